@@ -7,10 +7,11 @@ __copyright__ = '2012-2017, David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
 import calendar
-import os, threading, time, shutil, re
+import os, threading, time, shutil, re, hashlib
 from datetime import datetime, timedelta, timezone
-from contextlib import closing
+from contextlib import closing, contextmanager
 from collections import OrderedDict, defaultdict
+from functools import lru_cache
 
 
 # calibre Python 3 compatibility.
@@ -41,9 +42,9 @@ from six.moves.configparser import SafeConfigParser
 from six.moves.configparser import NoOptionError
 
 
-from calibre import strftime
-from calibre.constants import numeric_version as calibre_version
-from calibre.gui2 import error_dialog, info_dialog, open_url, question_dialog, FileDialog, open_local_file
+from calibre import strftime, human_readable
+from calibre.constants import numeric_version as calibre_version, isosx
+from calibre.gui2 import error_dialog, info_dialog, open_url, question_dialog, FileDialog, open_local_file, choose_files, choose_dir
 from calibre.gui2.actions import InterfaceAction
 from calibre.ptempfile import remove_dir
 from calibre.gui2.dialogs.message_box import ViewLog
@@ -51,12 +52,9 @@ from calibre.gui2.library.views import DeviceBooksView
 from calibre.utils.date import parse_date
 from calibre.utils.icu import sort_key
 from calibre.utils.config import config_dir
-from calibre.utils.logging import default_log
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata import authors_to_string
 from calibre.gui2.device import device_signals
-from calibre.ebooks.oeb.polish.container import EpubContainer
-from calibre.ebooks.oeb.polish.errors import DRMError
 
 from calibre.devices.kobo.driver import KOBO, KOBOTOUCH
 from calibre.devices.kobo.books import Book
@@ -90,7 +88,14 @@ MIMETYPE_KOBO = 'application/x-kobo-epub+zip'
 
 BOOKMARK_SEPARATOR = '|@ @|'       # Spaces are included to allow wrapping in the details panel
 
-EPUB_FETCH_QUERY = 'SELECT c1.ChapterIDBookmarked, ' \
+# Number of values to put in each "IN (...)" clause. Older SQLite versions limit a statement to 999 parameters.
+FETCH_BATCH_SIZE = 500
+# Number of books in each background job when getting the ToC status of books.
+TOC_STATUS_BATCH_SIZE = 20
+# Number of series or authors to set the related books for in each step, so the progress bar moves.
+RELATED_BOOKS_BATCH_SIZE = 50
+
+EPUB_FETCH_SELECT = 'SELECT c1.ChapterIDBookmarked, ' \
                         'c2.adobe_location, '      \
                         'c1.ReadStatus, '          \
                         'c1.___PercentRead, '      \
@@ -101,10 +106,11 @@ EPUB_FETCH_QUERY = 'SELECT c1.ChapterIDBookmarked, ' \
                         'r.rating, '               \
                         'c1.contentId '            \
                     'FROM content c1 LEFT OUTER JOIN content c2 ON c1.ChapterIDBookmarked = c2.ContentID ' \
-                        'LEFT OUTER JOIN ratings r ON c1.ContentID = r.ContentID '  \
-                    'WHERE c1.ContentID = ?'
+                        'LEFT OUTER JOIN ratings r ON c1.ContentID = r.ContentID '
+EPUB_FETCH_QUERY = EPUB_FETCH_SELECT + 'WHERE c1.ContentID = ?'
+EPUB_FETCH_QUERY_BATCH = EPUB_FETCH_SELECT + 'WHERE c1.ContentID IN ({0})'
 
-EPUB_FETCH_QUERY_NORATING = 'SELECT c1.ChapterIDBookmarked, ' \
+EPUB_FETCH_SELECT_NORATING = 'SELECT c1.ChapterIDBookmarked, ' \
                         'c2.adobe_location, '      \
                         'c1.ReadStatus, '          \
                         'c1.___PercentRead, '      \
@@ -114,10 +120,11 @@ EPUB_FETCH_QUERY_NORATING = 'SELECT c1.ChapterIDBookmarked, ' \
                         'c1.MimeType, '            \
                         'NULL as rating, '         \
                         'c1.contentId '            \
-                    'FROM content c1 LEFT OUTER JOIN content c2 ON c1.ChapterIDBookmarked = c2.ContentID ' \
-                    'WHERE c1.ContentID = ?'
+                    'FROM content c1 LEFT OUTER JOIN content c2 ON c1.ChapterIDBookmarked = c2.ContentID '
+EPUB_FETCH_QUERY_NORATING = EPUB_FETCH_SELECT_NORATING + 'WHERE c1.ContentID = ?'
+EPUB_FETCH_QUERY_NORATING_BATCH = EPUB_FETCH_SELECT_NORATING + 'WHERE c1.ContentID IN ({0})'
 
-KEPUB_FETCH_QUERY = 'SELECT c1.ChapterIDBookmarked, ' \
+KEPUB_FETCH_SELECT = 'SELECT c1.ChapterIDBookmarked, ' \
                         'c1.adobe_location, '      \
                         'c1.ReadStatus, '          \
                         'c1.___PercentRead, '      \
@@ -127,10 +134,11 @@ KEPUB_FETCH_QUERY = 'SELECT c1.ChapterIDBookmarked, ' \
                         'c1.MimeType, '            \
                         'r.rating, '               \
                         'c1.contentId '            \
-                    'FROM content c1 LEFT OUTER JOIN ratings r ON c1.ContentID = r.ContentID '  \
-                    'WHERE c1.ContentID = ?'
+                    'FROM content c1 LEFT OUTER JOIN ratings r ON c1.ContentID = r.ContentID '
+KEPUB_FETCH_QUERY = KEPUB_FETCH_SELECT + 'WHERE c1.ContentID = ?'
+KEPUB_FETCH_QUERY_BATCH = KEPUB_FETCH_SELECT + 'WHERE c1.ContentID IN ({0})'
 
-KEPUB_FETCH_QUERY_NORATING = 'SELECT c1.ChapterIDBookmarked, ' \
+KEPUB_FETCH_SELECT_NORATING = 'SELECT c1.ChapterIDBookmarked, ' \
                         'c1.adobe_location, '      \
                         'c1.ReadStatus, '          \
                         'c1.___PercentRead, '      \
@@ -140,25 +148,34 @@ KEPUB_FETCH_QUERY_NORATING = 'SELECT c1.ChapterIDBookmarked, ' \
                         'c1.MimeType, '            \
                         'NULL as rating, '         \
                         'c1.contentId '            \
-                    'FROM content c1 '             \
-                    'WHERE c1.ContentID = ?'
+                    'FROM content c1 '
+KEPUB_FETCH_QUERY_NORATING = KEPUB_FETCH_SELECT_NORATING + 'WHERE c1.ContentID = ?'
+KEPUB_FETCH_QUERY_NORATING_BATCH = KEPUB_FETCH_SELECT_NORATING + 'WHERE c1.ContentID IN ({0})'
 
 # Dictionary of Reading status fetch queries
 # Key is earliest firmware version that supports this query.
 # Values are a dictionary. The key of this is the book formats with the query as the value.
+# The "_batch" queries fetch the books with ContentIDs in a list. The list of
+# parameters is substituted for the "{0}".
 FETCH_QUERIES = {}
 FETCH_QUERIES[(0, 0, 0)] = {
                 'epub': EPUB_FETCH_QUERY_NORATING,
-                'kepub': KEPUB_FETCH_QUERY_NORATING
+                'kepub': KEPUB_FETCH_QUERY_NORATING,
+                'epub_batch': EPUB_FETCH_QUERY_NORATING_BATCH,
+                'kepub_batch': KEPUB_FETCH_QUERY_NORATING_BATCH
                 }
 FETCH_QUERIES[(1, 9, 17)] = {
                 'epub': EPUB_FETCH_QUERY,
-                'kepub': KEPUB_FETCH_QUERY
+                'kepub': KEPUB_FETCH_QUERY,
+                'epub_batch': EPUB_FETCH_QUERY_BATCH,
+                'kepub_batch': KEPUB_FETCH_QUERY_BATCH
                 }
 # With 4.17.13651, epub location is stored in the same way a for kepubs.
 FETCH_QUERIES[(4, 17, 13651)] = {
                 'epub': KEPUB_FETCH_QUERY,
-                'kepub': KEPUB_FETCH_QUERY
+                'kepub': KEPUB_FETCH_QUERY,
+                'epub_batch': KEPUB_FETCH_QUERY_BATCH,
+                'kepub_batch': KEPUB_FETCH_QUERY_BATCH
                 }
 
 KOBO_ROOT_DIR_NAME = ".kobo"
@@ -225,6 +242,9 @@ class KoboUtilitiesAction(InterfaceAction):
         self.menus_lock = threading.RLock()
         self.current_device_profile = None
         self.version_info           = None
+        self.device_paths_map       = {}
+        self.toc_status_dialog      = None
+        self.toc_jobs_pending       = 0
 
     def initialization_complete(self):
         # otherwise configured hot keys won't work until the menu's
@@ -297,6 +317,7 @@ class KoboUtilitiesAction(InterfaceAction):
             self.connected_device_info = None
             self.current_device_profile = None
             self.device = None
+            self.device_paths_map = {}
             self.rebuild_menus()
         else:
             self.get_device()
@@ -572,6 +593,13 @@ class KoboUtilitiesAction(InterfaceAction):
                                                             enabled=haveKobo,
                                                             is_library_action=True,
                                                             is_device_action=True)
+            self.rebuild_device_database_action = self.create_menu_item_ex(self.databaseMenu,  _("Rebuild database from incremental backup"),
+                                                            unique_name='Rebuild database from incremental backup',
+                                                            shortcut_name= _("Rebuild database from incremental backup"),
+                                                            triggered=self.rebuild_device_database_backup,
+                                                            enabled=True,
+                                                            is_library_action=True,
+                                                            is_device_action=True)
 
 #            self.menu.addSeparator()
 #            self.get_list_action = self.create_menu_item_ex(self.menu, 'Update TOC for Selected Book',
@@ -945,8 +973,9 @@ class KoboUtilitiesAction(InterfaceAction):
 
         self.options = dlg.new_prefs
         self.set_progressbar_label(_("Number of books to update metadata for {0}").format(len(books)))
-        updated_books, unchanged_books, not_on_device_books, count_books = self._update_metadata(books)
-        result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tUnchanged books={1}\n\tBooks not on device={2}\n\tTotal books={3}").format(updated_books, unchanged_books, not_on_device_books, count_books)
+        updated_books, unchanged_books, not_on_device_books, count_books, row_counts = self._update_metadata(books)
+        result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tUnchanged books={1}\n\tBooks not on device={2}\n\tTotal books={3}").format(updated_books, unchanged_books, not_on_device_books, count_books) \
+                             + self._rows_changed_message(row_counts)
         info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Device library updated"),
                     result_message,
                     show=True)
@@ -1057,6 +1086,8 @@ class KoboUtilitiesAction(InterfaceAction):
         self.options["epub_location_like_kepub"] = self.epub_location_like_kepub
         self.options['fetch_queries']        = self._get_fetch_query_for_firmware_version(self.device_fwversion)
         self.options['allOnDevice']          = True
+        self.options['device_uuid']          = self.device_uuid
+        self.options['library_uuid']         = get_library_uuid(library_db)
 
 #         QueueProgressDialog(self.gui, [], None, self.options, self._store_queue_job, library_db, plugin_action=self)
         if self.options[cfg.KEY_DO_NOT_STORE_IF_REOPENED]:
@@ -1075,39 +1106,30 @@ class KoboUtilitiesAction(InterfaceAction):
         onDevice_book_paths = self.get_device_paths_from_ids(onDeviceIds)
         debug_print("auto_store_current_bookmark::do_all_books -- onDevice_book_paths:", len(onDevice_book_paths))
 
-        self.books = self._convert_calibre_ids_to_books(library_db, onDeviceIds)
-        self.show_progressbar(len(self.books))
+        reading_values = self._get_current_reading_values(library_db, onDeviceIds,
+                                    (kobo_chapteridbookmarked_column, kobo_percentRead_column, rating_column, last_read_column))
+        self.show_progressbar(len(reading_values))
         self.set_progressbar_label(_('Queuing books'))
         books_to_scan = []
 
-        for book in self.books:
+        for book_id, (title, authors, current_chapterid, current_percentRead, current_rating, current_last_read) in reading_values.items():
             self.increment_progressbar()
-#             debug_print("auto_store_current_bookmark::do_all_books -- onDevice_book_paths[book.calibre_id]:", onDevice_book_paths[book.calibre_id])
-            device_book_paths = [x.path for x in onDevice_book_paths[book.calibre_id]]
+#             debug_print("auto_store_current_bookmark::do_all_books -- onDevice_book_paths[book_id]:", onDevice_book_paths[book_id])
+            device_book_paths = [x.path for x in onDevice_book_paths[book_id]]
 #             debug_print("auto_store_current_bookmark::do_all_books -- device_book_paths:", device_book_paths)
-            book.contentIDs = [self.contentid_from_path(path, self.CONTENTTYPE) for path in device_book_paths]
-            if len(book.contentIDs) > 0:
-                title               = book.title
+            contentIDs = [self.contentid_from_path(path, self.CONTENTTYPE) for path in device_book_paths]
+            if len(contentIDs) > 0:
                 self.set_progressbar_label(_('Queueing ') + title)
-                authors             = authors_to_string(book.authors)
-                current_chapterid   = None
-                current_percentRead = None
-                current_rating      = None
-                current_last_read   = None
-                if kobo_chapteridbookmarked_column is not None:
-                    current_chapterid = book.get_user_metadata(kobo_chapteridbookmarked_column, False)['#value#']
-                if kobo_percentRead_column is not None:
-                    current_percentRead = book.get_user_metadata(kobo_percentRead_column, False)['#value#']
-                if rating_column is not None:
-                    if rating_column == 'rating':
-                        current_rating = book.rating
-                    else:
-                        current_rating = book.get_user_metadata(rating_column, False)['#value#']
-                if last_read_column is not None:
-                    current_last_read = book.get_user_metadata(last_read_column, False)['#value#']
+#                 debug_print("auto_store_current_bookmark::do_books - adding:", book_id, contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read)
+                books_to_scan.append((book_id, contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read))
 
-#                 debug_print("auto_store_current_bookmark::do_books - adding:", book.calibre_id, book.contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read)
-                books_to_scan.append((book.calibre_id, book.contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read))
+        sync_watermark_settings = self._get_sync_watermark_settings(self.options, books_to_scan)
+        sync_watermark = cfg.get_sync_watermark(self.device_uuid, self.options['library_uuid'])
+        if sync_watermark and sync_watermark.get(cfg.KEY_WATERMARK_SETTINGS) != sync_watermark_settings:
+            debug_print("auto_store_current_bookmark::do_books - settings or books changed, ignoring sync watermark")
+            sync_watermark = None
+        self.options['sync_watermark']          = sync_watermark
+        self.options['sync_watermark_settings'] = sync_watermark_settings
 
         if len(books_to_scan) > 0:
             self._store_queue_job(None, self.options, books_to_scan)
@@ -1173,6 +1195,33 @@ class KoboUtilitiesAction(InterfaceAction):
         self.auto_backup_device_database(from_menu=True)
 
 
+    def rebuild_device_database_backup(self):
+        debug_print("rebuild_device_database_backup")
+        from calibre_plugins.koboutilities.jobs import restore_device_database_backup
+
+        backup_dir = self.current_backup_config[cfg.KEY_BACKUP_DEST_DIRECTORY] if self.current_backup_config else None
+        manifest_files = choose_files(self.gui, 'Kobo Utilities plugin:choose incremental backup',
+                        _("Choose Incremental Backup"),
+                        filters=[( _("Incremental backup"), ['chunks'])],
+                        all_files=False, select_only_single_file=True, default_dir=backup_dir)
+        if not manifest_files:
+            return
+        dest_dir = choose_dir(self.gui, 'Kobo Utilities plugin:choose rebuilt database destination', _("Choose Destination For The Rebuilt Database"))
+        if not dest_dir:
+            return
+
+        debug_print("rebuild_device_database_backup - manifest file=%s, dest_dir=%s" % (manifest_files[0], dest_dir))
+        try:
+            restored_files = restore_device_database_backup(manifest_files[0], dest_dir)
+        except Exception as e:
+            return error_dialog(self.gui, _("Cannot rebuild the device database."),
+                                _("The backup could not be rebuilt."),
+                                det_msg=unicode(e), show=True)
+
+        info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Database rebuilt"),
+                    _("The database files have been rebuilt:") + "\n\t" + "\n\t".join(restored_files),
+                    show=True)
+
     def auto_backup_device_database(self, from_menu=False):
         debug_print('auto_backup_device_database - start')
         if not self.current_backup_config:
@@ -1203,6 +1252,10 @@ class KoboUtilitiesAction(InterfaceAction):
         backup_options[cfg.KEY_DO_DAILY_BACKUP]        = self.current_backup_config[cfg.KEY_DO_DAILY_BACKUP]
         backup_options[cfg.KEY_BACKUP_EACH_CONNECTION] = self.current_backup_config[cfg.KEY_BACKUP_EACH_CONNECTION]
         backup_options[cfg.KEY_BACKUP_ZIP_DATABASE]    = self.current_backup_config[cfg.KEY_BACKUP_ZIP_DATABASE]
+        backup_options[cfg.KEY_BACKUP_INCREMENTAL]     = self.current_backup_config.get(cfg.KEY_BACKUP_INCREMENTAL, False)
+        backup_options[cfg.KEY_BACKUP_QUICK_CHECK]     = self.current_backup_config.get(cfg.KEY_BACKUP_QUICK_CHECK, False)
+        backup_options[cfg.KEY_BACKUP_ZIP_COMPRESSION] = self.current_backup_config.get(cfg.KEY_BACKUP_ZIP_COMPRESSION, 'deflate')
+        backup_options[cfg.KEY_BACKUP_ZIP_COMPRESSION_LEVEL] = self.current_backup_config.get(cfg.KEY_BACKUP_ZIP_COMPRESSION_LEVEL, 6)
         backup_options['device_name']                  = device_name
         backup_options['serial_number']                = serial_number
         backup_options['backup_file_template']         = backup_file_template
@@ -1279,12 +1332,16 @@ class KoboUtilitiesAction(InterfaceAction):
             book.paths = device_book_paths
             book.contentIDs = [self.contentid_from_path(path, self.CONTENTTYPE) for path in device_book_paths]
 
-        updated_books, not_on_device_books, count_books = self._restore_current_bookmark(books)
-        result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tBooks not on device={1}\n\tTotal books={2}").format(updated_books, not_on_device_books, count_books)
+        updated_books, not_on_device_books, count_books, row_counts = self._restore_current_bookmark(books)
+        result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tBooks not on device={1}\n\tTotal books={2}").format(updated_books, not_on_device_books, count_books) \
+                             + self._rows_changed_message(row_counts)
         info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Device library updated"),
                     result_message,
                     show=True)
 
+    def _rows_changed_message(self, row_counts):
+        return ''.join("\n\t" + _("Rows changed in {0}={1}").format(table, count) for table, count in row_counts.items())
+
     def _get_fetch_query_for_firmware_version(self, current_firmware_version):
         fetch_queries = None
         for fw_version in sorted(FETCH_QUERIES.keys()):
@@ -1353,11 +1410,7 @@ class KoboUtilitiesAction(InterfaceAction):
             book.contentIDs = [self.contentid_from_path(path, self.CONTENTTYPE) for path in device_book_paths]
 
         debug_print("backup_annotation_files - dest_path=", dest_path)
-        annotations_found, no_annotations, kepubs, count_books = self._backup_annotation_files(books, dest_path)
-        result_message = _("Annotations backup summary:\n\tBooks with annotations={0}\n\tBooks without annotations={1}\n\tKobo epubs={2}\n\tTotal books={3}").format(annotations_found, no_annotations, kepubs, count_books)
-        info_dialog(self.gui,  _("Kobo Utilities") + _(" - Annotations backup"),
-                    result_message,
-                    show=True)
+        self._backup_annotation_files(books, dest_path, dlg.zip_annotations())
 
     def remove_annotations_files(self):
         self.device = self.get_device()
@@ -1422,8 +1475,9 @@ class KoboUtilitiesAction(InterfaceAction):
 
         self.progressbar(_("Changing reading status on device"), on_top=False)
 
-        updated_books, unchanged_books, not_on_device_books, count_books = self._update_metadata(books)
-        result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tUnchanged books={1}\n\tBooks not on device={2}\n\tTotal books={3}").format(updated_books, unchanged_books, not_on_device_books, count_books)
+        updated_books, unchanged_books, not_on_device_books, count_books, row_counts = self._update_metadata(books)
+        result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tUnchanged books={1}\n\tBooks not on device={2}\n\tTotal books={3}").format(updated_books, unchanged_books, not_on_device_books, count_books) \
+                             + self._rows_changed_message(row_counts)
         info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Device library updated"),
                     result_message,
                     show=True)
@@ -1456,8 +1510,9 @@ class KoboUtilitiesAction(InterfaceAction):
         self.options = self.default_options()
         self.options['mark_not_interested'] = True
 
-        updated_books, unchanged_books, not_on_device_books, count_books = self._update_metadata(recommendations)
-        result_message = _("Books marked as Not Interested:\n\tBooks updated={0}\n\tUnchanged books={1}\n\tTotal books={2}").format(updated_books, unchanged_books, count_books)
+        updated_books, unchanged_books, not_on_device_books, count_books, row_counts = self._update_metadata(recommendations)
+        result_message = _("Books marked as Not Interested:\n\tBooks updated={0}\n\tUnchanged books={1}\n\tTotal books={2}").format(updated_books, unchanged_books, count_books) \
+                             + self._rows_changed_message(row_counts)
         info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Device library updated"),
                     result_message,
                     show=True)
@@ -1785,12 +1840,13 @@ class KoboUtilitiesAction(InterfaceAction):
 
         if self.options['title'] or self.options['series'] or self.options['published_date']:
             self.progressbar(_("Updating series information on device"), on_top=True)
-            updated_books, unchanged_books, not_on_device_books, count_books = self._update_metadata(books)
+            updated_books, unchanged_books, not_on_device_books, count_books, row_counts = self._update_metadata(books)
 
             debug_print("manage_series_on_device - about to call sync_booklists")
     #        self.device.sync_booklists((self.gui.current_view().model().db, None, None))
             USBMS.sync_booklists(self.device, (self.gui.current_view().model().db, None, None))
-            result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tUnchanged books={1}\n\tBooks not on device={2}\n\tTotal books={3}").format(updated_books, unchanged_books, not_on_device_books, count_books)
+            result_message = _("Update summary:") + "\n\t" + _("Books updated={0}\n\tUnchanged books={1}\n\tBooks not on device={2}\n\tTotal books={3}").format(updated_books, unchanged_books, not_on_device_books, count_books) \
+                             + self._rows_changed_message(row_counts)
         else:
             result_message = _("No changes made to series information.")
         info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Manage Series On Device"),
@@ -1848,11 +1904,7 @@ class KoboUtilitiesAction(InterfaceAction):
             return
         self.options = dlg.options
 
-        total_books, uploaded_covers, not_on_device_books = self._upload_covers(books)
-        result_message = _("Change summary:") + "\n\t" + _("Covers uploaded={0}\n\tBooks not on device={1}\n\tTotal books={2}").format(uploaded_covers, not_on_device_books, total_books)
-        info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Covers uploaded"),
-                    result_message,
-                    show=True)
+        self._upload_covers(books)
 
     def remove_covers(self):
         if len(self.gui.current_view().selectionModel().selectedRows()) == 0:
@@ -1976,7 +2028,18 @@ class KoboUtilitiesAction(InterfaceAction):
         self.options['main_image_path']      = self.device.normalize_path(self.main_image_path)
         self.options['sd_image_path']        = self.device.normalize_path(self.sd_image_path)
         self.options["device_database_path"] = self.device_database_path()
+        self.options['device_uuid']          = self.device_uuid
         self.options['job_function']         = 'clean_images_dir'
+        self.options['resume_cleanup']       = False
+
+        cleanup_plan = cfg.get_images_cleanup_plan(self.device_uuid)
+        if self.options['delete_extra_covers'] and cleanup_plan is not None:
+            remaining_images = len(cleanup_plan['main_memory']) + len(cleanup_plan['sd_card'])
+            self.options['resume_cleanup'] = question_dialog(self.gui, _("Clean images directory"),
+                        _("There is a saved cleanup plan from {0} with {1} image(s) still to be deleted. "
+                          "Do you want to delete the images in this plan?\n\n"
+                          "Choose No to check the images directory again.").format(cleanup_plan['created'], remaining_images),
+                        show_copy_button=False)
         debug_print("clean_images_dir - self.options=", self.options)
         QueueProgressDialog(self.gui, [], None, self.options, self._clean_images_dir_job, None)
 
@@ -2002,41 +2065,22 @@ class KoboUtilitiesAction(InterfaceAction):
         debug_print("_get_selected_ids - self.gui.current_view().model()", self.gui.current_view().model())
         return list(map(self.gui.current_view().model().id, rows))
 
+    @property
+    def contentid_translator(self):
+        # Built once for each device connection. The prefixes change when a different device is connected.
+        translator = getattr(self, '_contentid_translator', None)
+        if translator is None or not translator.is_for_device(self.device):
+            translator = ContentIDTranslator(self.device._main_prefix, self.device._card_a_prefix,
+                                             self.device.normalize_path('.kobo/kepub/'), self.device.path_from_contentid)
+            self._contentid_translator = translator
+        return translator
+
     def contentid_from_path(self, path, ContentType):
-#        debug_print("KoboUtilities.action:contentid_from_path - path='%s'"%path, "ContentType='%s'"%ContentType)
-#        debug_print("KoboUtilities.action:contentid_from_path - self.device._main_prefix='%s'"%self.device._main_prefix, "self.device.device._card_a_prefix='%s'"%self.device._card_a_prefix)
-        if ContentType == 6:
-            extension =  os.path.splitext(path)[1]
-            if extension == '.kobo':
-#                debug_print("KoboUtilities.action:contentid_from_path - have kepub")
-                ContentID = os.path.splitext(path)[0]
-                # Remove the prefix on the file.  it could be either
-                ContentID = ContentID.replace(self.device._main_prefix, '')
-            elif extension == '':
-#                debug_print("KoboUtilities.action:contentid_from_path - no extension:", os.path.join(self.device._main_prefix, '.kobo/kepub/'))
-                ContentID = path
-                ContentID = ContentID.replace(self.device._main_prefix + self.device.normalize_path('.kobo/kepub/'), '')
-            else:
-#                debug_print("KoboUtilities.action:contentid_from_path - All others")
-                ContentID = path
-                ContentID = ContentID.replace(self.device._main_prefix, "file:///mnt/onboard/")
-
-#            debug_print("KoboUtilities.action:contentid_from_path - 1 ContentID='%s'"%ContentID)
-
-            if self.device._card_a_prefix is not None:
-                ContentID = ContentID.replace(self.device._card_a_prefix,  "file:///mnt/sd/")
-        else:  # ContentType = 16
-#            debug_print("KoboUtilities.action:contentid_from_path ContentType other than 6 - ContentType='%d'"%ContentType, "path='%s'"%path)
-            ContentID = path
-            ContentID = ContentID.replace(self.device._main_prefix, "file:///mnt/onboard/")
-            if self.device._card_a_prefix is not None:
-                ContentID = ContentID.replace(self.device._card_a_prefix, "file:///mnt/sd/")
-        ContentID = ContentID.replace("\\", '/')
-#        debug_print("KoboUtilities.action:contentid_from_path - end - ContentID='%s'"%ContentID)
-        return ContentID
+        return self.contentid_translator.contentid_from_path(path, ContentType)
 
     def get_contentIDs_for_books(self, book_ids):
         contentIDs= []
+        self.get_device_paths_from_ids(book_ids)
         for book_id in book_ids:
             contentIDs_for_book = self.get_contentIDs_from_id(book_id)
             debug_print('get_contentIDs_for_books - contentIDs', contentIDs_for_book)
@@ -2068,8 +2112,57 @@ class KoboUtilitiesAction(InterfaceAction):
 
         return books
 
+    def _get_current_reading_values(self, db, ids, column_names):
+        '''
+        Get the title, authors and the current values of the reading location, percent read,
+        rating and last read columns for the books. With the new database API, each field is
+        read for all the books at once rather than building the full metadata for each book.
+        Returns a dictionary of tuples keyed by the book id.
+        '''
+        kobo_chapteridbookmarked_column, kobo_percentRead_column, rating_column, last_read_column = column_names
+        reading_values = {}
+        if not hasattr(db, 'new_api'):
+            for book in self._convert_calibre_ids_to_books(db, ids):
+                current_chapterid   = None
+                current_percentRead = None
+                current_rating      = None
+                current_last_read   = None
+                if kobo_chapteridbookmarked_column:
+                    current_chapterid = book.get_user_metadata(kobo_chapteridbookmarked_column, False)['#value#']
+                if kobo_percentRead_column:
+                    current_percentRead = book.get_user_metadata(kobo_percentRead_column, False)['#value#']
+                if rating_column:
+                    if rating_column == 'rating':
+                        current_rating = book.rating
+                    else:
+                        current_rating = book.get_user_metadata(rating_column, False)['#value#']
+                if last_read_column:
+                    current_last_read = book.get_user_metadata(last_read_column, False)['#value#']
+                reading_values[book.calibre_id] = (book.title, authors_to_string(book.authors),
+                                                   current_chapterid, current_percentRead, current_rating, current_last_read)
+            return reading_values
+
+        ids = list(ids)
+        no_values = dict.fromkeys(ids)
+        def field_values(field):
+            return db.new_api.all_field_for(field, ids, default_value=None) if field else no_values
+
+        titles              = field_values('title')
+        authors             = field_values('authors')
+        current_chapterids  = field_values(kobo_chapteridbookmarked_column)
+        current_percentRead = field_values(kobo_percentRead_column)
+        current_ratings     = field_values(rating_column)
+        current_last_read   = field_values(last_read_column)
+        for book_id in ids:
+            reading_values[book_id] = (titles[book_id], authors_to_string(authors[book_id] or ()),
+                                       current_chapterids[book_id], current_percentRead[book_id],
+                                       current_ratings[book_id], current_last_read[book_id])
+        return reading_values
+
     def _convert_calibre_ids_to_books(self, db, ids, get_cover=False):
         books = []
+        # The device paths for the books are usually needed next. Get them for all the books at once.
+        self.get_device_paths_from_ids(ids)
         for book_id in ids:
             book = self._convert_calibre_id_to_book(db, book_id, get_cover=get_cover)
 #            debug_print('_convert_calibre_ids_to_books - book', book)
@@ -2132,6 +2225,10 @@ class KoboUtilitiesAction(InterfaceAction):
             debug_print('No device connected')
             self.device = None
 
+        # Each action starts by getting the device. The map of device paths is rebuilt
+        # for each action so it reflects any changes to the books on the device.
+        self.device_paths_map = {}
+
         self.current_device_profile = None
         self.current_device_config = None
         self.current_backup_config = None
@@ -2193,58 +2290,48 @@ class KoboUtilitiesAction(InterfaceAction):
         return self.device.fwversion
 
     def get_device_path_from_id(self, book_id):
-        paths = []
-        for x in ('memory', 'card_a'):
-            x = getattr(self.gui, x+'_view').model()
-            paths += x.paths_for_db_ids(set([book_id]), as_map=True)[book_id]
+        paths = self.get_device_paths_from_ids([book_id])[book_id]
         return paths[0].path if paths else None
 
 
     def get_device_paths_from_id(self, book_id):
-        paths = []
-        for x in ('memory', 'card_a'):
-            x = getattr(self.gui, x+'_view').model()
-            paths += x.paths_for_db_ids([book_id], as_map=True)[book_id]
+        paths = self.get_device_paths_from_ids([book_id])[book_id]
         debug_print("get_device_paths_from_id - paths=", paths)
         return [r.path for r in paths]
 
     def get_device_paths_from_ids(self, book_ids):
+        '''
+        Get the books on the device for the book ids. The device views are only searched
+        for book ids not already in the map of device paths.
+        '''
+        missing_book_ids = [book_id for book_id in book_ids if book_id not in self.device_paths_map]
+        if missing_book_ids:
+            found_paths = defaultdict(list)
+            for x in ('memory', 'card_a'):
+                x = getattr(self.gui, x+'_view').model()
+                x = x.paths_for_db_ids(missing_book_ids, as_map=True)
+                for book_id in x.keys():
+                    found_paths[book_id].extend(x[book_id])
+            for book_id in missing_book_ids:
+                self.device_paths_map[book_id] = found_paths[book_id]
+
         paths = defaultdict(list)
-        for x in ('memory', 'card_a'):
-            x = getattr(self.gui, x+'_view').model()
-            x = x.paths_for_db_ids(book_ids, as_map=True)
-            for book_id in x.keys():
-                paths[book_id].extend(x[book_id])
+        for book_id in book_ids:
+            paths[book_id] = self.device_paths_map[book_id]
         return paths
 
 
     def get_device_path_from_contentID(self, contentID, mimetype):
-        if contentID.startswith("file:///mnt/sd/"):
-            card = 'carda'
-            device_prefix_path = self.device._card_a_prefix
-            book_path = contentID[len("file:///mnt/sd/")]
-        else:
-            device_prefix_path = self.device._main_prefix
-            book_path = contentID[len("file:///mnt/sd/")]
-            card = 'main'
-        return self.device.path_from_contentid(contentID, '6', mimetype, card, None)
+        return self.contentid_translator.path_from_contentid(contentID, mimetype)
 
     def get_contentIDs_from_id(self, book_id):
         debug_print("get_contentIDs_from_id - book_id=", book_id)
-        paths = []
-        for x in ('memory', 'card_a'):
-#            debug_print("get_contentIDs_from_id - x=", x)
-            x = getattr(self.gui, x+'_view').model()
-#            debug_print("get_contentIDs_from_id - x=", x)
-            paths += x.paths_for_db_ids(set([book_id]), as_map=True)[book_id]
+        paths = self.get_device_paths_from_ids([book_id])[book_id]
         debug_print("get_contentIDs_from_id - paths=", paths)
         return [r.contentID for r in paths]
 
     def get_contentIDs_from_book(self, book):
-        paths = []
-        for x in ('memory', 'card_a'):
-            x = getattr(self.gui, x+'_view').model()
-            paths += x.paths_for_db_ids(set([book_id]), as_map=True)[book_id]
+        paths = self.get_device_paths_from_ids([book.calibre_id])[book.calibre_id]
         debug_print("get_contentIDs_from_book - paths=", paths)
         return [r.contentID for r in paths]
 
@@ -2271,7 +2358,7 @@ class KoboUtilitiesAction(InterfaceAction):
             remove_dir(tdir)
             return
 
-        cpus = 1# self.gui.device_manager.server.pool_size
+        cpus = self.gui.job_manager.server.pool_size
         from calibre_plugins.koboutilities.jobs import do_store_locations
         args = [books_to_modify, options, cpus]
         desc = _('Storing reading positions for {0} books').format(len(books_to_modify))
@@ -2290,6 +2377,7 @@ class KoboUtilitiesAction(InterfaceAction):
         update_count = len(modified_epubs_map) if modified_epubs_map else 0
         if update_count == 0:
             msg = _('No reading positions were found that need to be updated')
+            self._save_sync_watermark(options)
             if options[cfg.KEY_PROMPT_TO_STORE]:
                 return info_dialog(self.gui, _('Kobo Utilities'), msg,
                                     show_copy_button=True, show=True,
@@ -2298,6 +2386,7 @@ class KoboUtilitiesAction(InterfaceAction):
                 self.gui.status_bar.show_message(_('Kobo Utilities') + ' - ' + _('Storing reading positions completed - No changes found'), 3000)
         else:
             msg = _('Kobo Utilities stored reading locations for <b>{0} book(s)</b>').format(update_count)
+            all_books_stored = True
 
             if options[cfg.KEY_PROMPT_TO_STORE]:
                 profileName = options['profileName'] if 'profileName' in options else None
@@ -2315,7 +2404,11 @@ class KoboUtilitiesAction(InterfaceAction):
                     return
                 self.options = dlg.prefs
                 modified_epubs_map = dlg.reading_locations
+                all_books_stored = len(modified_epubs_map) == update_count
             self._update_database_columns(modified_epubs_map)
+            # If any books were not stored, keep the old watermark so they are checked again next time.
+            if all_books_stored:
+                self._save_sync_watermark(options)
 
             if options[cfg.KEY_PROMPT_TO_STORE]:
                 if self.options[cfg.KEY_SELECT_BOOKS_IN_LIBRARY] or self.options[cfg.KEY_UPDATE_GOODREADS_PROGRESS]:
@@ -2324,6 +2417,25 @@ class KoboUtilitiesAction(InterfaceAction):
                     debug_print("KoboUtilitiesAction::_store_completed - goodreads_sync_plugin.users.keys()=", list(goodreads_sync_plugin.users.keys()))
                     goodreads_sync_plugin.update_reading_progress('progress', sorted(goodreads_sync_plugin.users.keys())[0])
 
+    def _get_sync_watermark_settings(self, options, books_to_scan):
+        book_contentIDs = sorted(contentID for book in books_to_scan for contentID in book[1])
+        return {
+                cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN: options[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN],
+                cfg.KEY_PERCENT_READ_CUSTOM_COLUMN:     options[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN],
+                cfg.KEY_RATING_CUSTOM_COLUMN:           options[cfg.KEY_RATING_CUSTOM_COLUMN],
+                cfg.KEY_LAST_READ_CUSTOM_COLUMN:        options[cfg.KEY_LAST_READ_CUSTOM_COLUMN],
+                cfg.KEY_STORE_IF_MORE_RECENT:           options[cfg.KEY_STORE_IF_MORE_RECENT],
+                cfg.KEY_DO_NOT_STORE_IF_REOPENED:       options[cfg.KEY_DO_NOT_STORE_IF_REOPENED],
+                'books': hashlib.sha1('\n'.join(book_contentIDs).encode('utf-8')).hexdigest(),
+                }
+
+    def _save_sync_watermark(self, options):
+        # Only the automatic store of all books on the device uses the watermark.
+        if options.get('device_uuid') and options.get('new_sync_watermark'):
+            sync_watermark = dict(options['new_sync_watermark'])
+            sync_watermark[cfg.KEY_WATERMARK_SETTINGS] = options['sync_watermark_settings']
+            cfg.set_sync_watermark(options['device_uuid'], options['library_uuid'], sync_watermark)
+
 
 #    def _device_database_backup(self, backup_options):
 #        debug_print("KoboUtilitiesAction::_firmware_update")
@@ -2384,8 +2496,13 @@ class KoboUtilitiesAction(InterfaceAction):
             msg = _('No extra files found')
         else:
             msg = _("Kobo Utilities found <b>{0} extra cover(s)</b> in the cover directory.").format(extra_covers_count)
+            msg += "\n" +_("Space used by the extra covers: {0}").format(human_readable(extra_image_files['total_bytes']))
             if self.options['delete_extra_covers']:
-                msg += "\n" +_("All files have been deleted.")
+                if cfg.get_images_cleanup_plan(self.device_uuid) is None:
+                    msg += "\n" +_("All files have been deleted.")
+                else:
+                    msg += "\n" +_("Some files could not be deleted. Run the cleanup again to resume from the saved plan.")
+                msg += "\n" +_("Space reclaimed: {0}").format(human_readable(extra_image_files['deleted_bytes']))
             if len(extra_image_files['main_memory']):
                 details += "\n" +_("Extra files found in main memory images directory:") + "\n"
                 for filename in extra_image_files['main_memory']:
@@ -2782,6 +2899,7 @@ class KoboUtilitiesAction(InterfaceAction):
             # Generate path templates
             # Individual storage mount points scanned/resolved in driver.get_annotations()
             path_map = {}
+            self.get_device_paths_from_ids(ids)
             for _id in ids:
                 paths = self.get_device_paths_from_id(_id)
                 debug_print("generate_annotation_paths - paths=", paths)
@@ -2847,9 +2965,9 @@ class KoboUtilitiesAction(InterfaceAction):
 
     def _upload_covers(self, books):
 
-        uploaded_covers     = 0
         total_books         = 0
         not_on_device_books = len(books)
+        covers_to_upload    = []
 
         kobo_kepub_dir = self.device.normalize_path('.kobo/kepub/')
         sd_kepub_dir   = self.device.normalize_path('koboExtStorage/kepub/')
@@ -2858,6 +2976,17 @@ class KoboUtilitiesAction(InterfaceAction):
         driver_supports_extended_cover_options = hasattr(self.device, 'dithered_covers')
         driver_supports_cover_letterbox_colors = hasattr(self.device, 'letterbox_fs_covers_color')
 
+        cover_options = {}
+        if self.haveKoboTouch():
+            cover_options['keep_cover_aspect'] = self.options[cfg.KEY_COVERS_KEEP_ASPECT_RATIO]
+            if driver_supports_extended_cover_options or driver_supports_cover_letterbox_colors:
+                cover_options['dithered_covers']     = self.options[cfg.KEY_COVERS_DITHERED]
+                cover_options['letterbox_fs_covers'] = self.options[cfg.KEY_COVERS_LETTERBOX]
+                cover_options['png_covers']          = self.options[cfg.KEY_COVERS_PNG]
+            if driver_supports_cover_letterbox_colors:
+                cover_options['letterbox_color'] = self.options[cfg.KEY_COVERS_LETTERBOX_COLOR]
+        debug_print("_upload_covers - cover_options=", cover_options)
+
         for book in books:
             total_books += 1
 #            debug_print("_upload_covers - book=", book)
@@ -2867,37 +2996,41 @@ class KoboUtilitiesAction(InterfaceAction):
             for path in paths:
                 debug_print("_upload_covers - path=", path)
                 if (kobo_kepub_dir not in path and sd_kepub_dir not in path) or self.options[cfg.KEY_COVERS_UPDLOAD_KEPUB]:
-                    if self.haveKoboTouch():
-                        if driver_supports_cover_letterbox_colors:
-                            self.device._upload_cover(
-                                                      path, '', book, path,
-                                                      self.options[cfg.KEY_COVERS_BLACKANDWHITE],
-                                                      dithered_covers=self.options[cfg.KEY_COVERS_DITHERED],
-                                                      keep_cover_aspect=self.options[cfg.KEY_COVERS_KEEP_ASPECT_RATIO],
-                                                      letterbox_fs_covers=self.options[cfg.KEY_COVERS_LETTERBOX],
-                                                      letterbox_color=self.options[cfg.KEY_COVERS_LETTERBOX_COLOR],
-                                                      png_covers=self.options[cfg.KEY_COVERS_PNG]
-                                                    )
-                        elif driver_supports_extended_cover_options:
-                            self.device._upload_cover(
-                                                      path, '', book, path,
-                                                      self.options[cfg.KEY_COVERS_BLACKANDWHITE],
-                                                      dithered_covers=self.options[cfg.KEY_COVERS_DITHERED],
-                                                      keep_cover_aspect=self.options[cfg.KEY_COVERS_KEEP_ASPECT_RATIO],
-                                                      letterbox_fs_covers=self.options[cfg.KEY_COVERS_LETTERBOX],
-                                                      png_covers=self.options[cfg.KEY_COVERS_PNG]
-                                                    )
-                        else:
-                            self.device._upload_cover(
-                                                      path, '', book, path,
-                                                      self.options[cfg.KEY_COVERS_BLACKANDWHITE],
-                                                      keep_cover_aspect=self.options[cfg.KEY_COVERS_KEEP_ASPECT_RATIO]
-                                                    )
-                    else:
-                        self.device._upload_cover(path, '', book, path, self.options[cfg.KEY_COVERS_BLACKANDWHITE])
-                    uploaded_covers += 1
+                    covers_to_upload.append((book, path, self.contentid_from_path(path, self.CONTENTTYPE)))
+
+        upload_options = {}
+        upload_options['total_books']         = total_books
+        upload_options['not_on_device_books'] = not_on_device_books
+        upload_options['upload_grayscale']    = self.options[cfg.KEY_COVERS_BLACKANDWHITE]
+        upload_options['cover_options']       = cover_options
+        # Covers that have not changed since they were last uploaded are skipped. The device images
+        # directory layout is only known for the Kobo Touch driver.
+        upload_options['device_uuid']          = self.device_uuid
+        upload_options['device_database_path'] = self.device_database_path()
+        upload_options['cover_manifest']       = cfg.get_cover_manifest(self.device_uuid) if self.haveKoboTouch() else None
+
+        from calibre_plugins.koboutilities.jobs import do_upload_covers, JobNotification
+        notification = JobNotification()
+        args = [self.device, covers_to_upload, upload_options]
+        desc = _('Uploading covers for {0} books').format(total_books)
+        job = self.gui.device_manager.create_job(do_upload_covers, self.Dispatcher(self._upload_covers_completed),
+                                                 description=desc, args=args, kwargs={'notification': notification})
+        notification.job = job
+        job._tdir = None
+        self.gui.status_bar.show_message(_("Kobo Utilities") + " - " + desc, 3000)
 
-        return total_books, uploaded_covers, not_on_device_books
+
+    def _upload_covers_completed(self, job):
+        if job.failed:
+            self.gui.job_exception(job, dialog_title=_('Failed to upload covers'))
+            return
+        total_books, uploaded_covers, unchanged_covers, not_on_device_books, upload_options = job.result
+        if upload_options['cover_manifest'] is not None:
+            cfg.set_cover_manifest(upload_options['device_uuid'], upload_options['cover_manifest'])
+        result_message = _("Change summary:") + "\n\t" + _("Covers uploaded={0}\n\tCovers unchanged={1}\n\tBooks not on device={2}\n\tTotal books={3}").format(uploaded_covers, unchanged_covers, not_on_device_books, total_books)
+        info_dialog(self.gui,  _("Kobo Utilities") + " - " + _("Covers uploaded"),
+                    result_message,
+                    show=True)
 
 
     def _remove_covers(self, books):
@@ -3094,7 +3227,8 @@ class KoboUtilitiesAction(InterfaceAction):
 
 
     def _get_imageid_set(self):
-        with closing(self.device_database_connection(use_row_factory=True)) as connection:
+        with closing(self.device_database_connection(use_row_factory=True)) as connection, \
+                database_profile(connection, '_get_imageid_set'):
 
             imageId_query = 'SELECT DISTINCT ImageId '       \
                             'FROM content '         \
@@ -3258,12 +3392,13 @@ class KoboUtilitiesAction(InterfaceAction):
             for section in koboConfig.sections():
                 debug_print("_order_series_shelves - koboConfig section={0}, options={1}".format(section, koboConfig.options(section)))
 
-        with closing(self.device_database_connection(use_row_factory=True)) as connection:
+        with closing(self.device_database_connection(use_row_factory=True)) as connection, \
+                database_profile(connection, '_order_series_shelves'):
 
             shelves_query = ("SELECT sc.ShelfName, c.ContentId, c.Title, c.DateCreated, sc.DateModified, c.Series, c.SeriesNumber "
                              "FROM ShelfContent sc JOIN content c on sc.ContentId= c.ContentId "
                              "WHERE sc._IsDeleted = 'false' "
-                             "AND sc.ShelfName = ? "
+                             "AND sc.ShelfName IN ({0}) "
                              "ORDER BY sc.ShelfName, c.SeriesNumber"
                             )
             update_query = ("UPDATE ShelfContent "
@@ -3273,6 +3408,17 @@ class KoboUtilitiesAction(InterfaceAction):
                             )
 
             cursor = connection.cursor()
+
+            # Fetch the contents of all the shelves to be ordered at once.
+            shelf_names = [shelf['name'] for shelf in shelves if shelf['count'] > 1]
+            shelves_rows = defaultdict(list)
+            for i in range(0, len(shelf_names), FETCH_BATCH_SIZE):
+                batch = shelf_names[i:i + FETCH_BATCH_SIZE]
+                cursor.execute(shelves_query.format(','.join('?' * len(batch))), batch)
+                for row in cursor:
+                    shelves_rows[row['ShelfName']].append(row)
+
+            database_writer = DeviceDatabaseWriter()
             for shelf in shelves:
                 starting_shelves += 1
                 debug_print("_order_series_shelves - shelf=%s, count=%d" % (shelf['name'], shelf['count']))
@@ -3281,12 +3427,8 @@ class KoboUtilitiesAction(InterfaceAction):
                 if shelf['count'] <= 1:
                     continue
                 shelves_ordered += 1
-                shelf_data = (shelf['name'],)
-                debug_print("_order_series_shelves - shelf_data:", shelf_data)
-                cursor.execute(shelves_query, shelf_data)
                 shelf_dict = {}
-                for i, row in enumerate(cursor):
-                    debug_print("_order_series_shelves - row:", i, row)
+                for i, row in enumerate(shelves_rows[shelf['name']]):
                     debug_print("_order_series_shelves - row:", i, row["ShelfName"], row["ContentID"], row['Series'], row["SeriesNumber"])
                     series_name = row['Series'] if row['Series'] else ''
                     try:
@@ -3296,7 +3438,6 @@ class KoboUtilitiesAction(InterfaceAction):
                         numbers = re.findall(r"\d*\.?\d+", row["SeriesNumber"])
                         if len(numbers) > 0:
                             series_index = float(numbers[0])
-                    debug_print("_order_series_shelves - series_index=", series_index)
                     if order_by == cfg.KEY_ORDER_SHELVES_PUBLISHED:
                         date_created = row['DateCreated']
                         if date_created is None:
@@ -3305,24 +3446,15 @@ class KoboUtilitiesAction(InterfaceAction):
                         sort_key = (date_created, row['Title'])
                     else:
                         sort_key = (series_name, series_index, row['Title']) if not series_name == '' else (row['Title'], -1, '')
-                    debug_print("_order_series_shelves - sort_key:", sort_key)
-                    current_list = shelf_dict.get(sort_key, None)
-                    current_list = shelf_dict.get(sort_key, [])
-                    current_list.append(row['ContentID'])
-                    shelf_dict[sort_key] = current_list
-                debug_print("_order_series_shelves - shelf_dict:", shelf_dict)
-
+                    shelf_dict.setdefault(sort_key, []).append(row['ContentID'])
                 debug_print("_order_series_shelves - sorted shelf_dict:", sorted(shelf_dict))
 
                 lastModifiedTime = datetime.fromtimestamp(time.mktime(time.gmtime()))
-
                 debug_print("_order_series_shelves - lastModifiedTime=", lastModifiedTime, " timeDiff:", timeDiff)
-                for sort_key in sorted(shelf_dict, reverse=sort_descending):
-                    for contentId in shelf_dict[sort_key]:
-                        update_data = (strftime(self.device_timestamp_string, lastModifiedTime.timetuple()), shelf['name'], contentId)
-                        debug_print("_order_series_shelves - sort_key: ", sort_key,  " update_data:", update_data)
-                        cursor.execute(update_query, update_data)
-                        lastModifiedTime += timeDiff
+                contentIds = [contentId for sort_key in sorted(shelf_dict, reverse=sort_descending) for contentId in shelf_dict[sort_key]]
+                for i, contentId in enumerate(contentIds):
+                    update_data = (strftime(self.device_timestamp_string, (lastModifiedTime + i * timeDiff).timetuple()), shelf['name'], contentId)
+                    database_writer.add('ShelfContent', update_query, update_data)
                 if update_config:
                     try:
                         shelf_key = quote("LastLibrarySorter_shelf_filterByBookshelf(" + shelf['name'] + ")")
@@ -3343,6 +3475,8 @@ class KoboUtilitiesAction(InterfaceAction):
                     debug_print("_order_series_shelves - koboConfig=", koboConfig)
 
             cursor.close()
+            row_counts = database_writer.execute(connection)
+            debug_print("_order_series_shelves - rows changed=", row_counts)
             if update_config:
                 with open(config_file_path, 'w') as config_file:
                     debug_print("_order_series_shelves - writing config file")
@@ -3394,68 +3528,60 @@ class KoboUtilitiesAction(InterfaceAction):
     def _set_related_books(self, related_books, options):
         debug_print("_set_related_books - related_books:", related_books, " options:", options)
 
-        categories_count = 0
-        books_count  = 0
-
         self.progressbar(_("Set Related Books"), on_top=False)
-        total_related_books = len(related_books)
-        self.show_progressbar(total_related_books)
         self.pb.left_align_label()
 
-        with closing(self.device_database_connection(use_row_factory=True)) as connection:
+        with closing(self.device_database_connection(use_row_factory=True)) as connection, \
+                database_profile(connection, '_set_related_books'):
 
-            series_query = (
-                            "SELECT c.ContentID, c.Title, c.Attribution, Series, SeriesNumber "
-                            "FROM content c "
-                            "WHERE c.ContentType = 6 "
-                            "AND Series = ? "
-                            "AND ContentID LIKE 'file%' "
-                            )
-            author_query = (
-                            "SELECT c.ContentID, c.Title, c.Attribution, Series, SeriesNumber "
-                            "FROM content c "
-                            "WHERE c.ContentType = 6 "
-                            "AND Attribution = ? "
-                            "AND ContentID LIKE 'file%' "
-                            )
-            get_queries = [series_query, author_query]
-            get_query =  get_queries[options[cfg.KEY_RELATED_BOOKS_TYPE]]
+            related_columns = ['Series', 'Attribution']
+            related_column  = related_columns[options[cfg.KEY_RELATED_BOOKS_TYPE]]
+            # Every book in a category is related to every other book in it.
             insert_query = ("INSERT INTO volume_tabs "
-                            "VALUES ( ?, ? )"
+                            "SELECT v.ContentID, t.ContentID "
+                            "FROM content t JOIN content v ON v.{0} = t.{0} AND v.ContentID <> t.ContentID "
+                            "WHERE t.ContentType = 6 "
+                            "AND t.ContentID LIKE 'file%' "
+                            "AND v.ContentType = 6 "
+                            "AND v.ContentID LIKE 'file%' "
+                            "AND t.{0} IN ({1})"
                             )
-            delete_query = (
-                            "DELETE FROM volume_tabs  "
-                            "WHERE tabId = ? "
+            delete_query = ("DELETE FROM volume_tabs "
+                            "WHERE tabId IN ("
+                                "SELECT ContentID FROM content "
+                                "WHERE ContentType = 6 "
+                                "AND ContentID LIKE 'file%' "
+                                "AND {0} IN ({1})"
+                                ")"
                             )
 
-            cursor = connection.cursor()
-            for related_type in related_books:
-                self.set_progressbar_label(_("Setting related books for ") + related_type['name'])
-                self.increment_progressbar()
-
-                categories_count += 1
-                debug_print("_set_related_books - related_type=%s, count=%d" % (related_type['name'], related_type['count']))
-                if related_type['count'] <= 1:
-                    continue
-                related_type_data = (related_type['name'],)
-                debug_print("_set_related_books - related_type_data:", related_type_data)
-                cursor.execute(get_query, related_type_data)
-                related_type_contentIds = []
-                for i, row in enumerate(cursor):
-                    debug_print("_set_related_books - row:", i, row["ContentID"], row["Title"], row["Attribution"], row['Series'], row["SeriesNumber"])
-                    related_type_contentIds.append(row["ContentID"])
-
-                debug_print("_set_related_books - related_type_contentIds:", related_type_contentIds)
-                for tab_contentId in related_type_contentIds:
-                    cursor.execute(delete_query, (tab_contentId, ))
-                    books_count += 1
-                    for volume_contentId in related_type_contentIds:
-                        if not tab_contentId == volume_contentId:
-                            insert_data = (volume_contentId, tab_contentId)
-                            debug_print("_set_related_books - insert_data:", insert_data)
-                            cursor.execute(insert_query, insert_data)
+            categories_count = len(related_books)
+            related_types = [related_type for related_type in related_books if related_type['count'] > 1]
+            books_count = sum(related_type['count'] for related_type in related_types)
+            debug_print("_set_related_books - categories to set=%d, books=%d" % (len(related_types), books_count))
 
-            cursor.close()
+            # The old entries for a batch must be deleted before the new ones are inserted, so the
+            # statements are run in order in one transaction rather than through DeviceDatabaseWriter.
+            self.show_progressbar(-(-len(related_types) // RELATED_BOOKS_BATCH_SIZE))
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                total_changes = connection.totalchanges()
+                for i in range(0, len(related_types), RELATED_BOOKS_BATCH_SIZE):
+                    batch = [related_type['name'] for related_type in related_types[i:i + RELATED_BOOKS_BATCH_SIZE]]
+                    self.set_progressbar_label(_("Setting related books for ") + batch[0])
+                    parameters = ','.join('?' * len(batch))
+                    cursor.execute(delete_query.format(related_column, parameters), batch)
+                    cursor.execute(insert_query.format(related_column, parameters), batch)
+                    self.increment_progressbar()
+                cursor.execute('COMMIT')
+            except:
+                debug_print('_set_related_books - Database Exception: rolling back changes')
+                cursor.execute('ROLLBACK')
+                raise
+            finally:
+                cursor.close()
+            debug_print("_set_related_books - rows changed=", connection.totalchanges() - total_changes)
 
         self.hide_progressbar()
         debug_print("_set_related_books - end")
@@ -3745,10 +3871,13 @@ class KoboUtilitiesAction(InterfaceAction):
                            "AND seriesid IS NOT NULL "
                            )
 
-        with closing(self.device_database_connection(use_row_factory=True)) as connection:
+        with closing(self.device_database_connection(use_row_factory=True)) as connection, \
+                database_profile(connection, '_update_metadata'):
 
             test_query = self.generate_metadata_query()
             cursor = connection.cursor()
+            # Each change is to the rows for a single book, so the changes can be grouped by statement.
+            database_writer = DeviceDatabaseWriter(group_statements=True)
             kobo_series_dict = {}
             if self.supports_series_list:
                 cursor.execute(series_id_query)
@@ -4050,29 +4179,32 @@ class KoboUtilitiesAction(InterfaceAction):
                         update_values.append(contentID)
                         debug_print("_update_metadata: update_query=%s" % update_query)
                         debug_print("_update_metadata: update_values= ", update_values)
-                        try:
-                            if changes_found:
-                                cursor.execute(update_query, update_values)
+                        if changes_found:
+                            database_writer.add('content', update_query, update_values)
 
-                            if rating_change_query:
-                                debug_print("_update_metadata: rating_change_query=%s" % rating_change_query)
-                                debug_print("_update_metadata: rating_values= ", rating_values)
-                                cursor.execute(rating_change_query, rating_values)
+                        if rating_change_query:
+                            debug_print("_update_metadata: rating_change_query=%s" % rating_change_query)
+                            debug_print("_update_metadata: rating_values= ", rating_values)
+                            database_writer.add('ratings', rating_change_query, rating_values)
 
-                            updated_books += 1
-                        except:
-                            debug_print('    Database Exception:  Unable to set series info')
-                            raise
+                        updated_books += 1
                     else:
                         debug_print("_update_metadata: no match for title='%s' contentId='%s'" % (book.title, contentID))
                         not_on_device_books += 1
+
+            try:
+                row_counts = database_writer.execute(connection)
+            except:
+                debug_print('    Database Exception:  Unable to set series info')
+                raise
+            debug_print("_update_metadata: rows changed=", row_counts)
             debug_print("Update summary: Books updated=%d, unchanged books=%d, not on device=%d, Total=%d" % (updated_books, unchanged_books, not_on_device_books, count_books))
 
             cursor.close()
 
         self.hide_progressbar()
 
-        return (updated_books, unchanged_books, not_on_device_books, count_books)
+        return (updated_books, unchanged_books, not_on_device_books, count_books, row_counts)
 
 
     def _render_synopsis(self, mi, book, template=None):
@@ -4526,6 +4658,8 @@ class KoboUtilitiesAction(InterfaceAction):
         with closing(self.device_database_connection(use_row_factory=True)) as connection:
 
             cursor = connection.cursor()
+            # Each change is to the rows for a single book, so the changes can be grouped by statement.
+            database_writer = DeviceDatabaseWriter(group_statements=True)
 
             for book in books:
                 count_books += 1
@@ -4676,32 +4810,35 @@ class KoboUtilitiesAction(InterfaceAction):
 
                         debug_print("_restore_current_bookmark - chapter_update=%s" % chapter_update)
                         debug_print("_restore_current_bookmark - chapter_values= ", chapter_values)
-                        try:
-                            cursor.execute(chapter_update, chapter_values)
-                            if len(location_set_clause) > 0 and not (result['MimeType'] == MIMETYPE_KOBO or self.epub_location_like_kepub):
-                                location_update += location_set_clause[1:]
-                                location_update += ' WHERE ContentID = ? AND BookID IS NOT NULL'
-                                location_values.append(kobo_chapteridbookmarked)
-                                debug_print("_restore_current_bookmark - location_update=%s" % location_update)
-                                debug_print("_restore_current_bookmark - location_values= ", location_values)
-                                cursor.execute(location_update, location_values)
-                            if rating_change_query:
-                                debug_print("_restore_current_bookmark - rating_change_query=%s" % rating_change_query)
-                                debug_print("_restore_current_bookmark - rating_values= ", rating_values)
-                                cursor.execute(rating_change_query, rating_values)
-
-                            updated_books += 1
-                        except:
-                            debug_print('    Database Exception:  Unable to set bookmark info.')
-                            raise
+                        database_writer.add('content', chapter_update, chapter_values)
+                        if len(location_set_clause) > 0 and not (result['MimeType'] == MIMETYPE_KOBO or self.epub_location_like_kepub):
+                            location_update += location_set_clause[1:]
+                            location_update += ' WHERE ContentID = ? AND BookID IS NOT NULL'
+                            location_values.append(kobo_chapteridbookmarked)
+                            debug_print("_restore_current_bookmark - location_update=%s" % location_update)
+                            debug_print("_restore_current_bookmark - location_values= ", location_values)
+                            database_writer.add('content', location_update, location_values)
+                        if rating_change_query:
+                            debug_print("_restore_current_bookmark - rating_change_query=%s" % rating_change_query)
+                            debug_print("_restore_current_bookmark - rating_values= ", rating_values)
+                            database_writer.add('ratings', rating_change_query, rating_values)
+
+                        updated_books += 1
                     else:
                         debug_print("_restore_current_bookmark - no match for title='%s' contentId='%s'" % (book.title, book.contentID))
                         not_on_device_books += 1
+
+            try:
+                row_counts = database_writer.execute(connection)
+            except:
+                debug_print('    Database Exception:  Unable to set bookmark info.')
+                raise
+            debug_print("_restore_current_bookmark - rows changed=", row_counts)
             debug_print("_restore_current_bookmark - Update summary: Books updated=%d, not on device=%d, Total=%d" % (updated_books, not_on_device_books, count_books))
 
             cursor.close()
 
-        return (updated_books, not_on_device_books, count_books)
+        return (updated_books, not_on_device_books, count_books, row_counts)
 
 
     def _get_shelves_from_device(self, books, options=None):
@@ -5096,12 +5233,11 @@ class KoboUtilitiesAction(InterfaceAction):
 
         return 1
 
-    def _backup_annotation_files(self, books, dest_path):
+    def _backup_annotation_files(self, books, dest_path, zip_annotations):
 
-        annotations_found = 0
         kepubs            = 0
-        no_annotations    = 0
         count_books       = 0
+        annotation_files  = []
 
         debug_print("_backup_annotation_files - self.device_path='%s'" % (self.device_path))
         kepub_dir = self.device.normalize_path('.kobo/kepub/')
@@ -5113,32 +5249,44 @@ class KoboUtilitiesAction(InterfaceAction):
 
             for book_path in book.paths:
                 relative_path = book_path.replace(self.device_path, '')
-                annotation_file = self.device.normalize_path(annotations_dir + relative_path + annotations_ext)
-                debug_print("_backup_annotation_files - kepub title='%s' annotation_file='%s'" % (book.title, annotation_file))
                 if relative_path.startswith(kepub_dir):
                     debug_print("_backup_annotation_files - kepub title='%s' book_path='%s'" % (book.title, book_path))
                     kepubs += 1
-                elif os.path.exists(annotation_file):
-                    debug_print("_backup_annotation_files - book_path='%s'" % (book_path))
-                    backup_file = self.device.normalize_path(dest_path + '/'+ relative_path + annotations_ext)
-                    debug_print("_backup_annotation_files - backup_file='%s'" % (backup_file))
-                    d, p = os.path.splitdrive(backup_file)
-                    debug_print("_backup_annotation_files - d='%s' p='%s'" % (d, p))
-                    backup_path = os.path.dirname(unicode(backup_file))
-                    try:
-                        os.makedirs(backup_path)
-                    except OSError:
-                        debug_print("_backup_annotation_files - path exists: backup_path='%s'" % (backup_path))
-                        pass
-                    shutil.copyfile(annotation_file, backup_file)
-                    annotations_found += 1
                 else:
-                    debug_print("_backup_annotation_files - book_path='%s'" % (book_path))
-                    no_annotations += 1
+                    annotation_files.append(self.device.normalize_path(relative_path + annotations_ext))
+
+        options = {}
+        options['annotations_dir']  = annotations_dir
+        options['dest_path']        = dest_path
+        options['zip_annotations']  = zip_annotations
+        options['annotation_files'] = annotation_files
+        options['kepubs']           = kepubs
+        options['count_books']      = count_books
+
+        func = 'arbitrary_n'
+        cpus = self.gui.job_manager.server.pool_size
+        args = ['calibre_plugins.koboutilities.jobs', 'do_backup_annotation_files',
+                (options, cpus)]
+        desc = _("Backing up annotations files")
+        self.gui.job_manager.run_job(
+                self.Dispatcher(self._backup_annotation_files_completed), func, args=args,
+                    description=desc)
+        self.gui.status_bar.show_message(_("Backing up annotations files") + '...')
 
-        debug_print("Backup summary: annotations_found=%d, no_annotations=%d, kepubs=%d Total=%d" % (annotations_found, no_annotations, kepubs, count_books))
+    def _backup_annotation_files_completed(self, job):
+        if job.failed:
+            self.gui.job_exception(job, dialog_title=_('Failed to backup annotations files'))
+            return
+        backup_result = job.result
+        self.gui.status_bar.show_message(_('Backing up annotations files completed'), 3000)
+        debug_print("Backup summary: annotations_found=%d, no_annotations=%d, kepubs=%d Total=%d" % (backup_result['annotations_found'], backup_result['no_annotations'], backup_result['kepubs'], backup_result['count_books']))
 
-        return (annotations_found, no_annotations, kepubs, count_books)
+        result_message = _("Annotations backup summary:\n\tBooks with annotations={0}\n\tBooks without annotations={1}\n\tKobo epubs={2}\n\tTotal books={3}").format(backup_result['annotations_found'], backup_result['no_annotations'], backup_result['kepubs'], backup_result['count_books'])
+        result_message += "\n\t" + _("Unchanged annotations files={0}").format(backup_result['unchanged'])
+        result_message += "\n\n" + _("Backup saved in: {0}").format(backup_result['backup_file'])
+        info_dialog(self.gui,  _("Kobo Utilities") + _(" - Annotations backup"),
+                    result_message,
+                    show=True)
 
 
     def _check_device_is_ready(self, function_message):
@@ -5214,7 +5362,7 @@ class KoboUtilitiesAction(InterfaceAction):
         self.set_progressbar_label(_("Number of books: {0}").format(len(books)))
         self.show_progressbar(len(books))
 
-        self._get_chapter_status(db, books)
+        books_to_read = self._prepare_chapter_status(db, books)
 
         self.hide_progressbar()
 
@@ -5222,7 +5370,10 @@ class KoboUtilitiesAction(InterfaceAction):
                                  self.qaction.icon(),
                                  books,
                                  )
+        self.toc_status_dialog = d
+        self._read_book_tocs(books, books_to_read)
         d.exec_()
+        self.toc_status_dialog = None
         if d.result() != d.Accepted:
             return
 
@@ -5241,313 +5392,328 @@ class KoboUtilitiesAction(InterfaceAction):
 
             self.update_device_toc_for_books( update_books )
 
-    def load_ebook(self, pathtoebook):
-        debug_print("KoboUtilities::load_ebook - creating container")
-        try:
-            container = EpubContainer(pathtoebook, default_log)
-        except DRMError:
-            container = None
-            raise
-
-        return container
-
-
-    def _read_toc(self, toc, toc_depth=1, format_on_device='EPUB', container=None):
-        chapters = []
-        debug_print("KoboUtilities::_read_toc")
-        debug_print("_read_toc - toc.title=", toc.title)
-        debug_print("_read_toc - toc_depth=", toc_depth)
-#         debug_print("_read_toc - toc.depth=", toc.depth)
-        debug_print("KoboUtilities::_read_toc - parsing ToC")
-        for item in toc:
-#             debug_print("_read_toc - item=", item)
-            debug_print("_read_toc - item.title=", item.title)
-#            debug_print("_read_toc - item.dest=", item.dest)
-#            debug_print("_read_toc - item.frag=", item.frag)
-            debug_print("_read_toc - item.depth=", item.depth)
-            if item.dest is not None:
-                chapter = {}
-                chapter['title'] = item.title
-                chapter['path'] = item.dest
-                if format_on_device == 'KEPUB':
-                    chapter['path'] = container.name_to_href(item.dest, container.opf_name)
-                chapter['toc_depth'] = toc_depth
-                if item.frag:
-                    chapter['fragment'] = item.frag
-                    chapter['path'] = "{0}#{1}".format(chapter['path'], item.frag)
-                if format_on_device == 'KEPUB':
-                    chapter['path'] = "{0}-{1}".format(chapter['path'], toc_depth)
-                chapter['added'] = False
-                chapters.append(chapter)
-            chapters += self._read_toc(item, toc_depth + 1, format_on_device=format_on_device, container=container)
-
-        debug_print("KoboUtilities::_read_toc - finished")
-        return chapters
-
-    def _get_manifest_entries(self, container):
-        debug_print("KoboUtilities::_get_manifest_entries")
-
-        total_spine_size = 0
-        manifest_entries = []
-        debug_print("KoboUtilities::_get_manifest_entries - spine_items - manifest_entries=", manifest_entries)
-        for spine_name, spine_linear in container.spine_names:
-            spine_path = container.name_to_href(spine_name, container.opf_name)
-            file_size = container.filesize(spine_name)
-            total_spine_size += file_size
-            manifest_entries.append({'path': spine_path, 'file_size': file_size, 'name': spine_name})
-#             debug_print("KoboUtilities::_get_manifest_entries - spine_name=%s - count=%s" % (spine_name, count))
-        debug_print("KoboUtilities::_get_manifest_entries - manifest_entries=", manifest_entries)
-        return manifest_entries
-
-    def _get_chapter_list(self, book, pathtoebook, book_location, format_on_device='EPUB'):
-        debug_print("KoboUtilities::_get_chapter_list - for %s" % book_location)
-        from calibre.ebooks.oeb.polish.toc import get_toc
-        container = self.load_ebook(pathtoebook)
-        debug_print("KoboUtilities::_get_chapter_list - container.opf_dir='%s'" % container.opf_dir)
-        debug_print("KoboUtilities::_get_chapter_list - container.opf_name='%s'" % container.opf_name)
-        book[book_location + '_opf_name'] = container.opf_name
-        book[book_location + '_opf_dir'] = container.opf_dir
-        last_slash_index = book[book_location + '_opf_name'].rfind('/')
-        book[book_location + '_opf_dir'] = book[book_location + '_opf_name'][:last_slash_index] if last_slash_index >= 0 else ''
-        debug_print("KoboUtilities::_get_chapter_list - book[book_location + '_opf_dir']='%s'" % book[book_location + '_opf_dir'])
-        toc = get_toc(container)
-        debug_print("KoboUtilities::_get_chapter_list - toc=", toc)
-
-        book[book_location + '_chapters'] = self._read_toc(toc, format_on_device=format_on_device, container=container)
-        debug_print("KoboUtilities::_get_chapter_list - chapters=", book[book_location + '_chapters'])
-        book[book_location + '_manifest'] = self._get_manifest_entries(container)
-        book[book_location + '_container'] = container
-        return
-
-    def _get_chapter_status(self, db, books):
+    def _prepare_chapter_status(self, db, books):
+        '''
+        Find the device and library formats of the books. Returns the details of the
+        books that need their ToCs read in a background job.
+        '''
         debug_print("Starting check of chapter status for {0} books".format(len(books)))
-        with closing(self.device_database_connection(use_row_factory=True)) as connection:
-            i = 0
-            book_format = 'EPUB'
-            debug_print("_get_chapter_status - device format_map='{0}".format(self.device.settings().format_map))
-            for book in books:
-                self.increment_progressbar()
-                debug_print("\nHandling book: {0}".format(book))
-                debug_print("Getting chapters for book number {0}, title={1}, author={2}".format(i, book['title'], book['author']))
-                book['library_chapters'] = []
-                book['kobo_chapters'] = []
-                book['kobo_database_chapters'] = []
-                book['kobo_format_status'] = False
-                book['kobo_database_status'] = False
+        books_to_read = []
+        debug_print("_prepare_chapter_status - device format_map='{0}".format(self.device.settings().format_map))
+        for book_index, book in enumerate(books):
+            self.increment_progressbar()
+            debug_print("Getting formats for book number {0}, title={1}, author={2}".format(book_index, book['title'], book['author']))
+            book['library_chapters'] = []
+            book['kobo_chapters'] = []
+            book['kobo_database_chapters'] = []
+            book['kobo_format_status'] = False
+            book['kobo_database_status'] = False
+            book['can_update_toc'] = False
+
+            book_id = book['calibre_id']
+
+            debug_print("Finding book on device...")
+            device_book_path = self.get_device_path_from_id(book_id)
+            if device_book_path is None:
+                book['comment'] = _("eBook is not on Kobo eReader")
+                book['good'] = False
+                book['icon'] = 'window-close.png'
                 book['can_update_toc'] = False
+                continue
+            extension =  os.path.splitext(device_book_path)[1]
+            ContentType = self.device.get_content_type_from_extension(extension) if extension != '' else self.device.get_content_type_from_path(device_book_path)
+            book['ContentID'] = self.device.contentid_from_path(device_book_path, ContentType)
+            if ".kepub.epub" in book['ContentID']:
+                book['kobo_format'] = "KEPUB"
+            elif ".epub" in book['ContentID']:
+                book['kobo_format'] = "EPUB"
+            else:
+                book['kobo_format'] = extension[1:].upper()
+                book['comment'] = _("eBook on Kobo eReader is not supported format")
+                book['good'] = True
+                book['icon'] = 'window-close.png'
+                book['can_update_toc'] = False
+                book['kobo_format_status'] = True
+                continue
 
-                book_id = book['calibre_id']
+            debug_print("Checking for book in library...")
+            if db.has_format(book_id, book['kobo_format'], index_is_id=True):
+                book['library_format'] = book['kobo_format']
+            elif book['kobo_format'] == 'KEPUB' and 'EPUB'.lower() in self.device.settings().format_map \
+                and db.has_format(book_id, 'EPUB', index_is_id=True):
+                book['library_format'] = 'EPUB'
+            else:
+                book['comment'] = _("No suitable format in library for book. The format of the device is {0}").format(book['kobo_format'])
+                book['good'] = False
+                continue
 
-                debug_print("Finding book on device...")
-                device_book_path = self.get_device_path_from_id(book_id)
-                if device_book_path is None:
-                    book['comment'] = _("eBook is not on Kobo eReader")
-                    book['good'] = False
-                    book['icon'] = 'window-close.png'
-                    book['can_update_toc'] = False
-                    continue
-                extension =  os.path.splitext(device_book_path)[1]
-                ContentType = self.device.get_content_type_from_extension(extension) if extension != '' else self.device.get_content_type_from_path(device_book_path)
-                book['ContentID'] = self.device.contentid_from_path(device_book_path, ContentType)
-                if ".kepub.epub" in book['ContentID']:
-                    book['kobo_format'] = "KEPUB"
-                elif ".epub" in book['ContentID']:
-                    book['kobo_format'] = "EPUB"
-                else:
-                    book['kobo_format'] = extension[1:].upper()
-                    book['comment'] = _("eBook on Kobo eReader is not supported format")
-                    book['good'] = True
-                    book['icon'] = 'window-close.png'
-                    book['can_update_toc'] = False
-                    book['kobo_format_status'] = True
-                    continue
+            debug_print("Getting path to book in library...")
+            pathtoebook = db.format_abspath(book_id, book['library_format'], index_is_id=True)
+            book['good'] = False
+            book['comment'] = _("Checking ToC...")
+            books_to_read.append((book_index, pathtoebook, device_book_path, book['kobo_format']))
 
-                debug_print("Checking for book in library...")
-                if db.has_format(book_id, book['kobo_format'], index_is_id=True):
-                    book['library_format'] = book['kobo_format']
-                elif book['kobo_format'] == 'KEPUB' and 'EPUB'.lower() in self.device.settings().format_map \
-                    and db.has_format(book_id, 'EPUB', index_is_id=True):
-                    book['library_format'] = 'EPUB'
-                else:
-                    book['comment'] = _("No suitable format in library for book. The format of the device is {0}").format(book['kobo_format'])
-                    book['good'] = False
-                    continue
+        return books_to_read
 
-                debug_print("Getting path to book in library...")
-                pathtoebook = db.format_abspath(book_id, book['library_format'], index_is_id=True)
-                debug_print("Getting chapters from library...")
-                try:
-                    self._get_chapter_list(book, pathtoebook, 'library', format_on_device=book['kobo_format'])
-                except DRMError:
-                    book['comment'] = _("eBook in library has DRM")
-                    book['good'] = False
-                    book['icon'] = 'window-close.png'
-                    continue
+    def _read_book_tocs(self, books, books_to_read):
+        '''
+        Read the ToCs of the books in background jobs. Each job handles a batch of books so
+        the jobs run in parallel and the results are shown as each batch finishes.
+        '''
+        # The ToC cache is created here so that the jobs do not race to create it.
+        cache_dir = cfg.get_toc_cache_dir()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
 
-                debug_print("Getting chapters from book on device...")
-                try:
-                    self._get_chapter_list(book, device_book_path, 'kobo', format_on_device=book['kobo_format'])
-                except DRMError:
-                    book['comment'] = _("eBook on Kobo eReader has DRM")
-                    book['good'] = False
-                    book['icon'] = 'window-close.png'
-                    continue
+        func = 'arbitrary_n'
+        cpus = self.gui.job_manager.server.pool_size
+        for i in range(0, len(books_to_read), TOC_STATUS_BATCH_SIZE):
+            batch = books_to_read[i:i + TOC_STATUS_BATCH_SIZE]
+            args = ['calibre_plugins.koboutilities.jobs', 'do_read_book_tocs',
+                    (batch, cpus)]
+            desc = _("Getting ToC status for {0} books").format(len(batch))
+            job = self.gui.job_manager.run_job(
+                    self.Dispatcher(self._read_book_tocs_completed), func, args=args,
+                        description=desc)
+            job._toc_books = books
+            job._toc_book_indexes = [book_to_read[0] for book_to_read in batch]
+            self.toc_jobs_pending += 1
+        if len(books_to_read) > 0:
+            self.gui.status_bar.show_message(_("Getting ToC status for books") + '...')
+
+    def _read_book_tocs_completed(self, job):
+        self.toc_jobs_pending -= 1
+        try:
+            self._show_book_tocs(job)
+        finally:
+            if self.toc_jobs_pending == 0:
+                # Only trim the ToC cache and refresh the device state when no job is using them.
+                from calibre_plugins.koboutilities.jobs import evict_toc_cache_entries
+                evict_toc_cache_entries(cfg.get_toc_cache_dir())
+                self.get_device()
+
+    def _show_book_tocs(self, job):
+        if self.toc_status_dialog is None:
+            debug_print("_show_book_tocs - ToC dialog has been closed, ignoring results")
+            return
+        if job.failed:
+            failed_books = [job._toc_books[book_index] for book_index in job._toc_book_indexes]
+            for book in failed_books:
+                book['comment'] = _("Could not read the ToC of the eBook")
+                book['good'] = False
+                book['icon'] = 'window-close.png'
+            self.toc_status_dialog.update_books(failed_books)
+            self.gui.job_exception(job, dialog_title=_('Failed to get ToC status for books'))
+            return
+        # Only check that the device is still there. Getting the device would reset the state
+        # that the batches still to finish use.
+        if self.gui.device_manager.connected_device is None:
+            debug_print("_show_book_tocs - device has been disconnected, ignoring results")
+            return
 
-                debug_print("Getting chapters from device database...")
-                if book['kobo_format'] == "KEPUB":
-                    book['kobo_database_chapters'] = self._get_database_chapters(connection, book['ContentID'], book['kobo_format'], 899)
-                    debug_print("_get_chapter_status - book['kobo_database_chapters']=", book['kobo_database_chapters'])
-                    book['kobo_database_manifest'] = self._get_database_chapters(connection,book['ContentID'], book['kobo_format'], 9)
-                    debug_print("_get_chapter_status - book['kobo_database_manifest']=", book['kobo_database_manifest'])
-                else:
-                    book['kobo_database_chapters'] = self._get_database_chapters(connection, book['ContentID'], book['kobo_format'], 9)
+        checked_books = []
+        for book_index, book_toc in job.result:
+            book = job._toc_books[book_index]
+            book.update(book_toc)
+            checked_books.append(book)
+        self._get_chapter_status(checked_books)
+        self.toc_status_dialog.update_books(checked_books)
+
+    def _get_chapter_status(self, books):
+        debug_print("_get_chapter_status - number of books=%d" % len(books))
+        books_to_check = [book for book in books if not book.get('library_drm', False) and not book.get('kobo_drm', False)
+                                                    and 'library_error' not in book and 'kobo_error' not in book]
+        with closing(self.device_database_connection(use_row_factory=True)) as connection:
+            database_chapters = self._get_database_chapters(connection, books_to_check)
+            reading_locations = self._get_database_current_chapters(connection, [book['ContentID'] for book in books_to_check])
 
-                koboDatabaseReadingLocation = self._get_database_current_chapter(book['ContentID'], connection)
-                if koboDatabaseReadingLocation is not None and len(koboDatabaseReadingLocation) > 0:
-                    book['koboDatabaseReadingLocation'] = koboDatabaseReadingLocation
-                    if self.device.fwversion < self.device.min_fwversion_epub_location:
-                        reading_location_volumeIndex, reading_location_file = re.match(r'\((\d+)\)(.*)\#?.*', koboDatabaseReadingLocation).groups()
-                        reading_location_volumeIndex = int(reading_location_volumeIndex)
+        for book in books:
+            debug_print("\nHandling book: {0}".format(book['title']))
+            book['good'] = True
+            book['comment'] = ''
+            if book.get('library_drm', False):
+                book['comment'] = _("eBook in library has DRM")
+                book['good'] = False
+                book['icon'] = 'window-close.png'
+                continue
+            if book.get('kobo_drm', False):
+                book['comment'] = _("eBook on Kobo eReader has DRM")
+                book['good'] = False
+                book['icon'] = 'window-close.png'
+                continue
+            if 'library_error' in book:
+                book['comment'] = _("Could not read eBook in library: {0}").format(book['library_error'])
+                book['good'] = False
+                book['icon'] = 'window-close.png'
+                continue
+            if 'kobo_error' in book:
+                book['comment'] = _("Could not read eBook on Kobo eReader: {0}").format(book['kobo_error'])
+                book['good'] = False
+                book['icon'] = 'window-close.png'
+                continue
+
+            debug_print("Getting chapters from device database...")
+            if book['kobo_format'] == "KEPUB":
+                book['kobo_database_chapters'] = database_chapters[(book['ContentID'], 899)]
+                debug_print("_get_chapter_status - book['kobo_database_chapters']=", book['kobo_database_chapters'])
+                book['kobo_database_manifest'] = database_chapters[(book['ContentID'], 9)]
+                debug_print("_get_chapter_status - book['kobo_database_manifest']=", book['kobo_database_manifest'])
+            else:
+                book['kobo_database_chapters'] = database_chapters[(book['ContentID'], 9)]
+
+            koboDatabaseReadingLocation = reading_locations.get(book['ContentID'])
+            if koboDatabaseReadingLocation is not None and len(koboDatabaseReadingLocation) > 0:
+                book['koboDatabaseReadingLocation'] = koboDatabaseReadingLocation
+                if self.device.fwversion < self.device.min_fwversion_epub_location:
+                    reading_location_volumeIndex, reading_location_file = re.match(r'\((\d+)\)(.*)\#?.*', koboDatabaseReadingLocation).groups()
+                    reading_location_volumeIndex = int(reading_location_volumeIndex)
+                    try:
+                        debug_print("_get_chapter_status - reading_location_volumeIndex =%d, reading_location_file='%s'" % (reading_location_volumeIndex, reading_location_file))
+                        debug_print("_get_chapter_status - chapter location='%s'" % (book['kobo_database_chapters'][reading_location_volumeIndex]['path'], ))
+                    except:
+                        debug_print("_get_chapter_status - exception logging reading location details.")
+                    new_toc_readingposition_index = self._get_readingposition_index(book, koboDatabaseReadingLocation)
+                    if new_toc_readingposition_index is not None:
                         try:
-                            debug_print("_get_chapter_status - reading_location_volumeIndex =%d, reading_location_file='%s'" % (reading_location_volumeIndex, reading_location_file))
-                            debug_print("_get_chapter_status - chapter location='%s'" % (book['kobo_database_chapters'][reading_location_volumeIndex]['path'], ))
+                            real_path, chapter_position = book['kobo_database_chapters'][reading_location_volumeIndex]['path'].split('#')
+                            debug_print("_get_chapter_status - chapter_location='%s'" % (chapter_position, ))
+                            book['kobo_database_chapters'][reading_location_volumeIndex]['path'] = real_path
+                            new_chapter_position = '{0}#{1}'.format(book['library_chapters'][new_toc_readingposition_index]['path'], chapter_position)
+                            book['library_chapters'][new_toc_readingposition_index]['chapter_position'] = new_chapter_position
+                            book['readingposition_index'] = new_toc_readingposition_index
+                            debug_print("_get_chapter_status - new chapter_location='%s'" % (new_chapter_position, ))
                         except:
-                            debug_print("_get_chapter_status - exception logging reading location details.")
-                        new_toc_readingposition_index = self._get_readingposition_index(book, koboDatabaseReadingLocation)
-                        if new_toc_readingposition_index is not None:
-                            try:
-                                real_path, chapter_position = book['kobo_database_chapters'][reading_location_volumeIndex]['path'].split('#')
-                                debug_print("_get_chapter_status - chapter_location='%s'" % (chapter_position, ))
-                                book['kobo_database_chapters'][reading_location_volumeIndex]['path'] = real_path
-                                new_chapter_position = '{0}#{1}'.format(book['library_chapters'][new_toc_readingposition_index]['path'], chapter_position)
-                                book['library_chapters'][new_toc_readingposition_index]['chapter_position'] = new_chapter_position
-                                book['readingposition_index'] = new_toc_readingposition_index
-                                debug_print("_get_chapter_status - new chapter_location='%s'" % (new_chapter_position, ))
-                            except:
-                                debug_print("_get_chapter_status - current chapter has not location. Not setting it.")
-                                pass
-                debug_print("_get_chapter_status - len(book['library_chapters']) =", len(book['library_chapters']))
-                debug_print("_get_chapter_status - len(book['kobo_chapters']) =", len(book['kobo_chapters']))
-                debug_print("_get_chapter_status - len(book['kobo_database_chapters']) =", len(book['kobo_database_chapters']))
+                            debug_print("_get_chapter_status - current chapter has not location. Not setting it.")
+                            pass
+            debug_print("_get_chapter_status - len(book['library_chapters']) =", len(book['library_chapters']))
+            debug_print("_get_chapter_status - len(book['kobo_chapters']) =", len(book['kobo_chapters']))
+            debug_print("_get_chapter_status - len(book['kobo_database_chapters']) =", len(book['kobo_database_chapters']))
 #                debug_print("_get_chapter_status - book['library_chapters']=", book['library_chapters'])
 #                debug_print("_get_chapter_status - book['kobo_chapters']=", book['kobo_chapters'])
 #                debug_print("_get_chapter_status - book['kobo_database_chapters']=", book['kobo_database_chapters'])
-                if len(book['library_chapters']) == len(book['kobo_database_chapters']):
-                    debug_print("_get_chapter_status - ToC lengths the same in library and database.")
-                    book['good'] = True
-                    book['icon'] = 'ok.png'
-                    book['comment'] = 'Chapters match in all places'
-
-                if len(book['library_chapters']) != len(book['kobo_chapters']):
-                    debug_print("_get_chapter_status - ToC lengths different between library and device.")
-                    book['kobo_format_status'] = False
+            if len(book['library_chapters']) == len(book['kobo_database_chapters']):
+                debug_print("_get_chapter_status - ToC lengths the same in library and database.")
+                book['good'] = True
+                book['icon'] = 'ok.png'
+                book['comment'] = 'Chapters match in all places'
+
+            if len(book['library_chapters']) != len(book['kobo_chapters']):
+                debug_print("_get_chapter_status - ToC lengths different between library and device.")
+                book['kobo_format_status'] = False
+                book['comment'] = _('Book needs to be updated on Kobo eReader')
+                book['icon'] = 'toc.png'
+            else:
+                book['kobo_format_status'] = self._compare_toc_entries(book, book_format1='library', book_format2='kobo')
+                if book['kobo_format'] == 'KEPUB':
+                    book['kobo_format_status'] = book['kobo_format_status'] and self._compare_manifest_entries(book, book_format1='library', book_format2='kobo')
+                if book['kobo_format_status']:
+                    book['comment'] = 'Chapters in the book on the device do not match the library'
+            book['good'] = book['good'] and book['kobo_format_status']
+
+            if len(book['kobo_database_chapters']) == 0:
+                debug_print("_get_chapter_status - No chapters in database for book.")
+                book['can_update_toc'] = False
+                book['kobo_database_status'] = False
+                book['comment'] = 'Book needs to be imported on the device'
+                book['icon'] = 'window-close.png'
+                continue
+            elif len(book['kobo_chapters']) != len(book['kobo_database_chapters']):
+                debug_print("_get_chapter_status - ToC lengths different between book on device and the database.")
+                book['kobo_database_status'] = False
+                book['comment'] = 'Chapters need to be updated in Kobo eReader database'
+                book['icon'] = 'toc.png'
+                book['can_update_toc'] = True
+            else:
+                book['kobo_database_status'] = self._compare_toc_entries(book, book_format1='kobo', book_format2='kobo_database')
+                if book['kobo_format'] == 'KEPUB':
+                    book['kobo_database_status'] = book['kobo_database_status'] and self._compare_manifest_entries(book, book_format1='kobo', book_format2='kobo_database')
+                if book['kobo_database_status']:
+                    book['comment'] = 'Chapters need to be updated in Kobo eReader database'
+                book['can_update_toc'] = True
+            book['good'] = book['good'] and book['kobo_database_status']
+
+            if book['good']:
+                book['icon'] = 'ok.png'
+                book['comment'] = 'Chapters match in all places'
+            else:
+                book['icon'] = 'toc.png'
+                if not book['kobo_format_status']:
                     book['comment'] = _('Book needs to be updated on Kobo eReader')
-                    book['icon'] = 'toc.png'
-                else:
-                    book['kobo_format_status'] = self._compare_toc_entries(book, book_format1='library', book_format2='kobo')
-                    if book['kobo_format'] == 'KEPUB':
-                        book['kobo_format_status'] = book['kobo_format_status'] and self._compare_manifest_entries(book, book_format1='library', book_format2='kobo')
-                    if book['kobo_format_status']:
-                        book['comment'] = 'Chapters in the book on the device do not match the library'
-                book['good'] = book['good'] and book['kobo_format_status']
-
-                if len(book['kobo_database_chapters']) == 0:
-                    debug_print("_get_chapter_status - No chapters in database for book.")
-                    book['can_update_toc'] = False
-                    book['kobo_database_status'] = False
-                    book['comment'] = 'Book needs to be imported on the device'
-                    book['icon'] = 'window-close.png'
-                    continue
-                elif len(book['kobo_chapters']) != len(book['kobo_database_chapters']):
-                    debug_print("_get_chapter_status - ToC lengths different between book on device and the database.")
-                    book['kobo_database_status'] = False
+                elif not book['kobo_database_status']:
                     book['comment'] = 'Chapters need to be updated in Kobo eReader database'
-                    book['icon'] = 'toc.png'
-                    book['can_update_toc'] = True
-                else:
-                    book['kobo_database_status'] = self._compare_toc_entries(book, book_format1='kobo', book_format2='kobo_database')
-                    if book['kobo_format'] == 'KEPUB':
-                        book['kobo_database_status'] = book['kobo_database_status'] and self._compare_manifest_entries(book, book_format1='kobo', book_format2='kobo_database')
-                    if book['kobo_database_status']:
-                        book['comment'] = 'Chapters need to be updated in Kobo eReader database'
-                    book['can_update_toc'] = True
-                book['good'] = book['good'] and book['kobo_database_status']
-
-                if book['good']:
-                    book['icon'] = 'ok.png'
-                    book['comment'] = 'Chapters match in all places'
-                else:
-                    book['icon'] = 'toc.png'
-                    if not book['kobo_format_status']:
-                        book['comment'] = _('Book needs to be updated on Kobo eReader')
-                    elif not book['kobo_database_status']:
-                        book['comment'] = 'Chapters need to be updated in Kobo eReader database'
 
-                debug_print("\nFinished with book\n")# {0}\n".format(book))
-                i += 1
+            debug_print("\nFinished with book\n")# {0}\n".format(book))
 
 
-    def _get_database_chapters(self, connection, koboContentId, book_format='EPUB', contentId=9):
-        chapters = []
-        debug_print("KoboUtilities::_get_database_chapters - koboContentId='%s', book_format='%s', contentId='%s'" % (koboContentId, book_format, contentId))
+    def _get_database_chapters(self, connection, books):
+        '''
+        Get the chapters in the device database for the books. Returns a dictionary keyed by
+        the book's ContentID and the ContentType of the chapters.
+        '''
+        debug_print("KoboUtilities::_get_database_chapters - number of books=%d" % len(books))
+        book_formats = dict((book['ContentID'], book['kobo_format']) for book in books)
+        contentIDs = list(book_formats.keys())
+        chapters = defaultdict(list)
         chapterQuery = (
-                'SELECT ContentID, Title, adobe_location, VolumeIndex, Depth, ChapterIDBookmarked '
+                'SELECT ContentID, Title, adobe_location, VolumeIndex, Depth, ChapterIDBookmarked, BookID, ContentType '
                 'FROM content '
-                'WHERE BookID = ?'
-                'AND ContentType = ?'
+                'WHERE BookID IN ({0}) '
+                'AND ContentType IN (9, 899)'
                 )
         cursor = connection.cursor()
-        t = (koboContentId, contentId)
-        cursor.execute(chapterQuery, t)
-        for row in cursor:
-            chapter = {}
-            debug_print("_get_database_chapters - chapterContentId=%s" % (row['ContentID'],))
-            chapter['chapterContentId'] = row['ContentID']
-            chapter['VolumeIndex'] = row['VolumeIndex']
-            chapter['title'] = row['Title']
-            if book_format == 'KEPUB':
-                path_separator_index = row['ContentID'].find('!')
-                path_separator_index = row['ContentID'].find('!', path_separator_index + 1)
-                # chapter['path'] = unquote(row['ContentID'][path_separator_index+1:])#depth_separator_index])
-                chapter['path'] = row['ContentID'][path_separator_index+1:]
-            else:
-                chapter['path'] = row['ContentID'][len(koboContentId)+1:]
-                path_separator_index = chapter['path'].find(')')
-                chapter['path'] = chapter['path'][path_separator_index+1:]
-            chapter['adobe_location'] = row['adobe_location']
-            chapter['ChapterIDBookmarked'] = row['ChapterIDBookmarked']
-            chapter['toc_depth'] = row['Depth']
-            chapter['added'] = True
-            debug_print("_get_database_chapters - chapter= ", chapter)
-            chapters.append(chapter)
-
+        for i in range(0, len(contentIDs), FETCH_BATCH_SIZE):
+            batch = contentIDs[i:i + FETCH_BATCH_SIZE]
+            cursor.execute(chapterQuery.format(','.join('?' * len(batch))), batch)
+            for row in cursor:
+                koboContentId = row['BookID']
+                chapters[(koboContentId, row['ContentType'])].append(self._get_database_chapter(row, koboContentId, book_formats[koboContentId]))
         cursor.close()
-        chapters.sort(key=lambda x: x['VolumeIndex'])
+
+        for book_chapters in chapters.values():
+            book_chapters.sort(key=lambda x: x['VolumeIndex'])
 
         return chapters
 
-    def _get_database_current_chapter(self, koboContentId, connection):
-        debug_print("KoboUtilities::_get_database_current_chapter")
-        readingLocationchapterQuery = 'SELECT ContentID, ChapterIDBookmarked, ReadStatus FROM content WHERE ContentID = ?'
+    def _get_database_chapter(self, row, koboContentId, book_format='EPUB'):
+        chapter = {}
+        chapter['chapterContentId'] = row['ContentID']
+        chapter['VolumeIndex'] = row['VolumeIndex']
+        chapter['title'] = row['Title']
+        if book_format == 'KEPUB':
+            path_separator_index = row['ContentID'].find('!')
+            path_separator_index = row['ContentID'].find('!', path_separator_index + 1)
+            chapter['path'] = row['ContentID'][path_separator_index+1:]
+        else:
+            chapter['path'] = row['ContentID'][len(koboContentId)+1:]
+            path_separator_index = chapter['path'].find(')')
+            chapter['path'] = chapter['path'][path_separator_index+1:]
+        chapter['adobe_location'] = row['adobe_location']
+        chapter['ChapterIDBookmarked'] = row['ChapterIDBookmarked']
+        chapter['toc_depth'] = row['Depth']
+        chapter['added'] = True
+        return chapter
+
+    def _get_database_current_chapters(self, connection, contentIDs):
+        debug_print("KoboUtilities::_get_database_current_chapters - number of books=%d" % len(contentIDs))
+        readingLocationchapterQuery = 'SELECT ContentID, ChapterIDBookmarked, ReadStatus FROM content WHERE ContentID IN ({0})'
+        reading_locations = {}
         cursor = connection.cursor()
-        t = (koboContentId,)
-        cursor.execute(readingLocationchapterQuery, t)
-        try:
-            result = next(cursor)
-            debug_print("KoboUtilities::_get_database_current_chapter - result='%s'" % (result,))
-            if result['ChapterIDBookmarked'] is None:
-                reading_location = None
-            else:
-                reading_location = result['ChapterIDBookmarked']
-                if self.device.fwversion < self.device.min_fwversion_epub_location:
-                    reading_location = reading_location[len(koboContentId) + 1:] if (result['ReadStatus'] == 1) else None
-        except StopIteration:
-            debug_print("_check_book_in_database - no match for contentId='%s'" % (koboContentId,))
-            reading_location = None
+        for i in range(0, len(contentIDs), FETCH_BATCH_SIZE):
+            batch = contentIDs[i:i + FETCH_BATCH_SIZE]
+            cursor.execute(readingLocationchapterQuery.format(','.join('?' * len(batch))), batch)
+            for result in cursor:
+                koboContentId = result['ContentID']
+                if result['ChapterIDBookmarked'] is None:
+                    reading_location = None
+                else:
+                    reading_location = result['ChapterIDBookmarked']
+                    if self.device.fwversion < self.device.min_fwversion_epub_location:
+                        reading_location = reading_location[len(koboContentId) + 1:] if (result['ReadStatus'] == 1) else None
+                debug_print("KoboUtilities::_get_database_current_chapters - contentId='%s', reading_location='%s'" % (koboContentId, reading_location))
+                reading_locations[koboContentId] = reading_location
         cursor.close()
-        debug_print("KoboUtilities::_get_database_current_chapter - reading_location='%s'" % (reading_location,))
 
-        return reading_location
+        return reading_locations
 
 
     def _get_readingposition_index(self, book, koboDatabaseReadingLocation):
@@ -5665,16 +5831,19 @@ class KoboUtilitiesAction(InterfaceAction):
                 self.increment_progressbar()
 
                 if len(book['kobo_chapters']) > 0:
-                    self.remove_all_toc_entries(connection, book['ContentID'])
+                    database_writer = DeviceDatabaseWriter()
+                    self.remove_all_toc_entries(database_writer, book['ContentID'])
 
-                    self.update_device_toc_for_book(connection, book, book['ContentID'], book['title'], book['kobo_format'])
+                    self.update_device_toc_for_book(connection, database_writer, book, book['ContentID'], book['title'], book['kobo_format'])
+                    database_writer.execute(connection)
 
         self.hide_progressbar()
 
 
-    def update_device_toc_for_book(self, connection, book, bookID, bookTitle, book_format='EPUB'):
+    def update_device_toc_for_book(self, connection, database_writer, book, bookID, bookTitle, book_format='EPUB'):
         debug_print("update_device_toc_for_book - bookTitle=%s, len(book['library_chapters'])=%d" % (bookTitle, len(book['library_chapters'])))
         num_chapters = len(book['kobo_chapters'])
+        database_chapter_ids = self.get_database_chapter_ids(book['ContentID'], connection)
         for i, chapter in enumerate(book['kobo_chapters']):
             debug_print("update_device_toc_for_book - chapter=", (chapter))
             if book_format == 'KEPUB':
@@ -5682,16 +5851,20 @@ class KoboUtilitiesAction(InterfaceAction):
             else:
                 chapterContentId = book['ContentID'] + '#({0})'.format(i) + chapter['path']
             debug_print("update_device_toc_for_book - chapterContentId=", chapterContentId)
-            databaseChapterId = self.getDatabaseChapterId(book['ContentID'], chapter['path'], connection)
+            databaseChapterId = self.getDatabaseChapterId(book['ContentID'], chapter['path'], database_chapter_ids)
             has_chapter = not databaseChapterId is None
             debug_print("update_device_toc_for_book - has_chapter=", has_chapter)
             if has_chapter and chapter['path'].endswith('finish.xhtml') \
                 and not chapterContentId == databaseChapterId:
                 debug_print("update_device_toc_for_book - removing SOL finish chapter")
-                self.removeChapterFromDatabase(databaseChapterId, bookID, connection)
+                self.removeChapterFromDatabase(databaseChapterId, bookID, database_writer)
+                database_chapter_ids.remove(databaseChapterId)
                 has_chapter = False
             if not has_chapter:
-                self.addChapterToDatabase(chapterContentId, chapter, bookID, bookTitle, i, connection, book_format)
+                addedChapterId = self.addChapterToDatabase(chapterContentId, chapter, bookID, bookTitle, i, database_writer, book_format)
+                if addedChapterId.startswith(book['ContentID']):
+                    # Later chapters can match this one, as they did when the rows were inserted straight away.
+                    database_chapter_ids.append(addedChapterId)
                 chapter['added'] = True
 
         if book_format == 'KEPUB':
@@ -5701,59 +5874,57 @@ class KoboUtilitiesAction(InterfaceAction):
             for i, manifest_entry in enumerate(book['kobo_manifest']):
                 file_size = manifest_entry['file_size'] * 100 / total_file_size
                 manifest_entry_ContentId = "{0}!{1}!{2}".format(book['ContentID'][len('file://'):], book['kobo_opf_dir'], manifest_entry['path'])
-                self.addManifestEntryToDatabase(manifest_entry_ContentId, bookID, bookTitle, manifest_entry['path'], i, connection, book_format, file_size=int(file_size), file_offset=int(file_offset))
+                self.addManifestEntryToDatabase(manifest_entry_ContentId, bookID, bookTitle, manifest_entry['path'], i, database_writer, book_format, file_size=int(file_size), file_offset=int(file_offset))
                 file_offset += file_size
 
-        self.update_database_content_entry(connection, book['ContentID'], num_chapters)
+        self.update_database_content_entry(database_writer, book['ContentID'], num_chapters)
         return 0
 
-    def getDatabaseChapterId(self, bookId, toc_file, connection):
+    def get_database_chapter_ids(self, bookId, connection):
+        '''
+        Get the ContentIDs in the device database that start with the book's ContentID, leaving
+        out the rows removed by remove_all_toc_entries. This is read once for each book so that
+        getDatabaseChapterId can match the chapters without scanning the content table each time.
+        '''
         cursor = connection.cursor()
-        t = ("{0}%{1}%".format(bookId,toc_file),)
-        cursor.execute('select ContentID from Content where ContentID like ?', t)
-        try:
-            result = next(cursor)
-            chapterContentId = result[0]
-        except StopIteration:
-            chapterContentId = None
+        # A range on the primary key instead of "LIKE 'bookId%'" so the index is used. The rows are
+        # kept in table order, which is the order the LIKE query found them in.
+        t = (bookId, next_prefix(bookId), bookId)
+        cursor.execute('SELECT ContentID FROM content '
+                       'WHERE ContentID >= ? AND ContentID < ? '
+                       'AND (BookID IS NULL OR BookID <> ?) '
+                       'ORDER BY rowid', t)
+        database_chapter_ids = [row[0] for row in cursor]
+        cursor.close()
+        debug_print('get_database_chapter_ids - number of ContentIDs=%d' % len(database_chapter_ids))
+        return database_chapter_ids
+
+    def getDatabaseChapterId(self, bookId, toc_file, database_chapter_ids):
+        chapterContentId = None
+        # LIKE ignores case, so this does too.
+        toc_file = toc_file.lower()
+        for database_chapter_id in database_chapter_ids:
+            if toc_file in database_chapter_id[len(bookId):].lower():
+                chapterContentId = database_chapter_id
+                break
 
         debug_print('getDatabaseChapterId - chapterContentId=%s' % chapterContentId)
-        cursor.close()
         return chapterContentId
 
-    def removeChapterFromDatabase(self, chapterContentId, bookID, connection):
-        cursor = connection.cursor()
-        t = (chapterContentId,)
-        cursor.execute('delete from Content where ContentID = ?', t)
-        t = (bookID, chapterContentId,)
-        cursor.execute('delete from volume_shortcovers where volumeId = ? and shortcoverId = ?', t)
-
-        cursor.close()
-        return
+    def removeChapterFromDatabase(self, chapterContentId, bookID, database_writer):
+        database_writer.add('content', 'DELETE FROM content WHERE ContentID = ?', (chapterContentId,))
+        database_writer.add('volume_shortcovers', 'DELETE FROM volume_shortcovers WHERE volumeId = ? AND shortcoverId = ?', (bookID, chapterContentId,))
 
-    def update_database_content_entry(self, connection, contentId, num_chapters):
-        cursor = connection.cursor()
-        t = (contentId, num_chapters)
-        cursor.execute('UPDATE content SET NumShortcovers = ? where ContentID = ?', t)
-
-        cursor.close()
-        return
+    def update_database_content_entry(self, database_writer, contentId, num_chapters):
+        database_writer.add('content', 'UPDATE content SET NumShortcovers = ? WHERE ContentID = ?', (num_chapters, contentId))
 
-    def remove_all_toc_entries(self, connection, contentId):
+    def remove_all_toc_entries(self, database_writer, contentId):
         debug_print("remove_all_toc_entries - contentId=", contentId)
 
-        cursor = connection.cursor()
-        t = (contentId,)
-
-        cursor.execute('DELETE FROM Content WHERE BookID = ?', t)
-        cursor.execute('DELETE FROM volume_shortcovers WHERE volumeId = ?', t)
-
-        cursor.close()
+        database_writer.add('content', 'DELETE FROM content WHERE BookID = ?', (contentId,))
+        database_writer.add('volume_shortcovers', 'DELETE FROM volume_shortcovers WHERE volumeId = ?', (contentId,))
 
-        return
-
-    def addChapterToDatabase(self, chapterContentId, chapter, bookID, bookTitle, volumeIndex, connection, book_format='EPUB'):
-        cursorContent = connection.cursor()
+    def addChapterToDatabase(self, chapterContentId, chapter, bookID, bookTitle, volumeIndex, database_writer, book_format='EPUB'):
         insertContentQuery = 'INSERT INTO content '\
             '(ContentID, ContentType, MimeType, BookID, BookTitle, Title, Attribution, adobe_location'\
             ', IsEncrypted, FirstTimeReading, ParagraphBookmarked, BookmarkWordOffset, VolumeIndex, ___NumPages'\
@@ -5804,21 +5975,18 @@ class KoboUtilitiesAction(InterfaceAction):
                     )
 
         debug_print("addChapterToDatabase - insertContentData=", insertContentData)
-        cursorContent.execute(insertContentQuery, insertContentData)
-        cursorContent.close()
+        database_writer.add('content', insertContentQuery, insertContentData)
 
         if book_format == 'EPUB':
-            cursorShortCover = connection.cursor()
             insertShortCoverQuery = 'INSERT INTO volume_shortcovers (volumeId, shortcoverId, VolumeIndex) VALUES (?,?,?)'
             insertShortCoverData = (bookID, chapterContentId, volumeIndex, )
             debug_print("addChapterToDatabase - insertShortCoverData=", insertShortCoverData)
-            cursorShortCover.execute(insertShortCoverQuery, insertShortCoverData)
+            database_writer.add('volume_shortcovers', insertShortCoverQuery, insertShortCoverData)
 
-            cursorShortCover.close()
+        return chapterContentId
 
-    def addManifestEntryToDatabase(self, manifest_entry, bookID, bookTitle, title, volumeIndex, connection,
+    def addManifestEntryToDatabase(self, manifest_entry, bookID, bookTitle, title, volumeIndex, database_writer,
                                    book_format='EPUB', file_size=None, file_offset=None):
-        cursorContent = connection.cursor()
         insertContentQuery = 'INSERT INTO content '\
             '(ContentID, ContentType, MimeType, BookID, BookTitle, Title, Attribution, adobe_location'\
             ', IsEncrypted, FirstTimeReading, ParagraphBookmarked, BookmarkWordOffset, VolumeIndex, ___NumPages'\
@@ -5852,16 +6020,12 @@ class KoboUtilitiesAction(InterfaceAction):
                     None
                     )
         debug_print("addManifestEntryToDatabase - insertContentData=", insertContentData)
-        cursorContent.execute(insertContentQuery, insertContentData)
+        database_writer.add('content', insertContentQuery, insertContentData)
 
-        cursorShortCover = connection.cursor()
         insertShortCoverQuery = 'INSERT INTO volume_shortcovers (volumeId, shortcoverId, VolumeIndex) VALUES (?,?,?)'
         insertShortCoverData = (bookID, manifest_entry, volumeIndex, )
         debug_print("addManifestEntryToDatabase - insertShortCoverData=", insertShortCoverData)
-        cursorShortCover.execute(insertShortCoverQuery, insertShortCoverData)
-
-        cursorContent.close()
-        cursorShortCover.close()
+        database_writer.add('volume_shortcovers', insertShortCoverQuery, insertShortCoverData)
 
 
     '''
@@ -5930,23 +6094,190 @@ class KoboUtilitiesAction(InterfaceAction):
 
 
 
+class ContentIDTranslator(object):
+    '''
+    Converts between the paths of books on the device and their ContentIDs in
+    the device database. The prefixes are worked out once, each path only needs
+    a single prefix match and the results are memoised. Paths are found from
+    ContentIDs by the device driver, so they match the paths calibre uses.
+    '''
+
+    MAIN_CONTENTID_PREFIX   = 'file:///mnt/onboard/'
+    CARD_A_CONTENTID_PREFIX = 'file:///mnt/sd/'
+
+    def __init__(self, main_prefix, card_a_prefix, kepub_dir, driver_path_from_contentid, cache_size=65536):
+        self.main_prefix    = main_prefix
+        self.card_a_prefix  = card_a_prefix
+        self.kepub_prefix   = main_prefix + kepub_dir
+        self.driver_path_from_contentid = driver_path_from_contentid
+        self.contentid_from_path = lru_cache(maxsize=cache_size)(self._contentid_from_path)
+        self.path_from_contentid = lru_cache(maxsize=cache_size)(self._path_from_contentid)
+
+    def is_for_device(self, device):
+        return self.main_prefix == device._main_prefix and self.card_a_prefix == device._card_a_prefix
+
+    def _replace_prefix(self, path, prefix, replacement):
+        if prefix and path.startswith(prefix):
+            return replacement + path[len(prefix):], True
+        return path, False
+
+    def _contentid_from_path(self, path, ContentType):
+        main_replacement = self.MAIN_CONTENTID_PREFIX
+        main_prefix      = self.main_prefix
+        if ContentType == 6:
+            root, extension = os.path.splitext(path)
+            if extension == '.kobo':
+                path = root
+                main_replacement = ''
+            elif extension == '':
+                main_prefix      = self.kepub_prefix
+                main_replacement = ''
+
+        ContentID, replaced = self._replace_prefix(path, main_prefix, main_replacement)
+        if not replaced:
+            ContentID, replaced = self._replace_prefix(path, self.card_a_prefix, self.CARD_A_CONTENTID_PREFIX)
+        return ContentID.replace("\\", '/')
+
+    def _path_from_contentid(self, ContentID, MimeType):
+        card = 'carda' if ContentID.startswith(self.CARD_A_CONTENTID_PREFIX) else 'main'
+        return self.driver_path_from_contentid(ContentID, '6', MimeType, card, None)
+
+
+def next_prefix(prefix):
+    '''
+    The smallest string greater than all the strings starting with the prefix, for
+    "value >= prefix AND value < next_prefix(prefix)" range queries.
+    '''
+    while prefix:
+        last_char = ord(prefix[-1])
+        if last_char < 0x10FFFF:
+            # Skip the surrogates, they cannot be stored in the database.
+            next_char = 0xE000 if last_char == 0xD7FF else last_char + 1
+            return prefix[:-1] + six.unichr(next_char)
+        prefix = prefix[:-1]
+    return None
+
 def row_factory(cursor, row):
     return {k[0]: row[i] for i, k in enumerate(cursor.getdescription())}
 
-def device_database_connection(database_path, use_row_factory=False):
+def device_database_connection(database_path, use_row_factory=False, readonly=False):
 
     import apsw
-    db_connection = apsw.Connection(database_path)
+    if readonly:
+        db_connection = apsw.Connection(database_path, flags=apsw.SQLITE_OPEN_READONLY)
+    else:
+        db_connection = apsw.Connection(database_path)
     if use_row_factory:
         db_connection.setrowtrace(row_factory)
 
     return db_connection
 
 
-def check_device_database(database_path):
+@contextmanager
+def database_profile(connection, name):
+    '''
+    Log the time taken, the SQL run and the peak memory use of the process
+    while the block runs. "executions" counts every statement execution,
+    including each set of bindings passed to executemany, and "statements" counts
+    the distinct SQL statements. The peak memory is in kilobytes. The log lines
+    start with "PROFILE" so they can be picked out of the debug log and compared
+    between releases.
+    '''
+    execution_count = [0]
+    statements = set()
+
+    previous_tracer = connection.getexectrace()
+
+    def count_statements(cursor, sql, bindings):
+        execution_count[0] += 1
+        statements.add(sql)
+        return previous_tracer(cursor, sql, bindings) if previous_tracer else True
+
+    connection.setexectrace(count_statements)
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        connection.setexectrace(previous_tracer)
+        try:
+            import resource
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+            if isosx:
+                max_rss //= 1024
+        except ImportError:
+            # Not available on Windows.
+            max_rss = -1
+        debug_print("PROFILE name=%s seconds=%.3f executions=%d statements=%d max_rss_kb=%d" % (name, time.time() - start_time, execution_count[0], len(statements), max_rss))
+
+
+class DeviceDatabaseWriter(object):
+    '''
+    Collects the changes to be made to the device database and writes them in
+    a single transaction. The changes are run in the order they were added, with
+    each run of changes using the same statement done by a single executemany.
+
+    If group_statements is True, all the changes using the same statement are run
+    together, in the order each statement was first added. This is only safe when
+    no two changes using different statements touch the same rows.
+    '''
+
+    def __init__(self, group_statements=False):
+        self.group_statements = group_statements
+        self.statements = []
+        self.statement_indexes = {}
+
+    def add(self, table, query, values):
+        key = (table, query)
+        if self.group_statements:
+            index = self.statement_indexes.get(key)
+        else:
+            index = len(self.statements) - 1 if self.statements and self.statements[-1][0] == key else None
+        if index is None:
+            index = len(self.statements)
+            self.statements.append((key, []))
+            self.statement_indexes[key] = index
+        self.statements[index][1].append(tuple(values))
+
+    def __len__(self):
+        return sum(len(values) for _key, values in self.statements)
+
+    def execute(self, connection):
+        '''
+        Run all the collected changes. Returns a dictionary with the number of
+        rows changed in each table.
+        '''
+        row_counts = OrderedDict()
+        if not self.statements:
+            return row_counts
+
+        cursor = connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for (table, query), values in self.statements:
+                debug_print("DeviceDatabaseWriter:execute - table=%s, rows=%d, query=%s" % (table, len(values), query))
+                total_changes = connection.totalchanges()
+                cursor.executemany(query, values)
+                row_counts[table] = row_counts.get(table, 0) + connection.totalchanges() - total_changes
+            cursor.execute('COMMIT')
+        except:
+            debug_print('DeviceDatabaseWriter:execute - Database Exception: rolling back changes')
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            cursor.close()
+        self.statements = []
+        self.statement_indexes = {}
+
+        debug_print("DeviceDatabaseWriter:execute - row_counts=", row_counts)
+        return row_counts
+
+
+def check_device_database(database_path, quick_check=False):
     with closing(device_database_connection(database_path)) as connection:
 
-        check_query = 'PRAGMA integrity_check'
+        # quick_check skips checking that the indexes match the tables, which is most of the work.
+        check_query = 'PRAGMA quick_check' if quick_check else 'PRAGMA integrity_check'
         cursor = connection.cursor()
 
         check_result = ''
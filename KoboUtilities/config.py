@@ -7,7 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2012-2022, David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
-import copy, traceback
+import copy, traceback, os
 
 # calibre Python 3 compatibility.
 from six import text_type as unicode
@@ -25,7 +25,7 @@ except ImportError:
 
 from calibre.gui2 import choose_dir, error_dialog, question_dialog
 from calibre.gui2.dialogs.confirm_delete import confirm
-from calibre.utils.config import JSONConfig
+from calibre.utils.config import JSONConfig, config_dir
 from calibre.constants import DEBUG as _DEBUG
 
 from calibre_plugins.koboutilities.common_utils import (get_library_uuid, debug_print, get_icon,
@@ -130,6 +130,9 @@ KEY_COVERS_LETTERBOX_COLOR   = 'letterbox_color'
 KEY_DRIVER_SUPPORTS_COVERS_LETTERBOX_COLOR = 'driver_supports_cover_letterbox_colors'
 KEY_COVERS_PNG               = 'png_covers'
 KEY_COVERS_UPDLOAD_KEPUB     = 'kepub_covers'
+KEY_COVER_MANIFEST_COVERS    = 'covers'
+
+KEY_IMAGES_CLEANUP_PLAN      = 'plan'
 
 KEY_DISMISS_CURRENT_EXTRAS   = 'dismissCurrentExtras'
 KEY_TILE_RECENT_NEW          = 'tileRecentBooksNew'
@@ -188,6 +191,11 @@ KEY_BACKUP_EACH_CONNECTION  = 'backupEachCOnnection'
 KEY_BACKUP_COPIES_TO_KEEP   = 'backupCopiesToKeepSpin'
 KEY_BACKUP_DEST_DIRECTORY   = 'backupDestDirectory'
 KEY_BACKUP_ZIP_DATABASE     = 'backupZipDatabase'
+KEY_BACKUP_INCREMENTAL      = 'backupIncremental'
+KEY_BACKUP_QUICK_CHECK      = 'backupQuickCheck'
+KEY_BACKUP_ZIP_COMPRESSION  = 'backupZipCompression'
+KEY_BACKUP_ZIP_COMPRESSION_LEVEL = 'backupZipCompressionLevel'
+BACKUP_ZIP_COMPRESSIONS = ['deflate', 'lzma', 'stored']
 
 KEY_SHELVES_CUSTOM_COLUMN   = 'shelvesColumn'
 KEY_ALL_BOOKS               = 'allBooks'
@@ -210,6 +218,15 @@ STORE_DEVICES = 'Devices'
 #                           'active':True, 'collections':False}, ...}
 DEFAULT_DEVICES_VALUES = {}
 
+STORE_SYNC_WATERMARKS = 'syncWatermarks'
+# Sync watermarks store consists of the most recent values seen when reading positions were last stored:
+# 'syncWatermarks': { 'dev_uuid': { 'library_uuid': {'DateLastRead':'xxx', '___SyncTime':'xxx', 'settings':{...}}, ...}, ...}
+# The settings are the columns, store options and books the watermark was taken with. The
+# watermark is ignored if any of these have changed.
+KEY_WATERMARK_DATE_LAST_READ = 'DateLastRead'
+KEY_WATERMARK_SYNC_TIME      = '___SyncTime'
+KEY_WATERMARK_SETTINGS       = 'settings'
+
 BOOKMARK_OPTIONS_DEFAULTS = {
                 KEY_STORE_BOOKMARK:             True,
                 KEY_READING_STATUS:             True,
@@ -310,7 +327,11 @@ BACKUP_OPTIONS_DEFAULTS = {
                 KEY_BACKUP_EACH_CONNECTION: False,
                 KEY_BACKUP_COPIES_TO_KEEP:  5,
                 KEY_BACKUP_DEST_DIRECTORY:  '',
-                KEY_BACKUP_ZIP_DATABASE:    True
+                KEY_BACKUP_ZIP_DATABASE:    True,
+                KEY_BACKUP_INCREMENTAL:     False,
+                KEY_BACKUP_QUICK_CHECK:     False,
+                KEY_BACKUP_ZIP_COMPRESSION: 'deflate',
+                KEY_BACKUP_ZIP_COMPRESSION_LEVEL: 6
                 }
 
 GET_SHELVES_OPTIONS_DEFAULTS = {
@@ -396,6 +417,7 @@ plugin_prefs.defaults[STORE_LIBRARIES]                  = {}
 plugin_prefs.defaults[BACKUP_OPTIONS_STORE_NAME]        = BACKUP_OPTIONS_DEFAULTS
 plugin_prefs.defaults[GET_SHELVES_OPTIONS_STORE_NAME]   = GET_SHELVES_OPTIONS_DEFAULTS
 plugin_prefs.defaults[STORE_DEVICES]                    = DEFAULT_DEVICES_VALUES
+plugin_prefs.defaults[STORE_SYNC_WATERMARKS]            = {}
 plugin_prefs.defaults[CUSTOM_COLUMNS_STORE_NAME]        = CUSTOM_COLUMNS_OPTIONS_DEFAULTS
 plugin_prefs.defaults[STORE_OPTIONS_STORE_NAME]         = STORE_OPTIONS_DEFAULTS
 plugin_prefs.defaults[READING_POSITION_CHANGES_STORE_NAME]    = READING_POSITION_CHANGES_DEFAULTS
@@ -559,6 +581,48 @@ def get_device_config(device_uuid):
     device_config = plugin_prefs[STORE_DEVICES].get(device_uuid, None)
     return device_config
 
+def get_sync_watermark(device_uuid, library_uuid):
+    sync_watermarks = plugin_prefs[STORE_SYNC_WATERMARKS]
+    return sync_watermarks.get(device_uuid, {}).get(library_uuid, None)
+
+def set_sync_watermark(device_uuid, library_uuid, sync_watermark):
+    debug_print("set_sync_watermark - device_uuid='%s', library_uuid='%s', sync_watermark=%s" % (device_uuid, library_uuid, sync_watermark))
+    sync_watermarks = plugin_prefs[STORE_SYNC_WATERMARKS]
+    sync_watermarks.setdefault(device_uuid, {})[library_uuid] = sync_watermark
+    plugin_prefs[STORE_SYNC_WATERMARKS] = sync_watermarks
+
+def get_cover_manifest(device_uuid):
+    # The cover manifest is kept in its own file for each device as it has an entry for every cover uploaded.
+    # It consists of: 'covers': { 'ImageId': 'hash of the library cover and upload options', ...}
+    manifest = JSONConfig('plugins/Kobo Utilities - Covers - %s' % device_uuid)
+    return manifest.get(KEY_COVER_MANIFEST_COVERS, {})
+
+def set_cover_manifest(device_uuid, covers):
+    debug_print("set_cover_manifest - device_uuid='%s', number of covers=%d" % (device_uuid, len(covers)))
+    manifest = JSONConfig('plugins/Kobo Utilities - Covers - %s' % device_uuid)
+    manifest[KEY_COVER_MANIFEST_COVERS] = covers
+
+def get_images_cleanup_plan(device_uuid):
+    # The images cleanup plan is kept in its own file for each device so that an interrupted cleanup can be resumed.
+    # It consists of: 'plan': { 'main_memory': { 'ImageId': [[relative path, size], ...], ...}, 'sd_card': {...}, 'total_bytes': n }
+    plan_store = JSONConfig('plugins/Kobo Utilities - Images Cleanup - %s' % device_uuid)
+    return plan_store.get(KEY_IMAGES_CLEANUP_PLAN, None)
+
+def set_images_cleanup_plan(device_uuid, plan):
+    plan_store = JSONConfig('plugins/Kobo Utilities - Images Cleanup - %s' % device_uuid)
+    if plan is None:
+        debug_print("set_images_cleanup_plan - device_uuid='%s', removing plan" % (device_uuid,))
+        if KEY_IMAGES_CLEANUP_PLAN in plan_store:
+            del plan_store[KEY_IMAGES_CLEANUP_PLAN]
+    else:
+        debug_print("set_images_cleanup_plan - device_uuid='%s', main memory images=%d, SD card images=%d" % (device_uuid, len(plan['main_memory']), len(plan['sd_card'])))
+        plan_store[KEY_IMAGES_CLEANUP_PLAN] = plan
+
+def get_toc_cache_dir():
+    # The ToC cache has a JSON file for each book file whose ToC has been read. Each file has the path, size,
+    # modification time and hash of the book file, and the chapters and manifest read from it.
+    return os.path.join(config_dir, 'plugins', 'Kobo Utilities - ToC Cache')
+
 def set_library_config(db, library_config):
     debug_print("set_library_config - library_config:", library_config)
     db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS, library_config)
@@ -1002,6 +1066,28 @@ class DevicesTab(QWidget):
         self.zip_database_checkbox.setToolTip(_("If checked, the database file will be added to the zip file with configuration files."))
         options_layout.addWidget(self.zip_database_checkbox, 2, 0, 1, 3)
 
+        self.incremental_backup_checkbox = QCheckBox(_('Incremental database backups'), self)
+        self.incremental_backup_checkbox.setToolTip(_("If checked, only the parts of the database that have changed since the last backup are saved. "
+                                                      "Use \"Rebuild database from incremental backup\" to get the database from one of these backups."))
+        options_layout.addWidget(self.incremental_backup_checkbox, 3, 0, 1, 3)
+
+        self.quick_check_checkbox = QCheckBox(_('Quick check of backup'), self)
+        self.quick_check_checkbox.setToolTip(_("If checked, a quicker check is done on the backup of the database. This does not check that the indexes are correct."))
+        options_layout.addWidget(self.quick_check_checkbox, 4, 0, 1, 3)
+
+        self.zip_compression_label = QLabel(_("Compression:"), self)
+        self.zip_compression_label.setToolTip(_("The compression used for the zip file. LZMA makes smaller files but is slower."))
+        self.zip_compression_combo = QComboBox(self)
+        self.zip_compression_combo.addItems([_('Deflate'), _('LZMA'), _('None')])
+        self.zip_compression_label.setBuddy(self.zip_compression_combo)
+        self.zip_compression_level_spin = QSpinBox(self)
+        self.zip_compression_level_spin.setRange(0, 9)
+        self.zip_compression_level_spin.setToolTip(_("The compression level. Higher levels make smaller files but are slower. Only used for Deflate compression."))
+        self.zip_compression_combo.currentIndexChanged.connect(self.zip_compression_combo_changed)
+        options_layout.addWidget(self.zip_compression_label, 5, 0, 1, 1)
+        options_layout.addWidget(self.zip_compression_combo, 5, 1, 1, 1)
+        options_layout.addWidget(self.zip_compression_level_spin, 5, 2, 1, 1)
+
         layout.addLayout(options_layout)
 
         self.toggle_backup_options_state(False)
@@ -1143,6 +1229,16 @@ class DevicesTab(QWidget):
         self.copies_to_keep_checkbox.setEnabled(enabled)
         self.copies_to_keep_checkbox_clicked(enabled and self.copies_to_keep_checkbox.checkState() == Qt.Checked)
         self.zip_database_checkbox.setEnabled(enabled)
+        self.incremental_backup_checkbox.setEnabled(enabled)
+        self.quick_check_checkbox.setEnabled(enabled)
+        self.zip_compression_label.setEnabled(enabled)
+        self.zip_compression_combo.setEnabled(enabled)
+        self.zip_compression_combo_changed(self.zip_compression_combo.currentIndex())
+
+    def zip_compression_combo_changed(self, index):
+        # zipfile only uses the compression level for deflate.
+        self.zip_compression_level_spin.setEnabled(self.zip_compression_combo.isEnabled()
+                                                   and BACKUP_ZIP_COMPRESSIONS[index] == 'deflate')
 
     def do_daily_backp_checkbox_clicked(self, checked):
         enable_backup_options = checked or self.backup_each_connection_checkbox.checkState() ==  Qt.Checked
@@ -1185,11 +1281,19 @@ class DevicesTab(QWidget):
         dest_directory           = get_pref(backup_prefs, BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_DEST_DIRECTORY)
         copies_to_keep           = get_pref(backup_prefs, BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_COPIES_TO_KEEP)
         zip_database             = get_pref(backup_prefs, BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_ZIP_DATABASE)
+        incremental_backup       = get_pref(backup_prefs, BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_INCREMENTAL)
+        quick_check              = get_pref(backup_prefs, BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_QUICK_CHECK)
+        zip_compression          = get_pref(backup_prefs, BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_ZIP_COMPRESSION)
+        zip_compression_level    = get_pref(backup_prefs, BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_ZIP_COMPRESSION_LEVEL)
 
         self.do_daily_backp_checkbox.setCheckState(Qt.Checked if do_daily_backup else Qt.Unchecked)
         self.backup_each_connection_checkbox.setCheckState(Qt.Checked if backup_each_connection else Qt.Unchecked)
         self.dest_directory_edit.setText(dest_directory)
         self.zip_database_checkbox.setCheckState(Qt.Checked if zip_database else Qt.Unchecked)
+        self.incremental_backup_checkbox.setCheckState(Qt.Checked if incremental_backup else Qt.Unchecked)
+        self.quick_check_checkbox.setCheckState(Qt.Checked if quick_check else Qt.Unchecked)
+        self.zip_compression_combo.setCurrentIndex(BACKUP_ZIP_COMPRESSIONS.index(zip_compression) if zip_compression in BACKUP_ZIP_COMPRESSIONS else 0)
+        self.zip_compression_level_spin.setProperty('value', zip_compression_level)
         if copies_to_keep == -1:
             self.copies_to_keep_checkbox.setCheckState(Qt.Unchecked)
         else:
@@ -1209,6 +1313,10 @@ class DevicesTab(QWidget):
         backup_prefs[KEY_DO_DAILY_BACKUP]       = self.do_daily_backp_checkbox.checkState() == Qt.Checked
         backup_prefs[KEY_BACKUP_EACH_CONNECTION]= self.backup_each_connection_checkbox.checkState() == Qt.Checked
         backup_prefs[KEY_BACKUP_ZIP_DATABASE]   = self.zip_database_checkbox.checkState() == Qt.Checked
+        backup_prefs[KEY_BACKUP_INCREMENTAL]    = self.incremental_backup_checkbox.checkState() == Qt.Checked
+        backup_prefs[KEY_BACKUP_QUICK_CHECK]    = self.quick_check_checkbox.checkState() == Qt.Checked
+        backup_prefs[KEY_BACKUP_ZIP_COMPRESSION] = BACKUP_ZIP_COMPRESSIONS[self.zip_compression_combo.currentIndex()]
+        backup_prefs[KEY_BACKUP_ZIP_COMPRESSION_LEVEL] = int(self.zip_compression_level_spin.value())
         backup_prefs[KEY_BACKUP_DEST_DIRECTORY] = unicode(self.dest_directory_edit.text())
         backup_prefs[KEY_BACKUP_COPIES_TO_KEEP] = int(unicode(self.copies_to_keep_spin.value())) if self.copies_to_keep_checkbox.checkState() == Qt.Checked else -1
         debug_print("DevicesTab:persist_devices_config - backup_prefs:", backup_prefs)
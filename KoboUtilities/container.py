@@ -7,18 +7,19 @@ __license__   = 'GPL v3'
 __copyright__ = '2012, David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
-import os, posixpath, sys, re, urllib
+import os, posixpath, sys, re
 
 from lxml import etree
 from lxml.etree import XMLSyntaxError
-from urlparse import urldefrag, urlparse, urlunparse
-from urllib import unquote as urlunquote
+from six import text_type as unicode
+from six.moves.urllib.parse import urldefrag, urlparse, urlunparse
 
 from calibre import guess_type, prepare_string_for_xml
 from calibre.ebooks.chardet import xml_to_unicode
 from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
-from calibre.ebooks.oeb.base import urlnormalize, OEB_DOCS, XPath, SVG, XLINK
+from calibre.ebooks.oeb.base import urlnormalize, urlquote, urlunquote, OEB_DOCS, XPath, SVG, XLINK
 from calibre.ebooks.oeb.parse_utils import RECOVER_PARSER, NotHTML, parse_html
+from calibre.ebooks.oeb.polish.errors import DRMError
 from calibre.utils.zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 exists, join = os.path.exists, os.path.join
@@ -30,6 +31,8 @@ NCX_NS = 'http://www.daisy.org/z3986/2005/ncx/'
 IMAGE_FILES = ['.png','.jpg','.jpeg', '.gif', '.bmp', '.svg']
 FONT_FILES = ['.otf','.ttf']
 NON_HTML_FILES = IMAGE_FILES + FONT_FILES + ['.opf', '.xpgt', '.ncx', '.css']
+# Encryption methods used to obfuscate embedded fonts. Files encrypted with anything else mean the ePub has DRM.
+FONT_OBFUSCATION_ALGORITHMS = ['http://www.idpf.org/2008/embedding', 'http://ns.adobe.com/pdf/enc#RC']
 
 class InvalidEpub(ValueError):
     pass
@@ -78,14 +81,7 @@ class Container(object):
         if not exists(container_path):
             raise InvalidEpub('No META-INF/container.xml in epub')
         self.container = etree.fromstring(open(container_path, 'rb').read())
-        opf_files = self.container.xpath((
-            r'child::ocf:rootfiles/ocf:rootfile'
-            '[@media-type="%s" and @full-path]'%guess_type('a.opf')[0]
-            ), namespaces={'ocf':OCF_NS}
-        )
-        if not opf_files:
-            raise InvalidEpub('META-INF/container.xml contains no link to OPF file')
-        opf_path = os.path.join(self.root, *opf_files[0].get('full-path').split('/'))
+        opf_path = os.path.join(self.root, *self.get_opf_full_path().split('/'))
         if not exists(opf_path):
             raise InvalidEpub('OPF file does not exist at location pointed to'
                     ' by META-INF/container.xml')
@@ -110,18 +106,122 @@ class Container(object):
             href = item.get('href')
             self.mime_map[self.href_to_name(href)] = item.get('media-type')
 
-        self.ncx = self.ncx_name = None
+        self._ncx = self._ncx_name = None
+        self._ncx_loaded = False
+
+    def get_opf_full_path(self):
+        opf_files = self.container.xpath((
+            r'child::ocf:rootfiles/ocf:rootfile'
+            '[@media-type="%s" and @full-path]'%guess_type('a.opf')[0]
+            ), namespaces={'ocf':OCF_NS}
+        )
+        if not opf_files:
+            raise InvalidEpub('META-INF/container.xml contains no link to OPF file')
+        return opf_files[0].get('full-path')
+
+    def _load_ncx(self):
+        '''
+        The NCX is only found and parsed the first time it is used.
+        '''
+        if self._ncx_loaded:
+            return
+        self._ncx_loaded = True
         for name in self.manifest_worthy_names():
             if name.endswith('.ncx'):
                 try:
-                    self.ncx_name = name
-                    self.ncx = self.get_parsed_etree(self.ncx_name)
+                    self._ncx_name = name
+                    self._ncx = self.get_parsed_etree(self._ncx_name)
+                    if not hasattr(self._ncx, 'xpath'):
+                        # Not in the manifest as an NCX, so it has not been parsed
+                        self._ncx_name = None
+                        self._ncx = None
                 except ParseError:
                     # This ePub is probably protected with DRM and the NCX is encrypted
-                    self.ncx_name = None
-                    self.ncx = None
+                    self._ncx_name = None
+                    self._ncx = None
                 break
 
+    @property
+    def ncx_name(self):
+        self._load_ncx()
+        return self._ncx_name
+
+    @property
+    def ncx(self):
+        self._load_ncx()
+        return self._ncx
+
+    @property
+    def opf_version(self):
+        try:
+            return int(self.opf.get('version', '2.0').partition('.')[0])
+        except ValueError:
+            return 2
+
+    @property
+    def spine_names(self):
+        '''
+        The names of the files in the spine, in reading order, with whether each is linear.
+        '''
+        manifest_items = dict((item.get('id'), item) for item in self.opf.xpath(
+                '//opf:manifest/opf:item[@id and @href]', namespaces={'opf':OPF_NS}))
+        for itemref in self.opf.xpath('//opf:spine/opf:itemref[@idref]', namespaces={'opf':OPF_NS}):
+            item = manifest_items.get(itemref.get('idref'))
+            if item is None:
+                continue
+            name = self.href_to_name(item.get('href'))
+            if name in self.name_path_map:
+                yield name, itemref.get('linear', 'yes').lower() != 'no'
+
+    def filesize(self, name):
+        if name in self.raw_data_map:
+            return len(self.raw_data_map[name])
+        return os.path.getsize(self.name_path_map[name])
+
+    def get_ncx_toc(self):
+        '''
+        Return the ToC from the NCX as a tree of TocEntry objects.
+        '''
+        toc = TocEntry()
+        if self.ncx is None:
+            return toc
+        ncx_dir = posixpath.dirname(self.ncx_name)
+
+        def add_navpoints(node, parent):
+            for navpoint in node.xpath('*[local-name()="navPoint"]'):
+                title = ''.join(navpoint.xpath('*[local-name()="navLabel"]/*[local-name()="text"]//text()'))
+                title = re.sub(r'\s+', ' ', title).strip()
+                dest = frag = None
+                src = navpoint.xpath('*[local-name()="content"]/@src')
+                if src and src[0]:
+                    path, frag = urldefrag(src[0])
+                    if path:
+                        dest = self.href_to_name(path, rel_to_opf=False, base=ncx_dir)
+                entry = TocEntry(title or None, dest, frag or None)
+                parent.children.append(entry)
+                add_navpoints(navpoint, entry)
+
+        navmaps = self.ncx.xpath('//*[local-name()="navMap"]')
+        if navmaps:
+            add_navpoints(navmaps[0], toc)
+        return toc
+
+    def is_drm_encrypted(self):
+        for name in self.name_path_map.keys():
+            if name.lower().endswith('encryption.xml'):
+                try:
+                    enc_xml = self.get_raw(name)
+                    root = etree.fromstring(enc_xml)
+                    for em in root.xpath('descendant::*[contains(name(), "EncryptionMethod")]'):
+                        algorithm = em.get('Algorithm', '')
+                        if algorithm not in FONT_OBFUSCATION_ALGORITHMS:
+                            return True
+                except (ParseError, XMLSyntaxError):
+                    # Having a problem reading the encryption xml
+                    self.log.error('Error parsing encryption xml for DRM check')
+                return False
+        return False
+
     def manifest_worthy_names(self):
         for name in self.name_path_map:
             if name.endswith('.opf'): continue
@@ -169,11 +269,11 @@ class Container(object):
         if not base and rel_to_opf:
             base = self.opf_dir
         if not base:
-            return urllib.quote(name)
+            return urlquote(name)
         href = posixpath.relpath(name, base)
         if href == '.':
             href = ''
-        return urllib.quote(href)
+        return urlquote(href)
 
     def abshref(self, href, base_name):
         """Convert the URL provided in :param:`href` from a reference
@@ -332,6 +432,91 @@ class Container(object):
         return fix_data(data)
 
 
+class TocEntry(object):
+    '''
+    An entry in the ToC with the title, dest and frag attributes of the entries in
+    calibre's ToC. Iterating over an entry gives its children.
+    '''
+
+    def __init__(self, title=None, dest=None, frag=None):
+        self.title = title
+        self.dest = dest
+        self.frag = frag
+        self.children = []
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+
+class ZipContainer(Container):
+    '''
+    Read only container that reads the ePub straight from the zip file instead of
+    unzipping it to a directory. Only the zip's central directory and the
+    META-INF/container.xml are read when it is created. The OPF, NCX and content
+    files are read and parsed the first time they are used.
+    '''
+
+    def __init__(self, path, log):
+        self.path = os.path.abspath(path)
+        self.log = log
+        self.raw_data_map = {}
+        self.etree_data_map = {}
+        self._mime_map = None
+        self.input_encoding = 'utf-8'
+        self.html_preprocessor = HTMLPreProcessor()
+        self._ncx = self._ncx_name = None
+        self._ncx_loaded = False
+
+        self.zip_file = ZipFile(self.path, 'r')
+        # Map of the names in the zip to their entries in the zip's central directory.
+        # Nothing is unzipped, so unlike Container there are no paths on the filesystem.
+        self.name_path_map = {}
+        for zip_info in self.zip_file.infolist():
+            if not zip_info.filename.endswith('/'):
+                self.name_path_map[zip_info.filename] = zip_info
+
+        if 'META-INF/container.xml' not in self.name_path_map:
+            raise InvalidEpub('No META-INF/container.xml in epub')
+        self.container = etree.fromstring(self.get_raw('META-INF/container.xml'))
+        self.opf_name = self.get_opf_full_path()
+        if self.opf_name not in self.name_path_map:
+            raise InvalidEpub('OPF file does not exist at location pointed to'
+                    ' by META-INF/container.xml')
+        self.opf_dir = posixpath.dirname(self.opf_name)
+
+        if self.is_drm_encrypted():
+            raise DRMError()
+
+    @property
+    def mime_map(self):
+        if self._mime_map is None:
+            # The OPF needs to be in the map before it can be parsed to find the rest.
+            self._mime_map = {self.opf_name: guess_type('a.opf')[0]}
+            for item in self.opf.xpath(
+                    '//opf:manifest/opf:item[@href and @media-type]',
+                    namespaces={'opf':OPF_NS}):
+                href = item.get('href')
+                self._mime_map[self.href_to_name(href)] = item.get('media-type')
+        return self._mime_map
+
+    def get_raw(self, name):
+        '''
+        Return the named resource as raw data. The data is not kept, only the parsed
+        etrees are.
+        '''
+        return self.zip_file.read(self.name_path_map[name])
+
+    def filesize(self, name):
+        return self.name_path_map[name].file_size
+
+    def close(self):
+        self.etree_data_map.clear()
+        self.zip_file.close()
+
+
 class WritableContainer(Container):
     '''
     Extensions to Container to do with deleting/modifying the contents
@@ -688,22 +873,6 @@ class ExtendedContainer(WritableContainer):
     that assist with working with sets of content specific to Replace CSS
     '''
 
-    def is_drm_encrypted(self):
-        for name in self.name_path_map.keys():
-            if name.lower().endswith('encryption.xml'):
-                try:
-                    enc_xml = self.get_raw(name)
-                    root = etree.fromstring(enc_xml)
-                    for em in root.xpath('descendant::*[contains(name(), "EncryptionMethod")]'):
-                        algorithm = em.get('Algorithm', '')
-                        if algorithm != 'http://ns.adobe.com/pdf/enc#RC':
-                            return True
-                except ParseError:
-                    # Having a problem reading the encryption xml
-                    self.log.error('Error parsing encryption xml for DRM check')
-                return False
-        return False
-
     def get_xpgt_names(self):
         '''
         Helper function to return list of xpgt name(s) from this epub
@@ -262,35 +262,19 @@ class QueueProgressDialog(QProgressDialog):
         else:
             onDeviceIds = self.plugin_action._get_selected_ids()
 
-        self.books = self.plugin_action._convert_calibre_ids_to_books(library_db, onDeviceIds)
-        self.setRange(0, len(self.books))
-        for book in self.books:
+        reading_values = self.plugin_action._get_current_reading_values(library_db, onDeviceIds,
+                                    (kobo_chapteridbookmarked_column, kobo_percentRead_column, rating_column, last_read_column))
+        self.plugin_action.get_device_paths_from_ids(onDeviceIds)
+        self.setRange(0, len(reading_values))
+        for book_id, (title, authors, current_chapterid, current_percentRead, current_rating, current_last_read) in reading_values.items():
             self.i += 1
-            device_book_paths = self.plugin_action.get_device_paths_from_id(book.calibre_id)
+            device_book_paths = self.plugin_action.get_device_paths_from_id(book_id)
 #            debug_print("QueueProgressDialog::do_all_books -- device_book_paths:", device_book_paths)
-            book.contentIDs = [self.plugin_action.contentid_from_path(path, self.plugin_action.CONTENTTYPE) for path in device_book_paths]
-            if len(book.contentIDs):
-                title               = book.title
+            contentIDs = [self.plugin_action.contentid_from_path(path, self.plugin_action.CONTENTTYPE) for path in device_book_paths]
+            if len(contentIDs):
                 self.setLabelText(_('Queueing ') + title)
-                authors             = authors_to_string(book.authors)
-                current_chapterid   = None
-                current_percentRead = None
-                current_rating      = None
-                current_last_read   = None
-                if kobo_chapteridbookmarked_column:
-                    current_chapterid = book.get_user_metadata(kobo_chapteridbookmarked_column, True)['#value#']
-                if kobo_percentRead_column:
-                    current_percentRead = book.get_user_metadata(kobo_percentRead_column, True)['#value#']
-                if rating_column:
-                    if rating_column == 'rating':
-                        current_rating = book.rating
-                    else:
-                        current_rating = book.get_user_metadata(rating_column, True)['#value#']
-                if last_read_column:
-                    current_last_read = book.get_user_metadata(last_read_column, True)['#value#']
-
-#                debug_print("QueueProgressDialog::do_books - adding:", book.calibre_id, book.contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read)
-                self.books_to_scan.append((book.calibre_id, book.contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read))
+#                debug_print("QueueProgressDialog::do_books - adding:", book_id, contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read)
+                self.books_to_scan.append((book_id, contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read))
             self.setValue(self.i)
 
         debug_print("QueueProgressDialog::do_books - Finish")
@@ -1502,6 +1486,7 @@ class BackupAnnotationsOptionsDialog(SizePersistedDialog):
         self.initialize_controls()
 
         self.dest_directory_edit.setText(self.options.get('dest_directory', ''))
+        self.zip_annotations_checkbox.setCheckState(Qt.Checked if self.options.get('zip_annotations', False) else Qt.Unchecked)
         # Cause our dialog size to be restored from prefs or created on first usage
         self.resize_dialog()
 
@@ -1526,6 +1511,11 @@ class BackupAnnotationsOptionsDialog(SizePersistedDialog):
         options_layout.addWidget(self.dest_directory_edit, 0, 1, 1, 1)
         options_layout.addWidget(dest_pick_button, 0, 2, 1, 1)
 
+        self.zip_annotations_checkbox = QCheckBox(_("Save in a zip file"), self)
+        self.zip_annotations_checkbox.setToolTip(_("Check this to save the annotations files in a single zip file in the destination directory. "
+                                                   "Otherwise, only the annotations files that have changed since the last backup are copied."))
+        options_layout.addWidget(self.zip_annotations_checkbox, 1, 0, 1, 3)
+
         layout.addStretch(1)
 
         # Dialog buttons
@@ -1542,12 +1532,16 @@ class BackupAnnotationsOptionsDialog(SizePersistedDialog):
                                 show=True, show_copy_button=False)
 
         self.options['dest_directory'] = unicode(self.dest_directory_edit.text())
+        self.options['zip_annotations'] = self.zip_annotations_checkbox.checkState() == Qt.Checked
         gprefs.set(self.unique_pref_name+':settings', self.options)
         self.accept()
 
     def dest_path(self):
         return self.dest_directory_edit.text()
 
+    def zip_annotations(self):
+        return self.zip_annotations_checkbox.checkState() == Qt.Checked
+
     def _get_dest_directory_name(self):
         path = choose_dir(self, 'backup annotations destination dialog','Choose destination directory')
         self.dest_directory_edit.setText(path)
@@ -3695,6 +3689,9 @@ class UpdateBooksToCDialog(SizePersistedDialog):
     def remove_from_list(self):
         self.books_table.remove_selected_rows()
 
+    def update_books(self, books):
+        self.books_table.update_books(books)
+
     def send_books_clicked(self):
         books_to_send = self.books_table.books_to_send
         ids_to_sync = [book['calibre_id'] for book in books_to_send]
@@ -3812,7 +3809,20 @@ class ToCBookListTableWidget(QTableWidget):
         if self.columnWidth(col) < minimum:
             self.setColumnWidth(col, minimum)
 
-    def populate_table_row(self, row, book):
+    def update_books(self, books):
+        '''
+        Refresh the rows of books whose ToC status has been found since the table was populated.
+        '''
+        updated_books = set(id(book) for book in books)
+        book_keys = set(book_key for book_key, book in self.books.items() if id(book) in updated_books)
+        self.setSortingEnabled(False)
+        for row in range(self.rowCount()):
+            book_key = convert_qvariant(self.item(row, self.TITLE_COLUMN_NO).data(Qt.UserRole))
+            if book_key in book_keys:
+                self.populate_table_row(row, self.books[book_key], book_key)
+        self.setSortingEnabled(True)
+
+    def populate_table_row(self, row, book, book_key=None):
 #         debug_print("populate_table_row - book:", book)
         book_status = 0
         if book['good']:
@@ -3830,7 +3840,7 @@ class ToCBookListTableWidget(QTableWidget):
         self.setItem(row, 0, status_cell)
         
         title_cell = ReadOnlyTableWidgetItem(book['title'])
-        title_cell.setData(Qt.UserRole, row)
+        title_cell.setData(Qt.UserRole, row if book_key is None else book_key)
         self.setItem(row, self.TITLE_COLUMN_NO, title_cell)
         
         self.setItem(row, self.AUTHOR_COLUMN_NO, AuthorTableWidgetItem(book['author'], book['author_sort']))
@@ -8,7 +8,7 @@ __copyright__ = '2012-2017, David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
 import time, os, shutil, re
-import zipfile
+import zipfile, json
 from datetime import datetime
 import logging
 try:
@@ -16,18 +16,23 @@ try:
 except ImportError:
     from urllib2 import urlopen
 
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 from calibre.utils.ipc.server import Server
 from calibre.utils.ipc.job import ParallelJob
-from calibre.utils.logging import Log
-from calibre.utils.zipfile import ZipFile
-from calibre.ebooks.BeautifulSoup import BeautifulStoneSoup
+from calibre.utils.logging import Log, default_log
+from calibre.ebooks.oeb.polish.container import EpubContainer
+from calibre.ebooks.oeb.polish.errors import DRMError
+from calibre.ebooks.oeb.polish.toc import get_toc
+from calibre_plugins.koboutilities.container import ZipContainer
+from calibre.ptempfile import TemporaryDirectory, PersistentTemporaryDirectory
+from calibre.utils.filenames import atomic_rename
 from calibre.constants import DEBUG
 from calibre import prints
 from calibre_plugins.koboutilities.action import (
                             MIMETYPE_KOBO, BOOKMARK_SEPARATOR,
-                            convert_kobo_date, check_device_database, device_database_connection
+                            convert_kobo_date, check_device_database, device_database_connection,
+                            database_profile, FETCH_BATCH_SIZE
                             )
 import calibre_plugins.koboutilities.config as cfg
 #from calibre_plugins.koboutilities.common_utils import debug_print
@@ -36,6 +41,42 @@ import calibre_plugins.koboutilities.config as cfg
 logger = Log()#logging.getLogger(__name__)
 JOBS_DEBUG = True
 BASE_TIME = None
+# Smallest number of books worth giving their own child job when storing reading locations.
+STORE_LOCATIONS_MIN_SHARD_SIZE = 250
+# The device writes its timestamps with and without fractional seconds and time zone. They are
+# put in this format before being compared with the sync watermark.
+SYNC_WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Books read up to this long before the sync watermark are checked again, in case the device clock was changed.
+SYNC_WATERMARK_MARGIN = '-1 day'
+# Number of ImageIds to delete between saves of the images cleanup plan.
+IMAGES_CLEANUP_BATCH_SIZE = 100
+# Size of the blocks read when looking for an annotation in an annotations file.
+ANNOTATION_SCAN_BLOCK_SIZE = 64 * 1024
+ANNOTATION_START_TAG = re.compile(br'<annotation[\s/>]')
+# Size of the chunks the databases are split into for incremental backups. SQLite page sizes divide this
+# evenly, so a changed page only changes one chunk.
+BACKUP_CHUNK_SIZE = 64 * 1024
+# Number of database pages copied between progress updates when backing up a database.
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_ZIP_BLOCK_SIZE = 1024 * 1024
+BACKUP_ZIP_QUEUED_BLOCKS = 8
+BACKUP_ZIP_COMPRESSION_TYPES = {
+    'stored':  zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'lzma':    zipfile.ZIP_LZMA,
+    }
+# Range of dates that can be stored in a zip file. Files on the device can have dates outside it after a clock reset.
+ZIP_MIN_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_MAX_DATE_TIME = (2107, 12, 31, 23, 59, 58)
+BACKUP_CHUNK_STORE_DIR = 'KoboUtilities-chunks'
+BACKUP_MANIFEST_EXT = '.chunks'
+# Limits for the ToC cache. When the cache is too big, the entries used longest ago are removed first.
+TOC_CACHE_MAX_SIZE = 50 * 1024 * 1024
+TOC_CACHE_MAX_AGE = 90 * 24 * 60 * 60
+# Size of the blocks at the start and end of a book file that are hashed to identify it in the ToC cache.
+TOC_CACHE_HASH_BLOCK_SIZE = 64 * 1024
+# Change when the way the ToC is read changes, so the cached ToCs are read again.
+TOC_CACHE_VERSION = 2
 def debug_print(*args):
     global BASE_TIME
     if BASE_TIME is None:
@@ -45,6 +86,58 @@ def debug_print(*args):
 #     logger.info('loggerINFO: %6.1f'%(time.time()-BASE_TIME), *args)
 #    logger(print('loggerDEBUG: %6.1f'%(time.time()-BASE_TIME), *args))
 
+@contextmanager
+def device_database_snapshot(device_database_path):
+    '''
+    Copy the device database to a local temporary directory and yield the
+    details of the copy. Read-only jobs query the copy so that they do not
+    read pages over the slow device connection or hold locks on the device
+    database. The modification time and size of the device database are
+    recorded so that a stale snapshot can be detected.
+    '''
+    with TemporaryDirectory('_kobo_utilities_db') as snapshot_dir:
+        snapshot_path = os.path.join(snapshot_dir, os.path.basename(device_database_path))
+        debug_print("device_database_snapshot - copying '%s' to '%s'" % (device_database_path, snapshot_path))
+        source_stat = os.stat(device_database_path)
+        backup_database_file(device_database_path, snapshot_path)
+        snapshot = {
+            'snapshot_path': snapshot_path,
+            'source_path':   device_database_path,
+            'source_mtime':  source_stat.st_mtime,
+            'source_size':   source_stat.st_size,
+            }
+        debug_print("device_database_snapshot - snapshot=", snapshot)
+        yield snapshot
+
+
+def backup_database_file(database_path, backup_path, progress=lambda x:x):
+    '''
+    Copy a database using the SQLite online backup API. The pages are copied in batches so
+    that progress can be reported. If the database is changed during the copy, SQLite restarts
+    the copy, so the result is always a consistent copy of the database.
+    '''
+    import apsw
+    debug_print("backup_database_file - copying '%s' to '%s'" % (database_path, backup_path))
+    with closing(apsw.Connection(database_path, flags=apsw.SQLITE_OPEN_READONLY)) as source_connection, \
+            closing(apsw.Connection(backup_path)) as backup_connection:
+        with backup_connection.backup("main", source_connection, "main") as backup:
+            while not backup.done:
+                backup.step(BACKUP_PAGES_PER_STEP)
+                if backup.pagecount:
+                    progress(float(backup.pagecount - backup.remaining) / backup.pagecount)
+
+
+def device_database_snapshot_is_stale(snapshot):
+    '''
+    Check whether the device database has changed since the snapshot was taken.
+    '''
+    try:
+        source_stat = os.stat(snapshot['source_path'])
+    except OSError:
+        return True
+    return source_stat.st_mtime != snapshot['source_mtime'] or source_stat.st_size != snapshot['source_size']
+
+
 def do_koboutilitiesa(books_to_scan, options, cpus, notification=lambda x,y:x):
     '''
     Master job, to launch child jobs to modify each ePub
@@ -53,17 +146,6 @@ def do_koboutilitiesa(books_to_scan, options, cpus, notification=lambda x,y:x):
 
     print("do_koboutilitiesa - options=%s" % (options))
     # Queue all the jobs
-
-    args = ['calibre_plugins.koboutilities.jobs', 'do_store_location_single',
-            (books_to_scan, options)]
-    print("do_koboutilitiesa - args=%s" % (args))
-    job = ParallelJob('arbitrary', str(book_id), done=None, args=args)
-    job._book_id    = book_id
-    job._title      = title
-    job._authors    = authors
-    job._contentIDs = contentIDs
-    server.add_job(job)
-
     for book_id, contentIDs, title, authors in books_to_scan:
         print("do_koboutilitiesa - book_id=%s, title=%s, authors=%s" % (book_id, title, authors))
         args = ['calibre_plugins.koboutilities.jobs', 'do_store_location_single',
@@ -80,7 +162,8 @@ def do_koboutilitiesa(books_to_scan, options, cpus, notification=lambda x,y:x):
     # Set the % complete to a small number to avoid the 'unavailable' indicator
     notification(0.01, 'Storing reading locations')
 
-    # dequeue the job results as they arrive, saving the resultsdevice_statusotal = len(books_to_scan)
+    # dequeue the job results as they arrive, saving the results
+    total = len(books_to_scan)
     count = 0
     stored_locations = dict()
     while True:
@@ -134,6 +217,7 @@ def do_device_database_backup(backup_options, cpus, notification=lambda x,y:x):
     do_daily_backup         = backup_options[cfg.KEY_DO_DAILY_BACKUP]
     backup_each_connection  = backup_options[cfg.KEY_BACKUP_EACH_CONNECTION]
     zip_database            = backup_options[cfg.KEY_BACKUP_ZIP_DATABASE]
+    incremental_backup      = backup_options.get(cfg.KEY_BACKUP_INCREMENTAL, False)
     database_file           = backup_options['database_file']
     device_path             = backup_options["device_path"]
     debug_print('do_device_database_backup - copies_to_keep=', copies_to_keep)
@@ -159,74 +243,98 @@ def do_device_database_backup(backup_options, cpus, notification=lambda x,y:x):
             notification(1, _("Backup already done"))
             return
 
-    notification(0.25, _("Backing up database KoboReader.sqlite"))
-    backup_file_name = backup_file_template.format(device_name, serial_number, backup_timestamp)
-    backup_file_path = os.path.join(dest_dir, backup_file_name + '.sqlite')
-    debug_print('do_device_database_backup - backup_file_name=%s' % backup_file_name)
-    debug_print('do_device_database_backup - backup_file_path=%s' % backup_file_path)
-    debug_print('do_device_database_backup - database_file=%s' % database_file)
-    shutil.copyfile(database_file, backup_file_path)
-
-    try:
-        notification(0.25, _("Backing up database BookReader.sqlite"))
-        bookreader_backup_file_name = bookreader_backup_file_template.format(device_name, serial_number, backup_timestamp)
-        bookreader_backup_file_path = os.path.join(dest_dir, bookreader_backup_file_name + '.sqlite')
-        debug_print('do_device_database_backup - bookreader_backup_file_name=%s' % bookreader_backup_file_name)
-        debug_print('do_device_database_backup - bookreader_backup_file_path=%s' % bookreader_backup_file_path)
-        debug_print('do_device_database_backup - bookreader_database_file=%s' % bookreader_database_file)
-        shutil.copyfile(bookreader_database_file, bookreader_backup_file_path)
-        bookreader_database_file_found = True
-    except Exception as e:
-        debug_print('do_device_database_backup - backup of database BookReader.sqlite failed. Exception: {0}'.format(e))
+    # When the database is going into the zip file or the chunk store, copy it to a temporary
+    # directory so the only file written in the destination is the one that is kept.
+    database_copy_dir = PersistentTemporaryDirectory('_kobo_utilities_backup') if zip_database or incremental_backup else dest_dir
 
-    notification(0.5, _("Performing check on the database"))
     try:
-        check_result = check_device_database(backup_file_path)
-        if not check_result.split()[0] == 'ok':
-            debug_print('do_device_database_backup - database is corrupt!')
-            raise Exception(check_result)
-    except:
-        debug_print('do_device_database_backup - backup is corrupt - renaming file.')
-        filename = os.path.basename(backup_file_path)
-        filename, fileext = os.path.splitext(filename)
-        corrupt_filename = filename + "_CORRUPT" + fileext
-        corrupt_file_path = os.path.join(dest_dir, corrupt_filename)
-        debug_print('do_device_database_backup - backup_file_name=%s' % database_file)
-        debug_print('do_device_database_backup - corrupt_file_path=%s' % corrupt_file_path)
-        os.rename(backup_file_path, corrupt_file_path)
-        raise
-
-    # Create the zip file archive
-    config_backup_path = os.path.join(dest_dir, backup_file_name + '.zip')
-    debug_print('do_device_database_backup - config_backup_path=%s' % config_backup_path)
-    with ZipFile(config_backup_path, 'w') as config_backup_zip:
-        config_file = os.path.join(device_path, '.kobo', 'Kobo', 'Kobo eReader.conf')
-        backup_file(config_backup_zip, config_file)
+        notification(0.05, _("Backing up database KoboReader.sqlite"))
+        backup_file_name = backup_file_template.format(device_name, serial_number, backup_timestamp)
+        backup_file_path = os.path.join(database_copy_dir, backup_file_name + '.sqlite')
+        debug_print('do_device_database_backup - backup_file_name=%s' % backup_file_name)
+        debug_print('do_device_database_backup - backup_file_path=%s' % backup_file_path)
+        debug_print('do_device_database_backup - database_file=%s' % database_file)
+        backup_database_file(database_file, backup_file_path,
+                             lambda done: notification(0.05 + 0.2 * done, _("Backing up database KoboReader.sqlite")))
 
-        version_file = os.path.join(device_path, '.kobo', 'version')
-        backup_file(config_backup_zip, version_file)
+        try:
+            notification(0.25, _("Backing up database BookReader.sqlite"))
+            bookreader_backup_file_name = bookreader_backup_file_template.format(device_name, serial_number, backup_timestamp)
+            bookreader_backup_file_path = os.path.join(database_copy_dir, bookreader_backup_file_name + '.sqlite')
+            debug_print('do_device_database_backup - bookreader_backup_file_name=%s' % bookreader_backup_file_name)
+            debug_print('do_device_database_backup - bookreader_backup_file_path=%s' % bookreader_backup_file_path)
+            debug_print('do_device_database_backup - bookreader_database_file=%s' % bookreader_database_file)
+            backup_database_file(bookreader_database_file, bookreader_backup_file_path,
+                                 lambda done: notification(0.25 + 0.2 * done, _("Backing up database BookReader.sqlite")))
+            bookreader_database_file_found = True
+        except Exception as e:
+            debug_print('do_device_database_backup - backup of database BookReader.sqlite failed. Exception: {0}'.format(e))
 
-        affiliate_file = os.path.join(device_path, '.kobo', 'affiliate.conf')
-        backup_file(config_backup_zip, affiliate_file)
+        notification(0.5, _("Performing check on the database"))
+        try:
+            check_result = check_device_database(backup_file_path, quick_check=backup_options.get(cfg.KEY_BACKUP_QUICK_CHECK, False))
+            if not check_result.split()[0] == 'ok':
+                debug_print('do_device_database_backup - database is corrupt!')
+                raise Exception(check_result)
+        except:
+            debug_print('do_device_database_backup - backup is corrupt - renaming file.')
+            filename = os.path.basename(backup_file_path)
+            filename, fileext = os.path.splitext(filename)
+            corrupt_filename = filename + "_CORRUPT" + fileext
+            corrupt_file_path = os.path.join(dest_dir, corrupt_filename)
+            debug_print('do_device_database_backup - backup_file_name=%s' % database_file)
+            debug_print('do_device_database_backup - corrupt_file_path=%s' % corrupt_file_path)
+            shutil.move(backup_file_path, corrupt_file_path)
+            raise
+
+        # Create the zip file archive
+        config_backup_path = os.path.join(dest_dir, backup_file_name + '.zip')
+        debug_print('do_device_database_backup - config_backup_path=%s' % config_backup_path)
+        files_to_zip = []
+        files_to_zip.append((os.path.join(device_path, '.kobo', 'Kobo', 'Kobo eReader.conf'), 'Kobo eReader.conf'))
+        files_to_zip.append((os.path.join(device_path, '.kobo', 'version'), 'version'))
+        files_to_zip.append((os.path.join(device_path, '.kobo', 'affiliate.conf'), 'affiliate.conf'))
 
         ade_file = os.path.join(device_path, '.adobe-digital-editions')
-        backup_file(config_backup_zip, ade_file)
-
         for root, _dirs, files in os.walk(ade_file):
             for fn in files:
                 absfn = os.path.join(root, fn)
                 zfn = os.path.relpath(absfn, device_path).replace(os.sep, '/')
-                backup_file(config_backup_zip, absfn, basename=zfn)
+                files_to_zip.append((absfn, zfn))
 
-        if zip_database:
+        if incremental_backup:
+            notification(0.6, _("Storing changed database chunks"))
+            backup_manifest = {'chunk_size': BACKUP_CHUNK_SIZE, 'files': {}}
+            backup_manifest['files']['KoboReader.sqlite'] = _store_file_chunks(backup_file_path, os.path.join(dest_dir, BACKUP_CHUNK_STORE_DIR))
+            if bookreader_database_file_found:
+                backup_manifest['files']['BookReader.sqlite'] = _store_file_chunks(bookreader_backup_file_path, os.path.join(dest_dir, BACKUP_CHUNK_STORE_DIR))
+            backup_manifest_path = os.path.join(dest_dir, backup_file_name + BACKUP_MANIFEST_EXT)
+            debug_print('do_device_database_backup - writing backup manifest=%s' % backup_manifest_path)
+            with open(backup_manifest_path, 'w') as backup_manifest_file:
+                json.dump(backup_manifest, backup_manifest_file, indent=2)
+        elif zip_database:
             debug_print('do_device_database_backup - adding database KoboReader to zip file=%s' % backup_file_path)
-            backup_file(config_backup_zip, backup_file_path, basename="KoboReader.sqlite")
-            os.unlink(backup_file_path)
-
+            files_to_zip.append((backup_file_path, "KoboReader.sqlite"))
             if bookreader_database_file_found:
                 debug_print('do_device_database_backup - adding database BookReader to zip file=%s' % bookreader_backup_file_path)
-                backup_file(config_backup_zip, bookreader_backup_file_path, basename="BookReader.sqlite")
-                os.unlink(bookreader_backup_file_path)
+                files_to_zip.append((bookreader_backup_file_path, "BookReader.sqlite"))
+
+        notification(0.65, _("Compressing backup"))
+        compression = BACKUP_ZIP_COMPRESSION_TYPES.get(backup_options.get(cfg.KEY_BACKUP_ZIP_COMPRESSION), zipfile.ZIP_DEFLATED)
+        compression_level = backup_options.get(cfg.KEY_BACKUP_ZIP_COMPRESSION_LEVEL, None)
+        try:
+            with zipfile.ZipFile(config_backup_path, 'w', compression, compresslevel=compression_level) as config_backup_zip:
+                backup_file(config_backup_zip, ade_file)
+                _write_files_to_zip(config_backup_zip, files_to_zip)
+        except Exception:
+            debug_print('do_device_database_backup - removing incomplete backup file=%s' % config_backup_path)
+            if os.path.exists(config_backup_path):
+                os.unlink(config_backup_path)
+            raise
+    finally:
+        # Never leave a copy of the database behind, whether the backup worked or not.
+        if database_copy_dir != dest_dir:
+            shutil.rmtree(database_copy_dir, ignore_errors=True)
 
     if copies_to_keep > 0:
         notification(0.75, _("Removing old backups"))
@@ -268,6 +376,13 @@ def do_device_database_backup(backup_options, cpus, notification=lambda x,y:x):
                 if os.path.exists(sqlite_filename):
                     debug_print('do_device_database_backup - removing sqlite backup file:', sqlite_filename)
                     os.unlink(sqlite_filename)
+                manifest_filename = os.path.splitext(filename)[0] + BACKUP_MANIFEST_EXT
+                if os.path.exists(manifest_filename):
+                    debug_print('do_device_database_backup - removing backup manifest file:', manifest_filename)
+                    os.unlink(manifest_filename)
+
+        if os.path.isdir(os.path.join(dest_dir, BACKUP_CHUNK_STORE_DIR)):
+            _remove_unused_chunks(dest_dir)
 
         debug_print('do_device_database_backup - Removing old backups - finished')
     else:
@@ -277,57 +392,359 @@ def do_device_database_backup(backup_options, cpus, notification=lambda x,y:x):
     return
 
 
+def _write_files_to_zip(backup_zip, files_to_zip):
+    '''
+    Stream the files into the zip file. The files are read in a separate thread so that
+    reading from the device overlaps with compressing the previous blocks. Files that
+    cannot be opened or added are logged and skipped. A read error part way through a
+    file fails the backup, as the zip file would otherwise have a truncated copy of it.
+    '''
+    from threading import Thread, Event
+    from six.moves.queue import Queue, Empty
+
+    blocks = Queue(maxsize=BACKUP_ZIP_QUEUED_BLOCKS)
+    stop_reading = Event()
+
+    def read_files():
+        for file_path, zip_name in files_to_zip:
+            if stop_reading.is_set():
+                break
+            try:
+                source_file = open(file_path, 'rb')
+            except Exception as e:
+                blocks.put(('error', file_path, e))
+                continue
+            with source_file:
+                blocks.put(('start', file_path, zip_name))
+                try:
+                    while not stop_reading.is_set():
+                        block = source_file.read(BACKUP_ZIP_BLOCK_SIZE)
+                        if not block:
+                            break
+                        blocks.put(('block', block))
+                except Exception as e:
+                    blocks.put(('read_error', file_path, e))
+                    break
+                blocks.put(('end',))
+        blocks.put(None)
+
+    def close_zip_entry(zip_entry, file_path):
+        try:
+            zip_entry.close()
+        except Exception as e:
+            debug_print("do_device_database_backup:_write_files_to_zip - file '%s' not added. Exception was: %s" % (file_path, e))
+
+    reader = Thread(target=read_files, name='KoboUtilitiesBackupReader')
+    reader.daemon = True
+    reader.start()
+
+    zip_entry = None
+    file_path = None
+    try:
+        while True:
+            item = blocks.get()
+            if item is None:
+                break
+            if item[0] == 'start':
+                file_path, zip_name = item[1], item[2]
+                debug_print('do_device_database_backup:_write_files_to_zip - file_to_add=%s' % file_path)
+                try:
+                    # Opened by name so the entry uses the compression and level of the zip file.
+                    zip_entry = backup_zip.open(zip_name, 'w', force_zip64=True)
+                except Exception as e:
+                    debug_print("do_device_database_backup:_write_files_to_zip - file '%s' not added. Exception was: %s" % (file_path, e))
+            elif item[0] == 'block':
+                if zip_entry is not None:
+                    try:
+                        zip_entry.write(item[1])
+                    except Exception as e:
+                        debug_print("do_device_database_backup:_write_files_to_zip - file '%s' not added. Exception was: %s" % (file_path, e))
+                        close_zip_entry(zip_entry, file_path)
+                        zip_entry = None
+            elif item[0] == 'end':
+                if zip_entry is not None:
+                    close_zip_entry(zip_entry, file_path)
+                    zip_entry = None
+            elif item[0] == 'read_error':
+                raise IOError("Error reading '%s' for the backup: %s" % (item[1], item[2]))
+            else:
+                debug_print("do_device_database_backup:_write_files_to_zip - file '%s' not added. Exception was: %s" % (item[1], item[2]))
+    finally:
+        if zip_entry is not None:
+            # The zip file cannot be closed while an entry is still open.
+            close_zip_entry(zip_entry, file_path)
+        # Stop the reader and empty the queue in case it is waiting to add a block.
+        stop_reading.set()
+        while reader.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except Empty:
+                pass
+        reader.join()
+
+def _store_file_chunks(file_path, chunk_store_path):
+    '''
+    Split the file into chunks and add any chunks not already in the chunk store. Returns
+    the manifest entry for the file.
+    '''
+    import hashlib
+    file_hash = hashlib.sha1()
+    chunks = []
+    new_chunks = 0
+    with open(file_path, 'rb') as source_file:
+        while True:
+            chunk = source_file.read(BACKUP_CHUNK_SIZE)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+            chunk_hash = hashlib.sha1(chunk).hexdigest()
+            chunks.append(chunk_hash)
+            chunk_path = _get_chunk_path(chunk_store_path, chunk_hash)
+            if not os.path.exists(chunk_path):
+                chunk_dir = os.path.dirname(chunk_path)
+                if not os.path.isdir(chunk_dir):
+                    os.makedirs(chunk_dir)
+                # Write under a temporary name so an interrupted backup never leaves a partial chunk.
+                with open(chunk_path + '.tmp', 'wb') as chunk_file:
+                    chunk_file.write(chunk)
+                os.rename(chunk_path + '.tmp', chunk_path)
+                new_chunks += 1
+
+    debug_print("_store_file_chunks - file_path='%s', chunks=%d, new chunks=%d" % (file_path, len(chunks), new_chunks))
+    return {'size': os.path.getsize(file_path), 'sha1': file_hash.hexdigest(), 'chunks': chunks}
+
+def _get_chunk_path(chunk_store_path, chunk_hash):
+    return os.path.join(chunk_store_path, chunk_hash[:2], chunk_hash)
+
+def _remove_unused_chunks(dest_dir):
+    '''
+    Delete the chunks that are not used by any of the remaining backup manifests.
+    '''
+    import glob
+    chunk_store_path = os.path.join(dest_dir, BACKUP_CHUNK_STORE_DIR)
+    used_chunks = set()
+    for manifest_path in glob.glob(os.path.join(dest_dir, '*' + BACKUP_MANIFEST_EXT)):
+        with open(manifest_path) as manifest_file:
+            backup_manifest = json.load(manifest_file)
+        for file_entry in backup_manifest['files'].values():
+            used_chunks.update(file_entry['chunks'])
+
+    removed_chunks = 0
+    for path, _dirs, files in os.walk(chunk_store_path):
+        for filename in files:
+            if filename not in used_chunks:
+                os.unlink(os.path.join(path, filename))
+                removed_chunks += 1
+    debug_print("_remove_unused_chunks - used chunks=%d, removed chunks=%d" % (len(used_chunks), removed_chunks))
+
+def restore_device_database_backup(manifest_path, dest_dir):
+    '''
+    Rebuild the database files in an incremental backup from the chunk store. Returns the paths
+    of the rebuilt files.
+    '''
+    import hashlib
+    chunk_store_path = os.path.join(os.path.dirname(manifest_path), BACKUP_CHUNK_STORE_DIR)
+    with open(manifest_path) as manifest_file:
+        backup_manifest = json.load(manifest_file)
+
+    restored_files = []
+    for filename, file_entry in backup_manifest['files'].items():
+        restored_file_path = os.path.join(dest_dir, filename)
+        debug_print("restore_device_database_backup - rebuilding '%s' from %d chunks" % (restored_file_path, len(file_entry['chunks'])))
+        file_hash = hashlib.sha1()
+        with open(restored_file_path, 'wb') as restored_file:
+            for chunk_hash in file_entry['chunks']:
+                with open(_get_chunk_path(chunk_store_path, chunk_hash), 'rb') as chunk_file:
+                    chunk = chunk_file.read()
+                file_hash.update(chunk)
+                restored_file.write(chunk)
+        if file_hash.hexdigest() != file_entry['sha1']:
+            raise Exception(_("The rebuilt file {0} does not match the backup.").format(restored_file_path))
+        restored_files.append(restored_file_path)
+
+    return restored_files
+
+
+class JobNotification(object):
+    '''
+    Notification function for jobs run in the device thread. The job is only
+    known after it has been created, so it is set once the job is queued.
+    '''
+
+    def __init__(self):
+        self.job = None
+
+    def __call__(self, percent, msg):
+        if self.job is not None:
+            self.job.notifications.put((percent, msg))
+
+
+def do_upload_covers(device, covers_to_upload, upload_options, notification=lambda x,y:x):
+    '''
+    Device job to upload covers. The covers are uploaded one at a time as the
+    device driver is not safe to call from more than one thread. The driver's
+    _upload_cover renders and writes each cover in a single call, so rendering
+    cannot be moved to a pool without copying the driver's resizing code, which
+    differs between calibre versions. If there is a cover manifest, covers whose
+    library cover and upload options are unchanged since the last upload are skipped.
+    '''
+    debug_print("do_upload_covers - start - number of covers=%d" % len(covers_to_upload))
+    upload_grayscale = upload_options['upload_grayscale']
+    cover_options    = upload_options['cover_options']
+    cover_manifest   = upload_options['cover_manifest']
+
+    notification(0.01, _('Checking covers'))
+    unchanged_covers = 0
+    if cover_manifest is not None:
+        options_signature = repr((upload_grayscale, sorted(cover_options.items())))
+        imageIds = _get_imageIds_for_contentIDs(upload_options['device_database_path'],
+                                                [contentID for _book, _path, contentID in covers_to_upload])
+        changed_covers = []
+        for book, path, contentID in covers_to_upload:
+            imageId = imageIds.get(contentID)
+            cover_hash = _cover_hash(book, options_signature)
+            if imageId is not None and cover_hash is not None \
+                    and cover_manifest.get(imageId) == cover_hash \
+                    and _cover_files_exist(device, path, imageId):
+                unchanged_covers += 1
+                continue
+            changed_covers.append((book, path, contentID, imageId, cover_hash))
+    else:
+        changed_covers = [(book, path, contentID, None, None) for book, path, contentID in covers_to_upload]
+    debug_print("do_upload_covers - unchanged_covers=%d, covers to upload=%d" % (unchanged_covers, len(changed_covers)))
+
+    total = len(changed_covers)
+    uploaded_covers = 0
+    if total == 0:
+        notification(1.0, _('No covers to upload'))
+        return upload_options['total_books'], uploaded_covers, unchanged_covers, upload_options['not_on_device_books'], upload_options
+
+    notification(0.02, _('Uploading covers'))
+    for book, path, contentID, imageId, cover_hash in changed_covers:
+        device._upload_cover(path, '', book, path, upload_grayscale, **cover_options)
+        if cover_manifest is not None and imageId is not None and cover_hash is not None:
+            cover_manifest[imageId] = cover_hash
+        uploaded_covers += 1
+        notification(float(uploaded_covers)/total, _('Uploading covers'))
+
+    debug_print("do_upload_covers - finished - uploaded_covers=%d" % uploaded_covers)
+    return upload_options['total_books'], uploaded_covers, unchanged_covers, upload_options['not_on_device_books'], upload_options
+
+
+def _get_imageIds_for_contentIDs(device_database_path, contentIDs):
+    imageIds = {}
+    imageId_query = ('SELECT ContentID, ImageId '
+                     'FROM content '
+                     'WHERE BookID IS NULL '
+                     'AND ContentID IN ({0})'
+                     )
+    with closing(device_database_connection(device_database_path, use_row_factory=True, readonly=True)) as connection:
+        cursor = connection.cursor()
+        for i in range(0, len(contentIDs), FETCH_BATCH_SIZE):
+            batch = contentIDs[i:i + FETCH_BATCH_SIZE]
+            cursor.execute(imageId_query.format(','.join('?' * len(batch))), batch)
+            for row in cursor:
+                imageIds[row['ContentID']] = row['ImageId']
+        cursor.close()
+    return imageIds
+
+
+def _cover_hash(book, options_signature):
+    '''
+    Hash of the library cover and the options used to upload it.
+    '''
+    import hashlib
+    if not book.cover or not os.path.exists(book.cover):
+        return None
+    cover_hash = hashlib.sha1(options_signature.encode('utf-8'))
+    with open(book.cover, 'rb') as cover_file:
+        cover_hash.update(cover_file.read())
+    return cover_hash.hexdigest()
+
+
+def _cover_files_exist(device, path, imageId):
+    image_path = device.images_path(path, imageId)
+    for ending in device.cover_file_endings().keys():
+        if os.path.exists(device.normalize_path(image_path + ending)):
+            return True
+    return False
+
+
 def do_store_locations(books_to_scan, options, cpus, notification=lambda x,y:x):
     '''
-    Master job to do store the current reading positions
+    Master job to do store the current reading positions. The books are split
+    into shards and each shard is checked by a child job.
     '''
     debug_print("do_store_locations - start")
     server = Server(pool_size=cpus)
 
     debug_print("do_store_locations - options=%s" % (options))
-    # Queue all the jobs
-
-    args = ['calibre_plugins.koboutilities.jobs', 'do_store_locations_all',
-            (books_to_scan, options)]
-#    debug_print("do_store_locations - args=%s" % (args))
-    debug_print("do_store_locations - len(books_to_scan)=%d" % (len(books_to_scan)))
-    job = ParallelJob('arbitrary', "Store locations", done=None, args=args)
-    server.add_job(job)
 
     # This server is an arbitrary_n job, so there is a notifier available.
     # Set the % complete to a small number to avoid the 'unavailable' indicator
     notification(0.01, 'Reading device database')
 
-    # dequeue the job results as they arrive, saving the results
-    total = 1
-    count = 0
     stored_locations = dict()
-    while True:
-        job = server.changed_jobs_queue.get()
-        # A job can 'change' when it is not finished, for example if it
-        # produces a notification. Ignore these.
-        job.update()
-        if not job.is_finished:
-            debug_print("do_store_locations - Job not finished")
-            continue
-#        debug_print("do_store_locations - Job finished")
-        # A job really finished. Get the information.
-        stored_locations = job.result
-#        book_id = job._book_id
-#        stored_locations[book_id] = stored_location
-        count += 1
-        notification(float(count)/total, 'Storing locations')
-        # Add this job's output to the current log
-        #debug_print("Stored_location=", stored_locations)
-        number_bookmarks = len(stored_locations) if stored_locations else 0
-        debug_print("Stored_location count=%d" % number_bookmarks)
-        debug_print(job.details)
-        if count >= total:
-            # All done!
-            break
+    with device_database_snapshot(options["device_database_path"]) as snapshot:
+        shard_options = dict(options)
+        shard_options["device_database_path"] = snapshot['snapshot_path']
+
+        with closing(device_database_connection(snapshot['snapshot_path'], use_row_factory=True, readonly=True)) as connection:
+            cursor = connection.cursor()
+            sync_watermark = options.get('sync_watermark', None)
+            options['new_sync_watermark'] = _get_sync_watermark(cursor)
+            debug_print("do_store_locations - sync_watermark=%s, new_sync_watermark=%s" % (sync_watermark, options['new_sync_watermark']))
+            if sync_watermark and _sync_watermark_in_future(cursor, sync_watermark):
+                debug_print("do_store_locations - sync watermark is later than the current time, checking all books")
+                sync_watermark = None
+            if sync_watermark and options['new_sync_watermark']:
+                changed_contentIDs = _get_contentIDs_changed_since(cursor, sync_watermark)
+                books_to_scan = [book for book in books_to_scan if any(contentID in changed_contentIDs for contentID in book[1])]
+                debug_print("do_store_locations - number of books changed since last store=%d" % len(books_to_scan))
+            cursor.close()
+
+        # Queue a job for each shard
+        debug_print("do_store_locations - len(books_to_scan)=%d" % (len(books_to_scan)))
+        number_shards = min(cpus, -(-len(books_to_scan) // STORE_LOCATIONS_MIN_SHARD_SIZE))
+        for shard_number in range(number_shards):
+            shard = books_to_scan[shard_number::number_shards]
+            args = ['calibre_plugins.koboutilities.jobs', 'do_store_locations_all',
+                    (shard, shard_options)]
+            debug_print("do_store_locations - shard %d - len(shard)=%d" % (shard_number, len(shard)))
+            job = ParallelJob('arbitrary', "Store locations %d" % shard_number, done=None, args=args)
+            job._shard_number = shard_number
+            server.add_job(job)
+
+        # dequeue the job results as they arrive, merging the results
+        total = number_shards
+        count = 0
+        while count < total:
+            job = server.changed_jobs_queue.get()
+            # A job can 'change' when it is not finished, for example if it
+            # produces a notification. Ignore these.
+            job.update()
+            if not job.is_finished:
+                debug_print("do_store_locations - Job not finished")
+                continue
+            # A job really finished. Get the information.
+            if job.failed:
+                server.close()
+                raise Exception(_("Storing reading positions failed:") + "\n" + job.details)
+            shard_stored_locations = job.result
+            if shard_stored_locations:
+                stored_locations.update(shard_stored_locations)
+            count += 1
+            notification(float(count)/total, 'Storing locations')
+            # Add this job's output to the current log
+            number_bookmarks = len(shard_stored_locations) if shard_stored_locations else 0
+            debug_print("do_store_locations - shard %d - Stored_location count=%d" % (job._shard_number, number_bookmarks))
+            debug_print(job.details)
+
+        if device_database_snapshot_is_stale(snapshot):
+            debug_print("do_store_locations - device database changed while reading positions were being stored")
 
     server.close()
-    debug_print("do_store_locations - finished")
+    debug_print("do_store_locations - finished - Stored_location count=%d" % len(stored_locations))
     # return the map as the job result
     return stored_locations, options
 
@@ -386,19 +803,25 @@ def _store_bookmarks(log, books, options):
     store_if_more_recent     = options[cfg.KEY_STORE_IF_MORE_RECENT]
     do_not_store_if_reopened = options[cfg.KEY_DO_NOT_STORE_IF_REOPENED]
     epub_location_like_kepub = options['epub_location_like_kepub']
-    kepub_fetch_query = options['fetch_queries']['kepub']
-    epub_fetch_query  = options['fetch_queries']['epub']
+    kepub_fetch_query = options['fetch_queries']['kepub_batch']
+    epub_fetch_query  = options['fetch_queries']['epub_batch']
 
     kobo_chapteridbookmarked_column_name = options[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN]
     kobo_percentRead_column_name         = options[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN]
     rating_column_name                   = options[cfg.KEY_RATING_CUSTOM_COLUMN]
     last_read_column_name                = options[cfg.KEY_LAST_READ_CUSTOM_COLUMN]
 
-    with closing(device_database_connection(options["device_database_path"], use_row_factory=True)) as connection:
+    with closing(device_database_connection(options["device_database_path"], use_row_factory=True, readonly=True)) as connection, \
+            database_profile(connection, '_store_bookmarks'):
 
         cursor = connection.cursor()
         count_books += 1
 
+        debug_print("_store_bookmarks - fetching reading status for all books")
+        all_contentIDs = [contentID for book in books for contentID in book[1]]
+        device_statuses = _fetch_reading_statuses(cursor, all_contentIDs, kepub_fetch_query, epub_fetch_query)
+        debug_print("_store_bookmarks - number of rows fetched=%d" % len(device_statuses))
+
         debug_print("_store_bookmarks - about to start book loop")
         for book_id, contentIDs, title, authors, current_chapterid, current_percentRead, current_rating, current_last_read in books:
             device_status = None
@@ -409,14 +832,10 @@ def _store_bookmarks(log, books, options):
             for contentID in contentIDs:
 #                log("_store_bookmarks - contentId='%s'" % (contentID))
                 debug_print("_store_bookmarks - contentId='%s'" % (contentID))
-                fetch_values = (contentID,)
-                if contentID.endswith(".kepub.epub"):
-                    fetch_query = kepub_fetch_query
-                else:
-                    fetch_query = epub_fetch_query
-                cursor.execute(fetch_query, fetch_values)
+                result = device_statuses.get(contentID)
+                if result is None:
+                    continue
                 try:
-                    result = next(cursor)
                     debug_print("_store_bookmarks - device_status='%s'" %(device_status))
                     debug_print("_store_bookmarks - result='%s'" %(result))
                     if device_status is None:
@@ -437,8 +856,6 @@ def _store_bookmarks(log, books, options):
                     debug_print("_store_bookmarks - device_status='%s'" %(device_status))
                     debug_print("_store_bookmarks - database result='%s'" %(result))
                     raise
-                except StopIteration:
-                    pass
 
             if not device_status:
                 continue
@@ -558,6 +975,94 @@ def _store_bookmarks(log, books, options):
     return stored_locations
 
 
+def _get_sync_watermark(cursor):
+    '''
+    Get the most recent DateLastRead and ___SyncTime for the books on the device.
+    Older firmware does not have the ___SyncTime column. There is no watermark
+    for these devices and all the books are always scanned.
+    '''
+    cursor.execute('PRAGMA table_info(content)')
+    content_columns = set(row['name'] for row in cursor)
+    if cfg.KEY_WATERMARK_SYNC_TIME not in content_columns:
+        return None
+
+    cursor.execute('SELECT MAX(strftime(:format, DateLastRead)) AS DateLastRead, '
+                   'MAX(strftime(:format, ___SyncTime)) AS SyncTime '
+                   'FROM content '
+                   'WHERE ContentType = 6', {'format': SYNC_WATERMARK_FORMAT})
+    row = next(cursor)
+    return {
+            cfg.KEY_WATERMARK_DATE_LAST_READ: row['DateLastRead'],
+            cfg.KEY_WATERMARK_SYNC_TIME:      row['SyncTime'],
+            }
+
+
+def _sync_watermark_bindings(sync_watermark):
+    return {
+            'format':       SYNC_WATERMARK_FORMAT,
+            'margin':       SYNC_WATERMARK_MARGIN,
+            'DateLastRead': sync_watermark.get(cfg.KEY_WATERMARK_DATE_LAST_READ),
+            'SyncTime':     sync_watermark.get(cfg.KEY_WATERMARK_SYNC_TIME),
+            }
+
+
+def _sync_watermark_in_future(cursor, sync_watermark):
+    '''
+    Check if the watermark is later than the current time. The device clock must have been wrong
+    when it was taken, and it cannot be used to find the books that have changed.
+    '''
+    cursor.execute("SELECT strftime(:format, :DateLastRead) > strftime(:format, 'now') "
+                   "OR strftime(:format, :SyncTime) > strftime(:format, 'now') AS InFuture",
+                   _sync_watermark_bindings(sync_watermark))
+    return bool(next(cursor)['InFuture'])
+
+
+def _get_contentIDs_changed_since(cursor, sync_watermark):
+    '''
+    Get the ContentIDs of the books read or synced after the watermark, less a margin. Books
+    with dates that cannot be read are always included.
+    '''
+    changed_condition = ("(strftime(:format, {0}) > COALESCE(strftime(:format, :{1}, :margin), '') "
+                         "OR ({0} IS NOT NULL AND strftime(:format, {0}) IS NULL))"
+                         )
+    changed_query = ('SELECT ContentID '
+                     'FROM content '
+                     'WHERE ContentType = 6 '
+                     'AND (' + changed_condition.format('DateLastRead', 'DateLastRead') + ' '
+                     'OR ' + changed_condition.format('___SyncTime', 'SyncTime') + ')'
+                     )
+    cursor.execute(changed_query, _sync_watermark_bindings(sync_watermark))
+    return set(row['ContentID'] for row in cursor)
+
+
+def _fetch_reading_statuses(cursor, contentIDs, kepub_fetch_query, epub_fetch_query):
+    '''
+    Run the batch reading status fetch queries for all the contentIDs, a batch
+    of contentIDs at a time rather than once per contentID. Returns a dictionary
+    of the first row found for each contentID.
+    '''
+    kepub_contentIDs = []
+    epub_contentIDs  = []
+    for contentID in contentIDs:
+        if contentID.endswith(".kepub.epub"):
+            kepub_contentIDs.append(contentID)
+        else:
+            epub_contentIDs.append(contentID)
+
+    device_statuses = {}
+    for fetch_query, query_contentIDs in ((kepub_fetch_query, kepub_contentIDs), (epub_fetch_query, epub_contentIDs)):
+        requested_contentIDs = set(query_contentIDs)
+        query_contentIDs = sorted(requested_contentIDs)
+        for i in range(0, len(query_contentIDs), FETCH_BATCH_SIZE):
+            batch = query_contentIDs[i:i + FETCH_BATCH_SIZE]
+            cursor.execute(fetch_query.format(','.join('?' * len(batch))), batch)
+            for row in cursor:
+                if row['ContentID'] in requested_contentIDs:
+                    device_statuses.setdefault(row['ContentID'], row)
+
+    return device_statuses
+
+
 def value_changed(old_value, new_value):
     return old_value is not None and new_value is None \
             or old_value is None and new_value is not None \
@@ -565,70 +1070,163 @@ def value_changed(old_value, new_value):
 
 
 def do_clean_images_dir(options, cpus, notification=lambda x,y:x):
+    from concurrent.futures import ThreadPoolExecutor
     main_image_path      = options['main_image_path']
     sd_image_path        = options['sd_image_path']
     device_database_path = options["device_database_path"]
-
-    notification(1/7, 'Getting ImageIDs from main images directory')
-    debug_print("Getting ImageIDs from main images directory - Path is: '%s'" % (main_image_path))
-    imageids_files_main = _get_file_imageIds(main_image_path)
-#    debug_print("Getting ImageIDs from main images directory - imageids_files_main", imageids_files_main)
-
-    notification(2/7, 'Getting ImageIDs from SD card images directory')
-    debug_print("Getting ImageIDs from SD images directory - Path is: '%s'" % (sd_image_path))
-    imageids_files_sd   = _get_file_imageIds(sd_image_path)
-
-    notification(3/7, 'Getting ImageIDs from device database.')
-    debug_print("Getting ImageIDs from device database.")
-    imageids_db = _get_imageId_set(device_database_path)
+    device_uuid          = options['device_uuid']
+    image_paths = {'main_memory': main_image_path, 'sd_card': sd_image_path}
+
+    plan = cfg.get_images_cleanup_plan(device_uuid) if options.get('resume_cleanup', False) else None
+    if plan is not None:
+        notification(1/5, 'Checking saved cleanup plan against device database.')
+        debug_print("Resuming images cleanup plan - main memory images=%d, SD card images=%d" % (len(plan['main_memory']), len(plan['sd_card'])))
+        # Books may have been added to the device since the plan was made. Don't delete any images that are now in use.
+        imageids_db = _get_imageId_set(device_database_path)
+        for image_store in ('main_memory', 'sd_card'):
+            plan[image_store] = dict((imageId, files) for imageId, files in plan[image_store].items() if imageId not in imageids_db)
+    else:
+        notification(1/5, 'Getting ImageIDs from images directories')
+        debug_print("Getting ImageIDs from main images directory - Path is: '%s'" % (main_image_path))
+        debug_print("Getting ImageIDs from SD images directory - Path is: '%s'" % (sd_image_path))
+        # Scan the main memory and SD card at the same time as they are separate devices.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            imageids_files_main_future = executor.submit(_get_image_file_index, main_image_path)
+            imageids_files_sd_future   = executor.submit(_get_image_file_index, sd_image_path)
+            imageids_files_main = imageids_files_main_future.result()
+            imageids_files_sd   = imageids_files_sd_future.result()
+
+        notification(2/5, 'Getting ImageIDs from device database.')
+        debug_print("Getting ImageIDs from device database.")
+        imageids_db = _get_imageId_set(device_database_path)
 #        debug_print("clean_images_dir - len(imageids_db)=%d imageids_db=%s" % (len(imageids_db), imageids_db))
 
-    notification(4/7, 'Checking/removing images from main images directory')
-    extra_imageids_files_main = set(imageids_files_main.keys()) - imageids_db
-    debug_print("Checking/removing images from main images directory - Number of extra images: %d" % (len(extra_imageids_files_main)))
-#    debug_print("Checking/removing images from main images directory - extra_imageids_files_main:", extra_imageids_files_main)
-    extra_image_files_main = _remove_extra_files(extra_imageids_files_main, imageids_files_main, options['delete_extra_covers'], main_image_path, images_tree=options['images_tree'])
-
-    notification(5/7, 'Checking/removing images from SD card images directory')
-    extra_imageids_files_sd   = set(imageids_files_sd.keys())   - imageids_db
-    debug_print("Checking/removing images from SD card images directory - Number of extra images: %d" % (len(extra_imageids_files_sd)))
-#    debug_print("Checking/removing images from SD card images directory - extra_imageids_files_sd:", extra_imageids_files_sd)
-    extra_image_files_sd   = _remove_extra_files(extra_imageids_files_sd, imageids_files_sd, options['delete_extra_covers'], sd_image_path, images_tree=options['images_tree'])
+        notification(3/5, 'Building cleanup plan')
+        extra_imageids_files_main = set(imageids_files_main.keys()) - imageids_db
+        debug_print("Checking images from main images directory - Number of extra images: %d" % (len(extra_imageids_files_main)))
+        extra_imageids_files_sd   = set(imageids_files_sd.keys())   - imageids_db
+        debug_print("Checking images from SD card images directory - Number of extra images: %d" % (len(extra_imageids_files_sd)))
+
+        plan = {}
+        plan['created']     = time.strftime('%Y-%m-%d %H:%M:%S')
+        plan['main_memory'] = _get_images_cleanup_plan_entries(extra_imageids_files_main, imageids_files_main, main_image_path)
+        plan['sd_card']     = _get_images_cleanup_plan_entries(extra_imageids_files_sd, imageids_files_sd, sd_image_path)
+        plan['total_bytes'] = sum(size for image_store in ('main_memory', 'sd_card')
+                                    for files in plan[image_store].values()
+                                    for _relative_path, size in files)
+        plan['deleted_bytes'] = 0
+        # The plan is only kept for resuming deletes. Just listing the extra images does not save it.
+        if options['delete_extra_covers']:
+            cfg.set_images_cleanup_plan(device_uuid, plan if plan['main_memory'] or plan['sd_card'] else None)
 
     extra_image_files                = {}
-    extra_image_files['main_memory'] = extra_image_files_main
-    extra_image_files['sd_card']     = extra_image_files_sd
+    extra_image_files['main_memory'] = [os.path.basename(relative_path) for files in plan['main_memory'].values() for relative_path, _size in files]
+    extra_image_files['sd_card']     = [os.path.basename(relative_path) for files in plan['sd_card'].values() for relative_path, _size in files]
+    extra_image_files['total_bytes'] = plan['total_bytes']
+
+    if options['delete_extra_covers']:
+        notification(4/5, 'Removing images using cleanup plan')
+        extra_image_files['deleted_bytes'] = _execute_images_cleanup_plan(plan, image_paths, device_uuid, options['images_tree'], notification)
 
-    notification(7/7, 'Cleaning images directory - Done')
+    notification(5/5, 'Cleaning images directory - Done')
 
     return extra_image_files
 
-def _get_file_imageIds(image_path):
+def _get_image_file_index(image_path):
+    '''
+    Walk the images directory once and build an index of the ImageIds and the cover files for each.
+    '''
     imageids_files = {}
-    if image_path:
-        for path, dirs, files in os.walk(image_path):
-#            debug_print("_get_file_imageIds - path=%s, dirs=%s" % (path, dirs))
-#            debug_print("_get_file_imageIds - files=", files)
-#            debug_print("_get_file_imageIds - len(files)=", len(files))
-            for filename in files:
-#                debug_print("_get_file_imageIds - filename=", filename)
+    if not image_path or not os.path.isdir(image_path):
+        return imageids_files
+
+    directories = [image_path]
+    while directories:
+        path = directories.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                filename = entry.name
                 if filename.find(" - N3_") > 0:
-#                    debug_print("check_covers - filename=%s" % (filename))
                     imageid = filename.split(" - N3_")[0]
-                    imageids_files[imageid] = path
-                    continue
                 elif filename.find(" - AndroidBookLoadTablet_Aspect") > 0:
-#                    debug_print("check_covers - filename=%s" % (filename))
                     imageid = filename.split(" - AndroidBookLoadTablet_Aspect")[0]
-                    imageids_files[imageid] = path
-                    continue
                 else:
-                    debug_print("_get_file_imageIds - path=%s" % (path))
+                    debug_print("_get_image_file_index - path=%s" % (path))
                     debug_print("check_covers: not 'N3' file - filename=%s" % (filename))
+                    continue
+                imageids_files.setdefault(imageid, []).append(entry.path)
 
-#    imageids_files = set(imageids_files)
     return imageids_files
 
+def _get_images_cleanup_plan_entries(extra_imageids, imageids_files, image_path):
+    plan_entries = {}
+    for imageId in extra_imageids:
+        files = []
+        for filename in imageids_files[imageId]:
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0
+            # Keep the paths relative as the device might be mounted somewhere else when the plan is resumed.
+            files.append([os.path.relpath(filename, image_path), size])
+        plan_entries[imageId] = files
+    return plan_entries
+
+def _execute_images_cleanup_plan(plan, image_paths, device_uuid, images_tree, notification=lambda x,y:x):
+    '''
+    Delete the files in the cleanup plan in batches. The plan is saved after each batch so that
+    the cleanup can be resumed if the device is disconnected part way through.
+    '''
+    debug_print("_execute_images_cleanup_plan - images_tree=%s" % (images_tree))
+    total_images = len(plan['main_memory']) + len(plan['sd_card'])
+    removed_images = 0
+    for image_store in ('main_memory', 'sd_card'):
+        image_path = image_paths[image_store]
+        if not plan[image_store]:
+            continue
+        if not image_path or not os.path.isdir(image_path):
+            debug_print("_execute_images_cleanup_plan - images directory not available, leaving in plan: image_store=%s" % (image_store))
+            continue
+
+        imageIds = list(plan[image_store].keys())
+        for i in range(0, len(imageIds), IMAGES_CLEANUP_BATCH_SIZE):
+            for imageId in imageIds[i:i + IMAGES_CLEANUP_BATCH_SIZE]:
+                debug_print("_execute_images_cleanup_plan - imageId=%s" % (imageId))
+                image_dirs = set()
+                for relative_path, size in plan[image_store][imageId]:
+                    filename = os.path.join(image_path, relative_path)
+                    debug_print("_execute_images_cleanup_plan - filename=%s" % (filename))
+                    try:
+                        os.unlink(filename)
+                        plan['deleted_bytes'] += size
+                    except FileNotFoundError:
+                        # Already deleted before the last checkpoint was saved.
+                        pass
+                    image_dirs.add(os.path.dirname(filename))
+                if images_tree:
+                    for image_dir in image_dirs:
+                        debug_print("_execute_images_cleanup_plan - about to remove directory: image_dir=%s" % image_dir)
+                        try:
+                            os.removedirs(image_dir)
+                            debug_print("_execute_images_cleanup_plan - removed path=%s" % (image_dir))
+                        except Exception as e:
+                            debug_print("_execute_images_cleanup_plan - removed path exception=", e)
+                            pass
+                del plan[image_store][imageId]
+                removed_images += 1
+
+            cfg.set_images_cleanup_plan(device_uuid, plan)
+            notification(removed_images / total_images, 'Removed {0} of {1} images'.format(removed_images, total_images))
+
+    deleted_bytes = plan['deleted_bytes']
+    if not plan['main_memory'] and not plan['sd_card']:
+        cfg.set_images_cleanup_plan(device_uuid, None)
+
+    return deleted_bytes
+
 def _remove_extra_files(extra_imageids_files, imageids_files, delete_extra_covers, image_path, images_tree=False):
     extra_image_files = []
     from glob import glob
@@ -657,7 +1255,9 @@ def _remove_extra_files(extra_imageids_files, imageids_files, delete_extra_cover
     return extra_image_files
 
 def _get_imageId_set(device_database_path):
-    with closing(device_database_connection(device_database_path, use_row_factory=True)) as connection:
+    with device_database_snapshot(device_database_path) as snapshot, \
+            closing(device_database_connection(snapshot['snapshot_path'], use_row_factory=True)) as connection, \
+            database_profile(connection, '_get_imageId_set'):
 
         imageId_query = ('SELECT DISTINCT ImageId '
                         'FROM content '
@@ -719,7 +1319,7 @@ def do_remove_annotations(options, books, cpus, notification=lambda x,y:x):
         if annotation_test_func:
             current_step += 1
             notification(current_step/steps, _('Checking annotations files.'))
-            annotation_files = _check_annotation_files(annotation_files, annotations_dir, annotations_ext, device_path, annotation_test_func)
+            annotation_files = _check_annotation_files(annotation_files, annotations_dir, annotations_ext, device_path, annotation_test_func, cpus)
             msg = _("Found {0} annotation files to be removed.").format(len(annotation_files))
 
     if len(annotation_files.keys()) > 0:
@@ -740,6 +1340,96 @@ def do_remove_annotations(options, books, cpus, notification=lambda x,y:x):
 
     return remove_annotations_result
 
+def do_backup_annotation_files(options, cpus, notification=lambda x,y:x):
+    from concurrent.futures import ThreadPoolExecutor
+    annotations_dir  = options['annotations_dir']
+    dest_path        = options['dest_path']
+    annotation_files = options['annotation_files']
+    debug_print("do_backup_annotation_files - annotations_dir='%s', dest_path='%s', number of files=%d" % (annotations_dir, dest_path, len(annotation_files)))
+
+    notification(1/3, _('Checking annotations files'))
+    with ThreadPoolExecutor(max_workers=max(cpus, 1)) as executor:
+        annotation_stats = list(executor.map(lambda relative_path: _get_file_stat(os.path.join(annotations_dir, relative_path)), annotation_files))
+    found_files = [(relative_path, file_stat) for relative_path, file_stat in zip(annotation_files, annotation_stats) if file_stat is not None]
+
+    backup_result = {}
+    backup_result['annotations_found'] = len(found_files)
+    backup_result['no_annotations']    = len(annotation_files) - len(found_files)
+    backup_result['kepubs']            = options['kepubs']
+    backup_result['count_books']       = options['count_books']
+
+    notification(2/3, _('Backing up annotations files'))
+    if options['zip_annotations']:
+        backup_result['backup_file'] = _backup_annotation_files_to_zip(found_files, annotations_dir, dest_path, cpus)
+        backup_result['unchanged'] = 0
+    else:
+        backup_result['backup_file'] = dest_path
+        backup_result['unchanged'] = _backup_annotation_files_to_tree(found_files, annotations_dir, dest_path, cpus)
+
+    debug_print("do_backup_annotation_files - backup_result:", backup_result)
+    notification(3/3, _('Backing up annotations files') + ' - ' + _("Finished"))
+    return backup_result
+
+def _get_file_stat(file_path):
+    try:
+        return os.stat(file_path)
+    except OSError:
+        return None
+
+def _backup_annotation_files_to_tree(found_files, annotations_dir, dest_path, cpus):
+    '''
+    Copy the annotations files into the destination directory. Files with the same size and
+    modification time as the existing backup are skipped.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    files_to_copy = []
+    backup_dirs = set()
+    for relative_path, file_stat in found_files:
+        backup_file = os.path.join(dest_path, relative_path)
+        backup_stat = _get_file_stat(backup_file)
+        if backup_stat is not None and backup_stat.st_size == file_stat.st_size \
+                and int(backup_stat.st_mtime) == int(file_stat.st_mtime):
+            continue
+        files_to_copy.append((os.path.join(annotations_dir, relative_path), backup_file))
+        backup_dirs.add(os.path.dirname(backup_file))
+
+    for backup_dir in backup_dirs:
+        if not os.path.isdir(backup_dir):
+            os.makedirs(backup_dir)
+
+    debug_print("_backup_annotation_files_to_tree - files to copy=%d, unchanged files=%d" % (len(files_to_copy), len(found_files) - len(files_to_copy)))
+    with ThreadPoolExecutor(max_workers=max(cpus, 1)) as executor:
+        # copy2 keeps the modification time so the file is skipped in the next backup.
+        list(executor.map(lambda copy_paths: shutil.copy2(*copy_paths), files_to_copy))
+
+    return len(found_files) - len(files_to_copy)
+
+def _backup_annotation_files_to_zip(found_files, annotations_dir, dest_path, cpus):
+    '''
+    Write the annotations files into a single zip file. The files are read by a few threads
+    and written to the zip file as they are read.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    def read_annotation_file(relative_path):
+        with open(os.path.join(annotations_dir, relative_path), 'rb') as annotation_file:
+            return annotation_file.read()
+
+    if not os.path.isdir(dest_path):
+        os.makedirs(dest_path)
+    backup_file = os.path.join(dest_path, 'KoboUtilities-Annotations-%s.zip' % time.strftime('%Y%m%d-%H%M%S'))
+    debug_print("_backup_annotation_files_to_zip - backup_file='%s'" % (backup_file))
+    with zipfile.ZipFile(backup_file, 'w', zipfile.ZIP_DEFLATED) as backup_zip, \
+            ThreadPoolExecutor(max_workers=max(cpus, 1)) as executor:
+        relative_paths = [relative_path for relative_path, _file_stat in found_files]
+        for (relative_path, file_stat), data in zip(found_files, executor.map(read_annotation_file, relative_paths)):
+            date_time = min(max(time.localtime(file_stat.st_mtime)[:6], ZIP_MIN_DATE_TIME), ZIP_MAX_DATE_TIME)
+            zip_info = zipfile.ZipInfo(relative_path.replace(os.sep, '/'), date_time)
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            backup_zip.writestr(zip_info, data)
+
+    return backup_file
+
 def _get_annotation_files(annotations_path, annotations_ext, device_path):
     annotation_files = {}
     if annotations_path:
@@ -777,14 +1467,21 @@ def _get_annotation_files_for_books(books, annotations_path, annotations_ext, de
 
     return annotation_files
 
-def _check_annotation_files(annotation_files, annotations_dir, annotations_ext, device_path, annotation_test_func):
+def _check_annotation_files(annotation_files, annotations_dir, annotations_ext, device_path, annotation_test_func, cpus=1):
+    from concurrent.futures import ThreadPoolExecutor
     annotation_files_to_remove = {}
-    for filename in annotation_files.keys():
+
+    def check_annotation_file(filename):
         debug_print("_check_annotation_files - filename='%s', path='%s'" % (filename, annotation_files[filename]))
-        file_path = annotation_files[filename]
-        if annotation_test_func(filename, file_path, annotations_dir, device_path):
-            debug_print("_check_annotation_files - annotation to be removed=", filename)
-            annotation_files_to_remove[filename] = file_path
+        return annotation_test_func(filename, annotation_files[filename], annotations_dir, device_path)
+
+    # The checks are almost all waiting on the device, so a few threads keep it busy.
+    filenames = list(annotation_files.keys())
+    with ThreadPoolExecutor(max_workers=max(cpus, 1)) as executor:
+        for filename, to_be_removed in zip(filenames, executor.map(check_annotation_file, filenames)):
+            if to_be_removed:
+                debug_print("_check_annotation_files - annotation to be removed=", filename)
+                annotation_files_to_remove[filename] = annotation_files[filename]
 
     return annotation_files_to_remove
 
@@ -799,12 +1496,206 @@ def _annotation_file_is_empty(annotation_filename, annotation_path, annotations_
     return not _annotation_file_is_not_empty(annotation_filename, annotation_path, annotations_dir, device_path)
 
 def _annotation_file_is_not_empty(annotation_filename, annotation_path, annotations_dir, device_path):
+    '''
+    Read the file a block at a time and stop at the first annotation start tag.
+    '''
     debug_print("_annotation_file_is_not_empty - annotation_filename=", annotation_filename)
     annotation_filepath = os.path.join(annotation_path, annotation_filename)
-    with open(annotation_filepath) as annotation_file:
-        soup = BeautifulStoneSoup(annotation_file.read())
-        annotation = soup.find('annotation')
-#        debug_print("_annotation_file_is_empty - annotation=", annotation)
+    # Keep the end of the previous block in case the tag is split between blocks.
+    overlap = len(b'<annotation ')
+    previous_tail = b''
+    with open(annotation_filepath, 'rb') as annotation_file:
+        while True:
+            block = annotation_file.read(ANNOTATION_SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            if ANNOTATION_START_TAG.search(previous_tail + block) is not None:
+                return True
+            previous_tail = block[-overlap:]
+
+    return False
+
+
+def do_read_book_tocs(books_to_read, cpus, notification=lambda x,y:x):
+    '''
+    Read the ToC and spine of the library and device copies of the books. Only the
+    chapter and manifest lists are returned, the parsed books are not kept.
+    '''
+    debug_print("do_read_book_tocs - number of books=%d" % len(books_to_read))
+    cache_dir = cfg.get_toc_cache_dir()
+    book_tocs = []
+    cached_files = 0
+    total_books = len(books_to_read)
+    for i, (book_index, library_path, device_path, format_on_device) in enumerate(books_to_read):
+        notification(i / total_books, _('Reading ToC'))
+        book_toc = {}
+        for book_location, pathtoebook in (('library', library_path), ('kobo', device_path)):
+            try:
+                chapter_list, cached = _get_cached_chapter_list(cache_dir, pathtoebook, format_on_device=format_on_device)
+            except DRMError:
+                book_toc[book_location + '_drm'] = True
+                break
+            except Exception as e:
+                debug_print("do_read_book_tocs - could not read ToC of '%s'. Exception was: %s" % (pathtoebook, e))
+                book_toc[book_location + '_error'] = '{0}'.format(e)
+                break
+            cached_files += 1 if cached else 0
+            book_toc.update((book_location + '_' + key, value) for key, value in chapter_list.items())
+        book_tocs.append((book_index, book_toc))
+    debug_print("do_read_book_tocs - ToCs read from cache=%d" % cached_files)
+
+    notification(1, _('Reading ToC') + ' - ' + _("Finished"))
+    return book_tocs
+
+def _get_cached_chapter_list(cache_dir, pathtoebook, format_on_device='EPUB'):
+    '''
+    Get the chapter list for the book file from the ToC cache, or read it from the book and
+    add it to the cache. Returns the chapter list and whether it came from the cache.
+    '''
+    import hashlib
+    pathtoebook = os.path.abspath(pathtoebook)
+    file_stat = os.stat(pathtoebook)
+    file_identity = [TOC_CACHE_VERSION, pathtoebook, file_stat.st_size, int(file_stat.st_mtime), _get_book_file_hash(pathtoebook, file_stat.st_size)]
+    cache_key = '%s|%s' % (pathtoebook, format_on_device)
+    cache_entry_path = os.path.join(cache_dir, hashlib.sha1(cache_key.encode('utf-8')).hexdigest() + '.json')
 
-    return annotation is not None
+    try:
+        with open(cache_entry_path, 'rb') as cache_file:
+            cache_entry = json.loads(cache_file.read().decode('utf-8'))
+        if cache_entry['identity'] == file_identity:
+            # Touch the entry so that eviction removes the entries used longest ago first.
+            os.utime(cache_entry_path, None)
+            return cache_entry['chapter_list'], True
+        debug_print("_get_cached_chapter_list - book file has changed: '%s'" % pathtoebook)
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    chapter_list = _get_chapter_list(pathtoebook, format_on_device=format_on_device)
+    cache_entry = {'identity': file_identity, 'chapter_list': chapter_list}
+    temp_path = '%s.%d.tmp' % (cache_entry_path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(json.dumps(cache_entry).encode('utf-8'))
+        atomic_rename(temp_path, cache_entry_path)
+    except (IOError, OSError) as e:
+        debug_print("_get_cached_chapter_list - could not save cache entry for '%s': %s" % (pathtoebook, e))
+    return chapter_list, False
+
+def _get_book_file_hash(pathtoebook, file_size):
+    '''
+    Hash of the blocks at the start and end of the book file. The end of an EPUB is the
+    zip central directory, which changes whenever any file in the book changes.
+    '''
+    import hashlib
+    file_hash = hashlib.sha1()
+    with open(pathtoebook, 'rb') as book_file:
+        file_hash.update(book_file.read(TOC_CACHE_HASH_BLOCK_SIZE))
+        if file_size > TOC_CACHE_HASH_BLOCK_SIZE:
+            book_file.seek(max(TOC_CACHE_HASH_BLOCK_SIZE, file_size - TOC_CACHE_HASH_BLOCK_SIZE))
+            file_hash.update(book_file.read(TOC_CACHE_HASH_BLOCK_SIZE))
+    return file_hash.hexdigest()
+
+def evict_toc_cache_entries(cache_dir):
+    '''
+    Remove the cache entries older than TOC_CACHE_MAX_AGE, then the entries used longest
+    ago until the cache is smaller than TOC_CACHE_MAX_SIZE.
+    '''
+    oldest_allowed = time.time() - TOC_CACHE_MAX_AGE
+    cache_entries = []
+    for entry in os.listdir(cache_dir):
+        entry_path = os.path.join(cache_dir, entry)
+        try:
+            entry_stat = os.stat(entry_path)
+        except OSError:
+            continue
+        cache_entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+
+    cache_entries.sort(reverse=True)
+    cache_size = 0
+    removed_entries = 0
+    for entry_mtime, entry_size, entry_path in cache_entries:
+        cache_size += entry_size
+        if entry_mtime < oldest_allowed or cache_size > TOC_CACHE_MAX_SIZE:
+            try:
+                os.remove(entry_path)
+                removed_entries += 1
+            except OSError:
+                # Another job might have removed it already.
+                pass
+    debug_print("evict_toc_cache_entries - entries=%d, removed=%d" % (len(cache_entries), removed_entries))
+
+def load_ebook(pathtoebook):
+    '''
+    Open the book straight from its zip file when its ToC can be read from the NCX. EPUB 3
+    books use the navigation document for their ToC, so they, and any book the zip
+    container cannot read, are unpacked with calibre's container instead.
+    '''
+    try:
+        container = ZipContainer(pathtoebook, default_log)
+        if container.opf_version < 3 and container.ncx is not None:
+            debug_print("load_ebook - reading from the zip file")
+            return container
+        container.close()
+    except DRMError:
+        raise
+    except Exception as e:
+        debug_print("load_ebook - cannot read from the zip file: %s" % (e,))
+    debug_print("load_ebook - creating container")
+    return EpubContainer(pathtoebook, default_log)
 
+def _release_container(container):
+    if isinstance(container, ZipContainer):
+        container.close()
+    else:
+        container.parsed_cache.clear()
+        shutil.rmtree(container.root, ignore_errors=True)
+
+def _read_toc(toc, toc_depth=1, format_on_device='EPUB', container=None):
+    chapters = []
+    debug_print("_read_toc - toc.title=%s, toc_depth=%d" % (toc.title, toc_depth))
+    for item in toc:
+        if item.dest is not None:
+            chapter = {}
+            chapter['title'] = item.title
+            chapter['path'] = item.dest
+            if format_on_device == 'KEPUB':
+                chapter['path'] = container.name_to_href(item.dest, container.opf_name)
+            chapter['toc_depth'] = toc_depth
+            if item.frag:
+                chapter['fragment'] = item.frag
+                chapter['path'] = "{0}#{1}".format(chapter['path'], item.frag)
+            if format_on_device == 'KEPUB':
+                chapter['path'] = "{0}-{1}".format(chapter['path'], toc_depth)
+            chapter['added'] = False
+            chapters.append(chapter)
+        chapters += _read_toc(item, toc_depth + 1, format_on_device=format_on_device, container=container)
+
+    return chapters
+
+def _get_manifest_entries(container):
+    manifest_entries = []
+    for spine_name, spine_linear in container.spine_names:
+        spine_path = container.name_to_href(spine_name, container.opf_name)
+        file_size = container.filesize(spine_name)
+        manifest_entries.append({'path': spine_path, 'file_size': file_size, 'name': spine_name})
+    debug_print("_get_manifest_entries - manifest_entries=", manifest_entries)
+    return manifest_entries
+
+def _get_chapter_list(pathtoebook, format_on_device='EPUB'):
+    debug_print("_get_chapter_list - pathtoebook='%s'" % (pathtoebook,))
+    container = load_ebook(pathtoebook)
+    chapter_list = {}
+    try:
+        opf_name = container.opf_name
+        last_slash_index = opf_name.rfind('/')
+        chapter_list['opf_name'] = opf_name
+        chapter_list['opf_dir'] = opf_name[:last_slash_index] if last_slash_index >= 0 else ''
+        toc = container.get_ncx_toc() if isinstance(container, ZipContainer) else get_toc(container)
+        chapter_list['chapters'] = _read_toc(toc, format_on_device=format_on_device, container=container)
+        chapter_list['manifest'] = _get_manifest_entries(container)
+    finally:
+        # Only the chapter list is kept. Drop the parsed files and the unpacked book now instead
+        # of when the worker exits, so a batch of books does not build up in memory and on disk.
+        _release_container(container)
+    debug_print("_get_chapter_list - opf_dir='%s', chapters=%d" % (chapter_list['opf_dir'], len(chapter_list['chapters'])))
+    return chapter_list
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+# Generate a synthetic KoboReader.sqlite for benchmarking the plugin without a
+# device. Only the tables and columns the plugin uses are created. The declared
+# column names match the device database, as the plugin reads some columns by
+# the names SQLite reports for them.
+#
+#     python make_kobo_database.py --books 10000 KoboReader.sqlite
+
+import argparse, os, random, sqlite3
+from datetime import datetime, timedelta
+
+CREATE_STATEMENTS = [
+    'CREATE TABLE content ('
+        'ContentID TEXT NOT NULL, '
+        'ContentType TEXT NOT NULL, '
+        'MimeType TEXT NOT NULL, '
+        'BookID TEXT, '
+        'BookTitle TEXT, '
+        'ImageId TEXT, '
+        'Title TEXT COLLATE NOCASE, '
+        'Attribution TEXT COLLATE NOCASE, '
+        'Description TEXT, '
+        'DateCreated TEXT, '
+        'adobe_location TEXT, '
+        'Publisher TEXT, '
+        'DateLastRead TEXT, '
+        'FirstTimeReading BOOL default true, '
+        'ChapterIDBookmarked TEXT, '
+        'NumShortcovers INTEGER, '
+        'VolumeIndex INTEGER, '
+        '___NumPages INTEGER, '
+        'ReadStatus INTEGER, '
+        '___SyncTime TEXT, '
+        '___UserID TEXT NOT NULL, '
+        '___FileOffset INTEGER, '
+        '___FileSize INTEGER, '
+        '___PercentRead INTEGER, '
+        'IsDownloaded BIT default true, '
+        'FeedbackType INTEGER default 0, '
+        'FeedbackTypeSynced INTEGER default 0, '
+        'PageProgressDirection TEXT, '
+        'ISBN TEXT, '
+        'Series TEXT, '
+        'SeriesNumber TEXT, '
+        'SeriesID TEXT, '
+        'SeriesNumberFloat REAL, '
+        'Subtitle TEXT, '
+        'DateModified TEXT, '
+        'PRIMARY KEY (ContentID))',
+    'CREATE INDEX content_bookid ON content (BookID)',
+    'CREATE TABLE ratings ('
+        'ContentID TEXT NOT NULL, '
+        'Rating INTEGER, '
+        'DateModified TEXT NOT NULL, '
+        'PRIMARY KEY (ContentID))',
+    'CREATE TABLE Shelf ('
+        'CreationDate TEXT, '
+        'Id TEXT, '
+        'InternalName TEXT, '
+        'LastModified TEXT, '
+        'Name TEXT, '
+        'Type TEXT, '
+        '_IsDeleted BOOL, '
+        '_IsVisible BOOL, '
+        '_IsSynced BOOL, '
+        '_SyncTime TEXT, '
+        'LastAccessed TEXT, '
+        'PRIMARY KEY (Id))',
+    'CREATE TABLE ShelfContent ('
+        'ShelfName TEXT, '
+        'ContentId TEXT, '
+        'DateModified TEXT, '
+        '_IsDeleted BOOL, '
+        '_IsSynced BOOL, '
+        'PRIMARY KEY (ShelfName, ContentId))',
+    'CREATE TABLE volume_tabs ('
+        'volumeId TEXT NOT NULL, '
+        'tabId TEXT NOT NULL, '
+        'PRIMARY KEY (volumeId, tabId))',
+    'CREATE TABLE volume_shortcovers ('
+        'volumeId TEXT NOT NULL, '
+        'shortcoverId TEXT NOT NULL, '
+        'VolumeIndex INTEGER, '
+        'PRIMARY KEY (volumeId, shortcoverId))',
+    'CREATE TABLE content_settings ('
+        'ContentType INTEGER NOT NULL, '
+        'ContentID TEXT NOT NULL, '
+        'DateModified TEXT NOT NULL, '
+        'ReadingFontFamily TEXT, '
+        'ReadingFontSize REAL, '
+        'ReadingAlignment TEXT, '
+        'ReadingLineHeight REAL, '
+        'ReadingLeftMargin INTEGER, '
+        'ReadingRightMargin INTEGER, '
+        'PRIMARY KEY (ContentType, ContentID))',
+    ]
+
+MIMETYPE_EPUB  = 'application/epub+zip'
+MIMETYPE_KEPUB = 'application/x-kobo-epub+zip'
+
+# The device has written its timestamps in each of these formats over the
+# firmware versions.
+DATE_FORMATS = [
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S+00:00',
+    '%Y-%m-%dT%H:%M:%S',
+    ]
+
+BASE_DATE = datetime(2018, 1, 1)
+
+
+def image_id_from_contentid(contentID):
+    return contentID.replace('/', '_').replace(' ', '_').replace(':', '_').replace('.', '_')
+
+
+def random_date(rng, days=365 * 3):
+    date = BASE_DATE + timedelta(seconds=rng.randrange(days * 24 * 60 * 60))
+    return date.strftime(rng.choice(DATE_FORMATS))
+
+
+def make_kobo_database(database_path, books, chapters_per_book=10, seed=0):
+    '''
+    Create the database at database_path with the given number of books. The
+    same seed always generates the same database. Returns the number of rows
+    created in each table.
+    '''
+    rng = random.Random(seed)
+    if os.path.exists(database_path):
+        os.remove(database_path)
+
+    authors = ['Author %04d' % i for i in range(max(books // 8, 1))]
+    series  = ['Series %04d' % i for i in range(max(books // 12, 1))]
+
+    content_rows  = []
+    ratings_rows  = []
+    settings_rows = []
+    series_books  = {}
+    for book_number in range(books):
+        kepub     = rng.random() < 0.3
+        extension = '.kepub.epub' if kepub else '.epub'
+        author    = rng.choice(authors)
+        title     = 'Book %06d' % book_number
+        contentID = 'file:///mnt/onboard/%s/%s - %s%s' % (author, title, author, extension)
+
+        book_series = series_number = None
+        if rng.random() < 0.4:
+            book_series = rng.choice(series)
+            series_books.setdefault(book_series, []).append(contentID)
+            series_number = '%d' % len(series_books[book_series])
+
+        read_status = rng.choice([0, 0, 1, 1, 1, 2])
+        chapter     = rng.randrange(chapters_per_book) if chapters_per_book else None
+        if kepub:
+            chapter_bookmarked = 'OEBPS/chapter%03d.xhtml#kobo.1.1' % chapter if chapter is not None else None
+        else:
+            chapter_bookmarked = '%s#(%d)OEBPS/chapter%03d.xhtml' % (contentID, chapter, chapter) if chapter is not None else None
+        content_rows.append({
+            'ContentID':           contentID,
+            'ContentType':         6,
+            'MimeType':            MIMETYPE_KEPUB if kepub else MIMETYPE_EPUB,
+            'BookID':              None,
+            'BookTitle':           None,
+            'ImageId':             image_id_from_contentid(contentID),
+            'Title':               title,
+            'Attribution':         author,
+            'DateCreated':         random_date(rng),
+            'adobe_location':      None,
+            'DateLastRead':        random_date(rng) if read_status else None,
+            'ChapterIDBookmarked': chapter_bookmarked if read_status else None,
+            'VolumeIndex':         -1,
+            'ReadStatus':          read_status,
+            '___SyncTime':         random_date(rng),
+            '___PercentRead':      rng.randrange(1, 100) if read_status == 1 else 100 if read_status == 2 else 0,
+            '___FileSize':         rng.randrange(100000, 5000000),
+            'Series':              book_series,
+            'SeriesNumber':        series_number,
+            })
+
+        for chapter_number in range(chapters_per_book):
+            if kepub:
+                chapter_contentID = '%s!OEBPS!chapter%03d.xhtml' % (contentID, chapter_number)
+                chapter_type      = 9
+                adobe_location    = None
+            else:
+                chapter_contentID = '%s#(%d)OEBPS/chapter%03d.xhtml' % (contentID, chapter_number, chapter_number)
+                chapter_type      = 899
+                adobe_location    = 'OEBPS/chapter%03d.xhtml#point(/1/4/2:0)' % chapter_number
+            content_rows.append({
+                'ContentID':           chapter_contentID,
+                'ContentType':         chapter_type,
+                'MimeType':            MIMETYPE_KEPUB if kepub else MIMETYPE_EPUB,
+                'BookID':              contentID,
+                'BookTitle':           title,
+                'ImageId':             None,
+                'Title':               'Chapter %d' % chapter_number,
+                'Attribution':         None,
+                'DateCreated':         None,
+                'adobe_location':      adobe_location,
+                'DateLastRead':        None,
+                'ChapterIDBookmarked': None,
+                'VolumeIndex':         chapter_number,
+                'ReadStatus':          0,
+                '___SyncTime':         None,
+                '___PercentRead':      0,
+                '___FileSize':         0,
+                'Series':              None,
+                'SeriesNumber':        None,
+                })
+
+        if read_status and rng.random() < 0.25:
+            ratings_rows.append((contentID, rng.randrange(1, 6), random_date(rng)))
+        if rng.random() < 0.05:
+            settings_rows.append((6, contentID, random_date(rng), 'Georgia', 22.0, 'justify', 1.4, 2, 2))
+
+    shelf_rows         = []
+    shelf_content_rows = []
+    for shelf_name, contentIDs in sorted(series_books.items()):
+        creation_date = random_date(rng)
+        shelf_rows.append((creation_date, shelf_name, shelf_name, creation_date, shelf_name,
+                           'UserTag', 'false', 'true', 'true'))
+        for contentID in contentIDs:
+            shelf_content_rows.append((shelf_name, contentID, random_date(rng), 'false', 'true'))
+
+    # Some of the books already have related books set.
+    volume_tabs_rows = []
+    for contentIDs in series_books.values():
+        if len(contentIDs) > 1 and rng.random() < 0.5:
+            volume_tabs_rows.extend((volumeId, tabId) for volumeId in contentIDs for tabId in contentIDs if volumeId != tabId)
+
+    content_columns = list(content_rows[0].keys()) if content_rows else []
+    content_insert  = 'INSERT INTO content (%s, ___UserID) VALUES (%s, \'\')' % (
+                            ', '.join(content_columns), ', '.join(':' + column for column in content_columns))
+
+    connection = sqlite3.connect(database_path)
+    try:
+        for statement in CREATE_STATEMENTS:
+            connection.execute(statement)
+        connection.executemany(content_insert, content_rows)
+        connection.executemany('INSERT INTO ratings (ContentID, Rating, DateModified) VALUES (?, ?, ?)', ratings_rows)
+        connection.executemany('INSERT INTO Shelf (CreationDate, Id, InternalName, LastModified, Name, Type, _IsDeleted, _IsVisible, _IsSynced) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', shelf_rows)
+        connection.executemany('INSERT INTO ShelfContent (ShelfName, ContentId, DateModified, _IsDeleted, _IsSynced) '
+                               'VALUES (?, ?, ?, ?, ?)', shelf_content_rows)
+        connection.executemany('INSERT INTO volume_tabs (volumeId, tabId) VALUES (?, ?)', volume_tabs_rows)
+        connection.executemany('INSERT INTO content_settings (ContentType, ContentID, DateModified, ReadingFontFamily, ReadingFontSize, '
+                               'ReadingAlignment, ReadingLineHeight, ReadingLeftMargin, ReadingRightMargin) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', settings_rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+    return {
+        'content':          len(content_rows),
+        'ratings':          len(ratings_rows),
+        'Shelf':            len(shelf_rows),
+        'ShelfContent':     len(shelf_content_rows),
+        'volume_tabs':      len(volume_tabs_rows),
+        'content_settings': len(settings_rows),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic KoboReader.sqlite')
+    parser.add_argument('database_path', help='Path of the database to create. An existing file is replaced.')
+    parser.add_argument('--books', type=int, default=1000, help='Number of books (default: %(default)s)')
+    parser.add_argument('--chapters', type=int, default=10, help='Number of chapters for each book (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: %(default)s)')
+    args = parser.parse_args()
+
+    row_counts = make_kobo_database(args.database_path, args.books, args.chapters, args.seed)
+    print('%s: %s' % (args.database_path, ', '.join('%s=%d' % item for item in row_counts.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+# Run the database heavy parts of the plugin against synthetic device databases
+# and write the timings to JSON and CSV files. This needs calibre's Python, so
+# run it with calibre-debug from the top of the repository:
+#
+#     calibre-debug -e benchmarks/run_benchmarks.py -- --output-dir bench-2.17.2
+#
+# Use --baseline with the JSON file from an earlier release to compare the two.
+#
+# The job functions from jobs.py are run as the child jobs run them. The shelf
+# and related books methods of the action are called with a stand-in for the
+# action that has no GUI. _update_metadata needs calibre's library and device
+# objects and is not run. Its PROFILE lines in the debug log can be used instead.
+#
+# max_rss_kb is the peak memory use of the process at the end of a benchmark.
+# The sizes are run smallest first, so run a single size with --books to get the
+# figure for that size alone.
+
+import argparse, csv, importlib, importlib.abc, importlib.machinery, importlib.util
+import json, os, platform, shutil, statistics, sys, tempfile, time
+from contextlib import closing
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR     = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'KoboUtilities')
+PLUGIN_PACKAGE = 'calibre_plugins.koboutilities'
+
+sys.path.insert(0, BENCHMARKS_DIR)
+from make_kobo_database import make_kobo_database
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+
+RESULT_FIELDS = ['plugin_version', 'books', 'benchmark', 'repeat', 'seconds_min', 'seconds_median',
+                 'executions', 'statements', 'max_rss_kb']
+
+# Changes in the last month of the generated dates.
+SYNC_WATERMARK_DATE = '2020-12-01T00:00:00'
+
+
+class PluginFinder(importlib.abc.MetaPathFinder):
+    '''
+    Import the plugin as calibre_plugins.koboutilities from the source tree
+    rather than from an installed plugin zip.
+    '''
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname == PLUGIN_PACKAGE:
+            return importlib.util.spec_from_file_location(fullname, os.path.join(self.plugin_dir, '__init__.py'),
+                                                          submodule_search_locations=[self.plugin_dir])
+        if fullname.startswith(PLUGIN_PACKAGE + '.'):
+            return importlib.machinery.PathFinder.find_spec(fullname, [self.plugin_dir])
+        return None
+
+
+def load_plugin(plugin_dir):
+    try:
+        import calibre_plugins
+    except ImportError:
+        calibre_plugins = importlib.util.module_from_spec(importlib.machinery.ModuleSpec('calibre_plugins', None, is_package=True))
+        calibre_plugins.__path__ = []
+        sys.modules['calibre_plugins'] = calibre_plugins
+    # Drop an installed copy of the plugin if calibre has already loaded it.
+    for name in list(sys.modules):
+        if name == PLUGIN_PACKAGE or name.startswith(PLUGIN_PACKAGE + '.'):
+            del sys.modules[name]
+    sys.meta_path.insert(0, PluginFinder(plugin_dir))
+    return importlib.import_module(PLUGIN_PACKAGE + '.jobs')
+
+
+class StatementCounter(object):
+    '''
+    Counts the statements run on every apsw connection opened while it is
+    installed.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.executions = 0
+        self.statements = set()
+
+    def install(self, apsw):
+        apsw.connection_hooks.append(self.connection_hook)
+
+    def connection_hook(self, connection):
+        connection.setexectrace(self.count_statements)
+
+    def count_statements(self, cursor, sql, bindings):
+        self.executions += 1
+        self.statements.add(sql)
+        return True
+
+
+class HeadlessProgressBar(object):
+
+    def left_align_label(self):
+        pass
+
+
+class HeadlessAction(object):
+    '''
+    Stands in for KoboUtilitiesAction, so that its database methods can be run
+    against a database file without the calibre GUI or a device.
+    '''
+    device_timestamp_string = '%Y-%m-%dT%H:%M:%SZ'
+
+    def __init__(self, jobs, database_path):
+        self.jobs          = jobs
+        self.database_path = database_path
+        self.pb            = HeadlessProgressBar()
+
+    def device_database_connection(self, use_row_factory=False):
+        return self.jobs.device_database_connection(self.database_path, use_row_factory=use_row_factory)
+
+    def progressbar(self, window_title, on_top=False):
+        pass
+
+    def show_progressbar(self, maximum_count):
+        pass
+
+    def set_progressbar_label(self, label):
+        pass
+
+    def increment_progressbar(self):
+        pass
+
+    def hide_progressbar(self):
+        pass
+
+
+def get_books(jobs, database_path):
+    '''
+    The books as the action passes them to the store locations jobs.
+    '''
+    with closing(jobs.device_database_connection(database_path, use_row_factory=True, readonly=True)) as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT ContentID, Title, Attribution FROM content WHERE ContentType = 6 ORDER BY ContentID")
+        books = [(book_id, [row['ContentID']], row['Title'], [row['Attribution']], None, None, None, None)
+                 for book_id, row in enumerate(cursor)]
+        cursor.close()
+    return books
+
+
+def get_shelves(jobs, database_path):
+    '''
+    The shelves to order. This counts the books on each shelf directly, as
+    _get_series_shelf_count checks the content table for every shelf and takes
+    minutes on the larger databases.
+    '''
+    with closing(jobs.device_database_connection(database_path, use_row_factory=True, readonly=True)) as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT ShelfName, COUNT(*) AS BookCount FROM ShelfContent WHERE _IsDeleted = 'false' GROUP BY ShelfName")
+        shelves = [{'name': row['ShelfName'], 'count': row['BookCount']} for row in cursor]
+        cursor.close()
+    return shelves
+
+
+def get_related_books(jobs, database_path):
+    from calibre_plugins.koboutilities.action import KoboUtilitiesAction
+    return KoboUtilitiesAction._get_related_books_count(HeadlessAction(jobs, database_path), jobs.cfg.KEY_RELATED_BOOKS_SERIES)
+
+
+def get_store_options(jobs, database_path):
+    from calibre_plugins.koboutilities.action import FETCH_QUERIES
+    cfg = jobs.cfg
+    return {
+        cfg.KEY_CLEAR_IF_UNREAD:                False,
+        cfg.KEY_STORE_IF_MORE_RECENT:           False,
+        cfg.KEY_DO_NOT_STORE_IF_REOPENED:       False,
+        cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN: '#kobo_location',
+        cfg.KEY_PERCENT_READ_CUSTOM_COLUMN:     '#kobo_percent_read',
+        cfg.KEY_RATING_CUSTOM_COLUMN:           'rating',
+        cfg.KEY_LAST_READ_CUSTOM_COLUMN:        '#kobo_last_read',
+        'device_database_path':                 database_path,
+        'epub_location_like_kepub':             True,
+        'fetch_queries':                        FETCH_QUERIES[max(FETCH_QUERIES)],
+        }
+
+
+def benchmark_snapshot(jobs, database_path, context):
+    with jobs.device_database_snapshot(database_path):
+        pass
+
+
+def benchmark_fetch_reading_statuses(jobs, database_path, context):
+    fetch_queries = context['store_options']['fetch_queries']
+    contentIDs    = [contentID for book in context['books'] for contentID in book[1]]
+    with closing(jobs.device_database_connection(database_path, use_row_factory=True, readonly=True)) as connection:
+        cursor = connection.cursor()
+        jobs._fetch_reading_statuses(cursor, contentIDs, fetch_queries['kepub_batch'], fetch_queries['epub_batch'])
+        cursor.close()
+
+
+def benchmark_store_locations_all(jobs, database_path, context):
+    options = dict(context['store_options'])
+    options['device_database_path'] = database_path
+    jobs.do_store_locations_all(context['books'], options)
+
+
+def benchmark_sync_watermark(jobs, database_path, context):
+    cfg = jobs.cfg
+    sync_watermark = {
+        cfg.KEY_WATERMARK_DATE_LAST_READ: SYNC_WATERMARK_DATE,
+        cfg.KEY_WATERMARK_SYNC_TIME:      SYNC_WATERMARK_DATE,
+        }
+    with closing(jobs.device_database_connection(database_path, use_row_factory=True, readonly=True)) as connection:
+        cursor = connection.cursor()
+        jobs._get_sync_watermark(cursor)
+        jobs._sync_watermark_in_future(cursor, sync_watermark)
+        jobs._get_contentIDs_changed_since(cursor, sync_watermark)
+        cursor.close()
+
+
+def benchmark_get_imageId_set(jobs, database_path, context):
+    jobs._get_imageId_set(database_path)
+
+
+def benchmark_order_series_shelves(jobs, database_path, context):
+    from calibre_plugins.koboutilities.action import KoboUtilitiesAction
+    cfg = jobs.cfg
+    options = {
+        cfg.KEY_SORT_DESCENDING:    False,
+        cfg.KEY_ORDER_SHELVES_BY:   cfg.KEY_ORDER_SHELVES_SERIES,
+        cfg.KEY_SORT_UPDATE_CONFIG: False,
+        }
+    KoboUtilitiesAction._order_series_shelves(HeadlessAction(jobs, database_path), context['shelves'], options)
+
+
+def benchmark_set_related_books(jobs, database_path, context):
+    from calibre_plugins.koboutilities.action import KoboUtilitiesAction
+    cfg = jobs.cfg
+    options = {
+        cfg.KEY_RELATED_BOOKS_TYPE: cfg.KEY_RELATED_BOOKS_SERIES,
+        }
+    KoboUtilitiesAction._set_related_books(HeadlessAction(jobs, database_path), context['related_books'], options)
+
+
+# Name, whether it changes the database and the function to run. A benchmark
+# that changes the database is run on a fresh copy each time.
+BENCHMARKS = [
+    ('device_database_snapshot', False, benchmark_snapshot),
+    ('_fetch_reading_statuses',  False, benchmark_fetch_reading_statuses),
+    ('do_store_locations_all',   False, benchmark_store_locations_all),
+    ('sync_watermark',           False, benchmark_sync_watermark),
+    ('_get_imageId_set',         False, benchmark_get_imageId_set),
+    ('_order_series_shelves',    True,  benchmark_order_series_shelves),
+    ('_set_related_books',       True,  benchmark_set_related_books),
+    ]
+
+
+def get_max_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows.
+        return -1
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+def run_benchmark(jobs, counter, function, writes, database_path, work_dir, context, repeat):
+    times = []
+    for i in range(repeat):
+        run_path = database_path
+        if writes:
+            run_path = os.path.join(work_dir, 'KoboReader-write.sqlite')
+            shutil.copyfile(database_path, run_path)
+        counter.reset()
+        start_time = time.perf_counter()
+        function(jobs, run_path, context)
+        times.append(time.perf_counter() - start_time)
+    return {
+        'repeat':         repeat,
+        'seconds_min':    round(min(times), 6),
+        'seconds_median': round(statistics.median(times), 6),
+        'executions':     counter.executions,
+        'statements':     len(counter.statements),
+        'max_rss_kb':     get_max_rss_kb(),
+        }
+
+
+def compare_with_baseline(results, baseline_path, threshold):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    baseline_times = dict(((result['books'], result['benchmark']), result['seconds_min']) for result in baseline['results'])
+    print('\nCompared with %s (plugin version %s):' % (baseline_path, baseline['plugin_version']))
+    regressions = 0
+    for result in results:
+        baseline_seconds = baseline_times.get((result['books'], result['benchmark']))
+        if not baseline_seconds:
+            continue
+        change = (result['seconds_min'] - baseline_seconds) / baseline_seconds
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-26s %6d books %10.4fs %10.4fs %+7.1f%%%s' % (result['benchmark'], result['books'], baseline_seconds,
+                                                             result['seconds_min'], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the plugin against synthetic device databases')
+    parser.add_argument('--books', type=int, action='append',
+                        help='Number of books in a database. Can be given more than once (default: %s)' % DEFAULT_SIZES)
+    parser.add_argument('--chapters', type=int, default=10, help='Number of chapters for each book (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each benchmark (default: %(default)s)')
+    parser.add_argument('--only', action='append', help='Only run the named benchmark. Can be given more than once.')
+    parser.add_argument('--output-dir', default='.', help='Directory for benchmarks.json and benchmarks.csv (default: %(default)s)')
+    parser.add_argument('--baseline', help='benchmarks.json from an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown from the baseline reported as a regression (default: %(default)s)')
+    parser.add_argument('--debug', action='store_true', help='Keep the debug logging of the plugin')
+    args = parser.parse_args()
+
+    jobs = load_plugin(PLUGIN_DIR)
+    import apsw
+    import calibre_plugins.koboutilities.common_utils as common_utils
+    from calibre_plugins.koboutilities import ActionKoboUtilities
+    from calibre.constants import numeric_version as calibre_version
+
+    if not args.debug:
+        # The jobs log every book, which would be most of what was measured.
+        jobs.JOBS_DEBUG = jobs.DEBUG = jobs.cfg.DEBUG = common_utils.DEBUG = False
+
+    counter = StatementCounter()
+    counter.install(apsw)
+
+    plugin_version = '.'.join(str(part) for part in ActionKoboUtilities.version)
+    benchmarks = [benchmark for benchmark in BENCHMARKS if not args.only or benchmark[0] in args.only]
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='kobo_utilities_benchmarks_')
+    try:
+        for books in sorted(args.books or DEFAULT_SIZES):
+            database_path = os.path.join(work_dir, 'KoboReader-%d.sqlite' % books)
+            row_counts = make_kobo_database(database_path, books, args.chapters)
+            print('Generated %d books: %s' % (books, ', '.join('%s=%d' % item for item in row_counts.items())))
+            context = {
+                'books':         get_books(jobs, database_path),
+                'store_options': get_store_options(jobs, database_path),
+                'shelves':       get_shelves(jobs, database_path),
+                'related_books': get_related_books(jobs, database_path),
+                }
+            for name, writes, function in benchmarks:
+                result = {'plugin_version': plugin_version, 'books': books, 'benchmark': name}
+                result.update(run_benchmark(jobs, counter, function, writes, database_path, work_dir, context, args.repeat))
+                results.append(result)
+                print('%-26s %6d books %10.4fs executions=%d statements=%d max_rss_kb=%d' % (
+                        name, books, result['seconds_min'], result['executions'], result['statements'], result['max_rss_kb']))
+            os.remove(database_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    report = {
+        'plugin_version':  plugin_version,
+        'calibre_version': '.'.join(str(part) for part in calibre_version),
+        'apsw_version':    apsw.apswversion(),
+        'sqlite_version':  apsw.sqlitelibversion(),
+        'python_version':  platform.python_version(),
+        'platform':        platform.platform(),
+        'created':         time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'chapters':        args.chapters,
+        'results':         results,
+        }
+    json_path = os.path.join(args.output_dir, 'benchmarks.json')
+    with open(json_path, 'w') as json_file:
+        json.dump(report, json_file, indent=2)
+    csv_path = os.path.join(args.output_dir, 'benchmarks.csv')
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    print('Results written to %s and %s' % (json_path, csv_path))
+
+    if args.baseline and compare_with_baseline(results, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()